@@ -7,7 +7,7 @@ import sys
 from flask import Flask, session, g, request
 from flask import url_for as _flask_url_for
 
-from services import get_db, FIELDS    # services.logger は下でimport
+from services import get_db, close_db, load_session_user, FIELDS    # services.logger は下でimport
 from filters import register_filters
 
 # --- ログ設定を先に定義（後で呼び出す） ---
@@ -43,6 +43,7 @@ def configure_logging():
 # --- Flaskアプリ生成 ---
 app = Flask(__name__)
 app.secret_key = "any_secret"
+app.teardown_appcontext(close_db)   # リクエスト毎のDB接続をプールへ返却
 
 # ログ設定・フィルタ・CLI登録
 configure_logging()           # ← ここで一度だけ設定（※定義を上に移動）
@@ -90,6 +91,10 @@ from blueprints.my_applications_bp import my_applications_bp
 app.register_blueprint(my_applications_bp)
 from blueprints.errors_bp import errors_bp
 app.register_blueprint(errors_bp)
+from blueprints.admin_bp import admin_bp
+app.register_blueprint(admin_bp)
+from blueprints.export_job_bp import export_job_bp
+app.register_blueprint(export_job_bp)
 
 # --- 旧→新エンドポイント互換（後で消せる） ---
 @app.context_processor
@@ -143,20 +148,31 @@ def _log_request_end(response):
     logger.info(f"REQ {request.method} {request.path} {response.status_code} {dur_ms}ms user={uid}")
     return response
 
+# --- 定期メンテナンス（初回リクエストでスレッド起動。MAINTENANCE_SCHEDULER=off なら起動しない）---
+from maintenance import start_scheduler
+
+@app.before_request
+def _start_maintenance():
+    start_scheduler()
+
+# --- メール送信ワーカー（mail_outbox を配送。MAIL_WORKER=off なら起動しない）---
+from mail_outbox import start_mail_worker, wake_mail_worker
+
+@app.before_request
+def _start_mail_worker():
+    start_mail_worker()
+
+app.teardown_appcontext(wake_mail_worker)   # メールを積んだリクエストの終了時に送信を起こす
+
 # --- ログインユーザー読み込み ---
 @app.before_request
 def load_logged_in_user():
     user_id = session.get('user_id')
     g.user = None
-    g.user_roles = []
+    g.user_roles = frozenset()
     if user_id:
-        db = get_db()
-        g.user = db.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
-        g.user_roles = [r['name'] for r in db.execute("""
-            SELECT roles.name FROM roles
-            JOIN user_roles ON roles.id = user_roles.role_id
-            WHERE user_roles.user_id=?
-        """, (user_id,))]
+        # ユーザー行とロールはユーザーごとに短時間キャッシュ（services.load_session_user）
+        g.user, g.user_roles = load_session_user(get_db(), user_id)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,396 @@
+# approval_engine.py
+"""
+申請の一括承認・差し戻し（approval_bp.approval から使う）。
+  - 選択された申請を 1 クエリで読み、new_values の解析・検証は書き込み前に済ませる
+  - 申請種別ごとにまとめ、item / child_item / checkout_history への反映は executemany
+  - item_application の状態更新と application_history の記録も一括
+  - 全体を 1 つの BEGIN IMMEDIATE トランザクションで実行（途中で例外なら全件ロールバック）
+同じ item への申請が複数選ばれた場合は、選択順に「ラウンド」へ分けて順に適用する（ラウンド内で item は重複しない）。
+結果は申請ごとの outcome のリスト。通知メールは on_done で同じトランザクションに積める。
+"""
+import json
+from datetime import datetime
+
+from services import FIELD_KEYS, APPLICATION_SNAPSHOT_KEYS, immediate_transaction, parse_application_values
+
+PENDING = "申請中"
+GONE_STATUSES = ("破棄", "譲渡")
+# 承認時に approval_group（承認者の部署）を記録する入庫系列
+ENTRY_STATUSES = ("入庫持ち出し譲渡申請中", "入庫持ち出し申請中", "入庫申請中")
+# 所有者リスト（枝番 1..n）を作り直す入庫持ち出し系列
+ENTRY_CHECKOUT_STATUSES = ("入庫持ち出し譲渡申請中", "入庫持ち出し申請中")
+# 既存の生存枝番の所有者を差し替える持ち出し系列
+CHECKOUT_STATUSES = ("持ち出し申請中", "持ち出し譲渡申請中")
+# 承認時に transfer_branch_nos を譲渡にする系列
+TRANSFER_STATUSES = ("入庫持ち出し譲渡申請中", "持ち出し譲渡申請中")
+
+_UPSERT_CHILD_SQL = """
+    INSERT INTO child_item (item_id, branch_no, owner, status, comment) VALUES (?, ?, ?, '持ち出し中', '')
+    ON CONFLICT(item_id, branch_no) DO UPDATE SET owner = excluded.owner, status = excluded.status
+"""
+_REPLACE_ALIVE_OWNER_SQL = """
+    UPDATE child_item
+    SET owner  = CASE WHEN status IN ('破棄', '譲渡') THEN owner ELSE ? END,
+        status = CASE WHEN status IN ('破棄', '譲渡') THEN status ELSE '持ち出し中' END
+    WHERE item_id=? AND branch_no=?
+"""
+_TRANSFER_CHILD_SQL = """
+    UPDATE child_item SET status='譲渡', comment=?, owner='', transfer_dispose_date=?
+    WHERE item_id=? AND branch_no=?
+"""
+
+
+def application_content(status: str, new_values: dict, raw_new_values: str = "") -> str:
+    """application_history.application_content に記録する申請内容の表示名。"""
+    if status == "入庫持ち出し譲渡申請中":
+        return "入庫持ち出し譲渡申請"
+    if status == "持ち出し譲渡申請中":
+        return "持ち出し譲渡申請"
+    if status == "破棄・譲渡申請中" and new_values.get("dispose_type") == "破棄":
+        return "破棄申請"
+    if status == "破棄・譲渡申請中" and new_values.get("dispose_type") == "譲渡":
+        return "譲渡申請"
+    if status == "入庫申請中":
+        return "入庫申請"
+    if status == "入庫持ち出し申請中":
+        return "入庫持ち出し申請"
+    if status == "持ち出し申請中":
+        return "持ち出し申請"
+    if status == "返却申請中":
+        return "持ち出し終了申請"
+    return raw_new_values or status or ""
+
+
+def _parent_status(statuses: list[str]):
+    """子が全て破棄/譲渡なら親の確定状態、まだ生存枝があれば None。"""
+    if not statuses or any(s not in GONE_STATUSES for s in statuses):
+        return None
+    if all(s == "破棄" for s in statuses):
+        return "破棄"
+    if all(s == "譲渡" for s in statuses):
+        return "譲渡"
+    return "破棄・譲渡"
+
+
+# ===== 枝番の割り当て（承認画面のプレビューと承認処理で共用）=====
+def _owners(nv: dict) -> list:
+    """申請の所有者リスト。未入力ならサンプル数ぶんの管理者。サンプル数が不正なら ValueError。"""
+    owners = nv.get("owner_list", [])
+    if not owners:
+        try:
+            n = int(nv.get("num_of_samples", 1))
+        except (TypeError, ValueError):
+            raise ValueError(f"サンプル数が不正です（{nv.get('num_of_samples')}）")
+        owners = [nv.get("sample_manager", "")] * n
+    return list(owners)
+
+
+def load_children(db, item_ids) -> dict:
+    """item_id → child_item 行（branch_no 順）のリスト。何件でも 1 クエリ。"""
+    ids = sorted({i for i in item_ids if i is not None})
+    children = {}
+    if not ids:
+        return children
+    for r in db.execute(
+        f"SELECT id, item_id, branch_no, status FROM child_item WHERE item_id IN ({','.join(['?'] * len(ids))}) "
+        "ORDER BY item_id, branch_no",
+        ids
+    ):
+        children.setdefault(r["item_id"], []).append(r)
+    return children
+
+
+def assign_branches(item_id, status: str, owners: list, rows: list) -> tuple[list, str]:
+    """
+    所有者を枝番に割り当て、([(branch_no, owner), ...], 割り当てられない理由 or "") を返す。
+      入庫持ち出し系列 : 枝番 1..n を作り直す
+      持ち出し系列     : 子がなければ 1..n、あれば生きている枝番へ順に（破棄・譲渡は保持。足りなければ割り当てない）
+    """
+    if status in ENTRY_CHECKOUT_STATUSES or not rows:
+        return list(enumerate(owners, 1)), ""
+    alive = [r["branch_no"] for r in rows if r["status"] not in GONE_STATUSES]
+    if len(owners) > len(alive):
+        return [], (
+            f"通し番号 {item_id}: 生きている枝番（{len(alive)}）より所有者が多い（{len(owners)}）ため、"
+            "追加は行わず更新できません。"
+        )
+    return list(zip(alive, owners)), ""
+
+
+def preview_owner_pairs(db, apps: list[dict]):
+    """
+    申請 dict（parsed_values 付き）に owner_pairs / owner_error を付ける。
+    承認時と同じ assign_branches() を使うので、プレビューと承認結果は一致する（child_item は 1 クエリ）。
+    """
+    targets = [
+        a for a in apps
+        if (a.get("parsed_values") or {}).get("status") in ENTRY_CHECKOUT_STATUSES + CHECKOUT_STATUSES
+    ]
+    children = load_children(db, [a["item_id"] for a in targets])
+    for a in apps:
+        a["owner_pairs"], a["owner_error"] = [], ""
+    for a in targets:
+        pv = a["parsed_values"]
+        try:
+            owners = _owners(pv)
+        except ValueError as e:
+            a["owner_error"] = str(e)
+            continue
+        a["owner_pairs"], a["owner_error"] = assign_branches(
+            a["item_id"], pv["status"], owners, children.get(a["item_id"], [])
+        )
+
+
+# ===== 計画（書き込み前の解析・検証）=====
+def _plan(app_row: dict) -> dict:
+    """
+    申請 1 件の new_values を解析して適用計画を作る。不正な内容は ValueError。
+    所有者の既定（サンプル数ぶんの管理者）は、プレビューと同じく item 行に new_values を重ねた
+    parsed_values から決める（new_values は差分なので num_of_samples を持たない）。
+    """
+    try:
+        nv = json.loads(app_row["new_values"] or "{}")
+    except Exception:
+        nv = {}
+    status = nv.get("status")
+    plan = {"app": app_row, "id": app_row["id"], "item_id": app_row["item_id"], "nv": nv, "status": status}
+
+    if status in ENTRY_CHECKOUT_STATUSES or status in CHECKOUT_STATUSES:
+        plan["owners"] = _owners(app_row.get("parsed_values") or nv)
+    if status in TRANSFER_STATUSES:
+        plan["transfer_branch_nos"] = list(nv.get("transfer_branch_nos", []))
+    if status == "破棄・譲渡申請中":
+        try:
+            plan["target_child_ids"] = [t["id"] for t in nv.get("target_child_branches", [])]
+        except (TypeError, KeyError):
+            raise ValueError("破棄・譲渡の対象枝番が不正です")
+    return plan
+
+
+def _rounds(plans: list[dict]) -> list[list[dict]]:
+    """同じ item への申請を別ラウンドへ振り分ける（選択順を維持）。"""
+    rounds = []
+    seen = {}
+    for p in plans:
+        k = p["item_id"]
+        r = seen.get(k, 0) if k is not None else 0
+        if k is not None:
+            seen[k] = r + 1
+        while len(rounds) <= r:
+            rounds.append([])
+        rounds[r].append(p)
+    return rounds
+
+
+def _executemany(db, sql, rows):
+    """行があるときだけ executemany（行が無くても SQL はコンパイルされ、列の不足などで失敗するため）。"""
+    rows = list(rows)
+    if rows:
+        db.executemany(sql, rows)
+
+
+# ===== 適用（1 ラウンド分。ラウンド内で item_id は重複しない）=====
+def _apply_approvals(db, plans, outcomes, *, comment, approver_dept, now_str):
+    # 1) new_values にある item の列を反映（status と識別用スナップショットは除く。申請で変わる列だけ）。
+    #    列の組み合わせごとに executemany
+    field_keys = set(FIELD_KEYS) - set(APPLICATION_SNAPSHOT_KEYS)
+    by_cols = {}
+    for p in plans:
+        vals = {k: v for k, v in p["nv"].items() if k in field_keys and k != "status"}
+        if vals:
+            cols = tuple(vals)
+            by_cols.setdefault(cols, []).append([vals[k] for k in cols] + [p["item_id"]])
+    for cols, rows in by_cols.items():
+        set_clause = ", ".join(f"{k}=?" for k in cols)
+        _executemany(db, f"UPDATE item SET {set_clause} WHERE id=?", rows)
+
+    # 2) 入庫系列は承認者の部署を approval_group に
+    _executemany(db, 
+        "UPDATE item SET approval_group=? WHERE id=?",
+        [(approver_dept, p["item_id"]) for p in plans if p["status"] in ENTRY_STATUSES]
+    )
+
+    # 3) 親の状態遷移
+    status_rows = []
+    for p in plans:
+        if p["status"] in ENTRY_CHECKOUT_STATUSES or p["status"] in CHECKOUT_STATUSES:
+            status_rows.append(("持ち出し中", p["item_id"]))
+        elif p["status"] == "入庫申請中":
+            status_rows.append(("保管中", p["item_id"]))
+    _executemany(db, "UPDATE item SET status=? WHERE id=?", status_rows)
+    _executemany(db, 
+        "UPDATE item SET status='保管中', storage=? WHERE id=?",
+        [(p["nv"].get("storage", ""), p["item_id"]) for p in plans if p["status"] == "返却申請中"]
+    )
+
+    # 4) 子アイテム（所有者リスト）。枝番はプレビューと同じ assign_branches() で決める
+    children = load_children(db, [p["item_id"] for p in plans if p["status"] in CHECKOUT_STATUSES])
+    upserts = []
+    owner_updates = []
+    for p in plans:
+        if p["status"] not in ENTRY_CHECKOUT_STATUSES and p["status"] not in CHECKOUT_STATUSES:
+            continue
+        rows = children.get(p["item_id"], [])
+        pairs, error = assign_branches(p["item_id"], p["status"], p["owners"], rows)
+        if error:
+            outcomes[p["id"]]["message"] = error
+        elif p["status"] in ENTRY_CHECKOUT_STATUSES or not rows:
+            upserts += [(p["item_id"], b, owner) for b, owner in pairs]
+        else:
+            # 生存枝番の所有者だけ更新（破棄・譲渡は保持）
+            owner_updates += [(owner, p["item_id"], b) for b, owner in pairs]
+    _executemany(db, _UPSERT_CHILD_SQL, upserts)
+    _executemany(db, _REPLACE_ALIVE_OWNER_SQL, owner_updates)
+
+    # 5) 持ち出し履歴
+    _executemany(db, 
+        "INSERT INTO checkout_history (item_id, checkout_start_date, checkout_end_date) VALUES (?, ?, ?)",
+        [
+            (p["item_id"], p["nv"].get("checkout_start_date", ""), p["nv"].get("checkout_end_date", ""))
+            for p in plans if p["status"] in ENTRY_CHECKOUT_STATUSES or p["status"] in CHECKOUT_STATUSES
+        ]
+    )
+
+    # 6) 譲渡・返却・破棄の子アイテム更新
+    _executemany(db, 
+        _TRANSFER_CHILD_SQL,
+        [
+            (p["nv"].get("transfer_comment", ""), p["nv"].get("transfer_date", ""), p["item_id"], b)
+            for p in plans if p["status"] in TRANSFER_STATUSES
+            for b in p["transfer_branch_nos"]
+        ]
+    )
+    _executemany(db, 
+        "UPDATE child_item SET status='返却済', owner='' WHERE item_id=? AND status NOT IN ('破棄', '譲渡')",
+        [(p["item_id"],) for p in plans if p["status"] == "返却申請中"]
+    )
+    dispose_rows = []
+    for p in plans:
+        if p["status"] == "破棄・譲渡申請中":
+            new_status = "破棄" if p["nv"].get("dispose_type") == "破棄" else "譲渡"
+            dispose_rows += [
+                (new_status, p["nv"].get("dispose_comment", ""), p["nv"].get("dispose_date", ""), cid)
+                for cid in p["target_child_ids"]
+            ]
+    _executemany(db, 
+        "UPDATE child_item SET status=?, comment=?, owner='', transfer_dispose_date=? WHERE id=?",
+        dispose_rows
+    )
+
+    # 7) 全子が破棄/譲渡になった親の状態確定（破棄・譲渡申請はそうでなければ original_status に戻す）
+    recheck = [p for p in plans if p["status"] in TRANSFER_STATUSES or p["status"] == "破棄・譲渡申請中"]
+    if recheck:
+        ids = [p["item_id"] for p in recheck]
+        statuses = {}
+        for r in db.execute(
+            f"SELECT item_id, status FROM child_item WHERE item_id IN ({','.join(['?'] * len(ids))})", ids
+        ):
+            statuses.setdefault(r["item_id"], []).append(r["status"])
+        parent_rows = []
+        for p in recheck:
+            parent = _parent_status(statuses.get(p["item_id"], []))
+            if parent is None and p["status"] == "破棄・譲渡申請中":
+                parent = p["app"].get("original_status") or None
+            if parent:
+                parent_rows.append((parent, p["item_id"]))
+        _executemany(db, "UPDATE item SET status=? WHERE id=?", parent_rows)
+
+    # 8) 申請の状態と履歴
+    _executemany(db, 
+        "UPDATE item_application SET approver_comment=?, approval_datetime=?, status='承認' WHERE id=?",
+        [(comment, now_str, p["id"]) for p in plans]
+    )
+    _executemany(db, 
+        """
+        INSERT INTO application_history
+        (item_id, applicant, application_content, applicant_comment, application_datetime, approver, status, approval_datetime, approver_comment)
+        VALUES (?, ?, ?, ?, ?, ?, '承認', ?, ?)
+        """,
+        [
+            (
+                p["item_id"], p["app"]["applicant"],
+                application_content(p["status"], p["nv"], p["app"]["new_values"]),
+                p["app"]["applicant_comment"], p["app"]["application_datetime"], p["app"]["approver"],
+                now_str, comment,
+            )
+            for p in plans
+        ]
+    )
+
+
+def _apply_rejections(db, plans, *, comment, now_str):
+    _executemany(db, 
+        "UPDATE item SET status=? WHERE id=?",
+        [(p["app"]["original_status"], p["item_id"]) for p in plans if p["app"].get("original_status")]
+    )
+    _executemany(db, 
+        "UPDATE item_application SET approver_comment=?, approval_datetime=?, status='差し戻し' WHERE id=?",
+        [(comment, now_str, p["id"]) for p in plans]
+    )
+
+
+# ===== 公開 =====
+def process_applications(db, app_ids, action: str, *, comment: str = "", approver_dept: str = "",
+                         now_str: str = None, on_done=None) -> list[dict]:
+    """
+    申請 app_ids を action（'approve' | 'reject'）で一括処理し、選択順の outcome を返す。
+      outcome = {"app_id", "item_id", "ok", "message", "row"（申請行 dict。メール作成用）}
+    申請中でないもの・存在しないもの・内容が不正なものは ok=False で飛ばし、他は処理する。
+    on_done(db, done) は処理できた申請の outcome のリストを渡して、同じトランザクションの中で 1 回呼ばれる
+    （通知メールをまとめて積む用）。
+    """
+    if action not in ("approve", "reject"):
+        raise ValueError(f"unknown action: {action}")
+    now_str = now_str or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    ids = []
+    outcomes = {}
+    for x in app_ids:
+        try:
+            app_id = int(x)
+        except (TypeError, ValueError):
+            continue
+        if app_id not in outcomes:
+            ids.append(app_id)
+            outcomes[app_id] = {"app_id": app_id, "item_id": None, "ok": False, "message": "", "row": None}
+    if not ids:
+        return []
+
+    with immediate_transaction(db):
+        rows = {
+            r["id"]: dict(r) for r in db.execute(
+                f"SELECT * FROM item_application WHERE id IN ({','.join(['?'] * len(ids))})", ids
+            )
+        }
+        parse_application_values(db, list(rows.values()))  # 所有者の既定を決めるための item 行の重ね合わせ
+        plans = []
+        for app_id in ids:
+            out = outcomes[app_id]
+            row = rows.get(app_id)
+            if row is None:
+                out["message"] = "申請が見つかりません"
+                continue
+            out["item_id"] = row["item_id"]
+            out["row"] = row
+            if row["status"] != PENDING:
+                out["message"] = f"既に処理済みです（{row['status']}）"
+                continue
+            try:
+                plans.append(_plan(row))
+            except ValueError as e:
+                out["message"] = str(e)
+                continue
+            out["ok"] = True
+
+        for round_plans in _rounds(plans):
+            if action == "approve":
+                _apply_approvals(db, round_plans, outcomes,
+                                 comment=comment, approver_dept=approver_dept, now_str=now_str)
+            else:
+                _apply_rejections(db, round_plans, comment=comment, now_str=now_str)
+
+        done = [outcomes[i] for i in ids if outcomes[i]["ok"]]
+        if on_done and done:
+            on_done(db, done)
+
+    return [outcomes[i] for i in ids]
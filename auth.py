@@ -12,13 +12,11 @@ authenticate(username, password) を実装すること
 
 # --- SQLite認証（デフォルト） ---
 def authenticate(username, password):
-    import sqlite3
     from werkzeug.security import check_password_hash
+    from services import get_db  # リクエスト内の接続を共有（個別に開かない）
 
-    DB_PATH = 'items.db'
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = get_db()
         user = conn.execute("SELECT * FROM users WHERE username=?", (username,)).fetchone()
         if user and check_password_hash(user['password'], password):
             return {
@@ -0,0 +1,47 @@
+# blueprints/admin_bp.py
+from flask import Blueprint, jsonify
+
+from services import get_db, login_required, roles_required, get_db_stats
+from maintenance import JOBS, list_runs
+from mail_outbox import outbox_status
+
+admin_bp = Blueprint("admin_bp", __name__)
+
+@admin_bp.route('/admin/db_stats')
+@login_required
+@roles_required('admin')
+def db_stats():
+    """
+    このワーカープロセスの DB 接続プール統計（JSON）。
+      hits       … 同一リクエスト内で既存接続を返した回数
+      reuses     … プールの空き接続を再利用した回数
+      opens      … 新規に接続を開いた回数
+      high_water … 同時使用中接続数の最大値
+    """
+    return jsonify(get_db_stats())
+
+@admin_bp.route('/admin/maintenance')
+@login_required
+@roles_required('admin')
+def maintenance_runs():
+    """
+    定期メンテナンスのジョブ設定（実行間隔 秒）と直近の実行ログ（JSON）。
+    実行ログは maintenance_run の新しい順 50 件。
+    """
+    db = get_db()
+    return jsonify({
+        "jobs": {name: interval for name, (_, interval) in JOBS.items()},
+        "runs": list_runs(db),
+    })
+
+
+@admin_bp.route('/admin/mail_outbox')
+@login_required
+@roles_required('admin')
+def mail_outbox_status():
+    """
+    メール送信キューの状況（JSON）。
+      counts … 状態（pending / sending / sent / failed）ごとの件数
+      recent … 直近 50 通（本文は除く。last_error は直近の送信失敗の理由）
+    """
+    return jsonify(outbox_status(get_db()))
@@ -1,6 +1,6 @@
 # blueprints/auth_bp.py
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
-from services import get_db
+from services import get_db, forget_session_user
 from auth import authenticate
 from datetime import datetime, timezone, timedelta
 
@@ -36,6 +36,7 @@ def login():
                 db.commit()
                 user_id = db.execute("SELECT id FROM users WHERE username=?", (username,)).fetchone()['id']
 
+            forget_session_user(user_id)  # ログイン時に更新したプロフィールを次のリクエストから使う
             session['user_id'] = user_id
             return redirect(url_for('index_bp.index'))
         else:
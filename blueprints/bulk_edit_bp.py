@@ -5,8 +5,9 @@ from services import (
     get_db,
     login_required,
     FIELDS,
-    acquire_locks, release_locks,
+    acquire_locks, release_locks, get_locked_ids,
 )
+from user_directory import get_user_display
 
 bulk_edit_bp = Blueprint("bulk_edit_bp", __name__)
 
@@ -52,13 +53,7 @@ def bulk_edit():
         return redirect(url_for('index_bp.index'))
 
     # user_display を作成（realname 優先、なければ username）
-    user_rows = db.execute("""
-        SELECT
-            username,
-            COALESCE(NULLIF(realname, ''), username) AS display_name
-        FROM users
-    """).fetchall()
-    user_display = {r["username"]: r["display_name"] for r in user_rows}
+    user_display = get_user_display(db)
 
     # 編集対象の取得（index と同じ項目セット）
     user_field_keys = [f['key'] for f in FIELDS if not f.get('internal', False) and f.get('show_in_index', True)]
@@ -128,8 +123,7 @@ def bulk_edit_cancel():
 def unlock_my_locks():
     db = get_db()
     # 自分がロックしている全IDを収集して解除
-    rows = db.execute("SELECT id FROM item WHERE locked_by=?", (g.user['username'],)).fetchall()
-    ids = [r["id"] for r in rows]
+    ids = get_locked_ids(db, g.user['username'])
     if ids:
         release_locks(db, ids)
         flash(f"{len(ids)}件のロックを解除しました。")
@@ -7,12 +7,11 @@ from services import (
     get_db,
     login_required, roles_required,
     INDEX_FIELDS,
-    get_proper_users,
-    get_user_profiles,
-    get_user_profile,
+    transition_items,
 )
+from user_directory import get_proper_users, get_user_profiles, get_user_profile
 
-from send_mail import send_mail
+from mail_outbox import enqueue_mail
 
 bulk_manager_change_bp = Blueprint("bulk_manager_change_bp", __name__)
 
@@ -48,11 +47,8 @@ def bulk_manager_change():
         flash(f"選択されたアイテムは一括管理者変更の対象状態ではありません（許可: {', '.join(BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES)}）。")
         return redirect(url_for('index_bp.index'))
 
-    # 許可対象のみを再取得（以降の処理はこの items を使用）
-    items = db.execute(
-        f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_ids))})",
-        allowed_ids
-    ).fetchall()
+    # 許可対象のみ（以降の画面表示はこの items を使用）
+    items = [row for row in items_all if row['status'] in BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES]
 
     proper_users = get_proper_users(db)
     proper_usernames = [u['username'] for u in proper_users]
@@ -73,10 +69,7 @@ def bulk_manager_change():
         new_manager = request.form.get('new_manager', '').strip()
         if not new_manager or new_manager not in proper_usernames:
             # エラー表示時も profiles を渡す
-            items_err = db.execute(
-                f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_ids))})",
-                allowed_ids
-            ).fetchall()
+            items_err = items
             current_manager_usernames = list({item['sample_manager'] for item in items_err})
             display_profiles = get_user_profiles(db, current_manager_usernames)
 
@@ -89,45 +82,21 @@ def bulk_manager_change():
                 error_message="管理者は候補から選択してください。"
             )
 
-        # ▼ 送信時点でもう一度、最新の status を確認（競合対策）
-        rows_status = db.execute(
-            f"SELECT id, status FROM item WHERE id IN ({','.join(['?']*len(allowed_ids))})",
-            allowed_ids
-        ).fetchall()
-        allowed_now_ids = [r['id'] for r in rows_status if r['status'] in BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES]
-        not_allowed_now_ids = [r['id'] for r in rows_status if r['status'] not in BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES]
+        # 許可状態のものだけ 1 文で管理者を変更（BEGIN IMMEDIATE の中。変更前の行が返る）
+        items_before = list(transition_items(
+            db, allowed_ids, BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES, values={"sample_manager": new_manager}
+        ).values())
+        if not items_before:
+            db.rollback()
+            flash("全ての対象が許可外状態となったため、変更は行いませんでした。")
+            return redirect(url_for('index_bp.index'))
+        changed_ids = {it['id'] for it in items_before}
+        not_allowed_now_ids = [i for i in allowed_ids if i not in changed_ids]
         if not_allowed_now_ids:
             flash(f"送信中に状態が変更されたため、一部のアイテムを除外しました（ID: {', '.join(map(str, not_allowed_now_ids))}）。"
                   f"許可状態: {', '.join(BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES)}")
-
-        if not allowed_now_ids:
-            flash("全ての対象が許可外状態となったため、変更は行いませんでした。")
-            return redirect(url_for('index_bp.index'))
-
-        # 旧管理者（変更前）を確定（更新対象 items のみ）
-        items_before = db.execute(
-            f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_now_ids))})",
-            allowed_now_ids
-        ).fetchall()
         old_managers = set(item['sample_manager'] for item in items_before)
 
-        # ▼ 念押し：更新直前にも状態確認（トランザクション境界での競合に備える）
-        rows_status_final = db.execute(
-            f"SELECT id, status FROM item WHERE id IN ({','.join(['?']*len(allowed_now_ids))})",
-            allowed_now_ids
-        ).fetchall()
-        allowed_final_ids = [r['id'] for r in rows_status_final if r['status'] in BULK_MANAGER_CHANGE_ALLOWED_ITEM_STATUSES]
-        if not allowed_final_ids:
-            flash("更新直前に全ての対象が許可外状態となったため、変更は適用されませんでした。")
-            return redirect(url_for('index_bp.index'))
-
-        # 一括更新（許可最終確認を通過したIDだけ）
-        db.executemany(
-            "UPDATE item SET sample_manager=? WHERE id=?",
-            [(new_manager, i) for i in allowed_final_ids]
-        )
-        db.commit()
-
         # === 通知メール ===
         usernames_to_fetch = list(old_managers | {new_manager})
         profiles = get_user_profiles(db, usernames_to_fetch)
@@ -144,29 +113,25 @@ def bulk_manager_change():
         if changer_prof.get("email"):
             to_emails.add(changer_prof["email"])
 
-        # メール本文に載せるのは実際に更新した items のみ
-        items_updated = db.execute(
-            f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_final_ids))})",
-            allowed_final_ids
-        ).fetchall()
-
-        subject = f"[通知] 管理者一括変更 ({len(items_updated)}件)"
+        # メール本文に載せるのは実際に更新した items のみ（旧管理者を出すため変更前の行）
+        subject = f"[通知] 管理者一括変更 ({len(items_before)}件)"
         body = render_template(
             "mails/manager_change.txt",
             new_prof=new_prof,
             old_profs=old_profs,
-            items=items_updated,
+            items=items_before,
             profiles=profiles,
             changer_prof=changer_prof
         )
 
         to = ",".join(sorted(e for e in to_emails if e))
-        result = send_mail(to=to, subject=subject, body=body)
-
-        if result:
-            flash(f"管理者を「{new_manager}」に一括変更しました。旧管理者・新管理者にメールで連絡しました。")
+        # 更新と同じトランザクションで送信キューへ（送信はワーカーが行う）
+        queued = enqueue_mail(db, to, subject, body)
+        db.commit()
+        if queued:
+            flash(f"管理者を「{new_manager}」に一括変更しました。旧管理者・新管理者にメールで連絡します。")
         else:
-            flash(f"管理者を「{new_manager}」に一括変更しました。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+            flash(f"管理者を「{new_manager}」に一括変更しました。メールの宛先がないため、関係者への連絡をお願いします。")
 
         return redirect(url_for('index_bp.index'))
 
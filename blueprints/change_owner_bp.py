@@ -6,10 +6,12 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from services import (
     get_db,
     login_required, roles_required,
-    get_proper_users, get_partner_users,
-    get_user_profiles, get_user_profile,
+    transition_items,
 )
-from send_mail import send_mail
+from user_directory import (
+    get_proper_users, get_partner_users, get_user_profiles, get_user_profile,
+)
+from mail_outbox import enqueue_mail
 
 change_owner_bp = Blueprint("change_owner_bp", __name__)
 
@@ -79,13 +81,10 @@ def change_owner():
         )
 
     # POST: 変更反映
-    # 送信時も最新状態で許可ステータスを再確認（競合対策）
-    rows_status = db.execute(
-        f"SELECT id, status FROM item WHERE id IN ({','.join(['?']*len(target_ids))})",
-        target_ids
-    ).fetchall()
-    allowed_now_ids = {r['id'] for r in rows_status if r['status'] in CHANGE_OWNER_ALLOWED_ITEM_STATUSES}
-    not_allowed_now_ids = {r['id'] for r in rows_status if r['status'] not in CHANGE_OWNER_ALLOWED_ITEM_STATUSES}
+    # 送信時の最新状態で許可ステータスを確認（BEGIN IMMEDIATE で書き込みロックを取ってから読む。競合対策）
+    locked = transition_items(db, target_ids, CHANGE_OWNER_ALLOWED_ITEM_STATUSES)
+    allowed_now_ids = set(locked)
+    not_allowed_now_ids = set(target_ids) - allowed_now_ids
     if not_allowed_now_ids:
         flash(f"送信中に状態が変更されたため、一部アイテムを除外しました（ID: {', '.join(map(str, sorted(not_allowed_now_ids)))}）。"
               f"許可状態: {', '.join(CHANGE_OWNER_ALLOWED_ITEM_STATUSES)}")
@@ -101,25 +100,12 @@ def change_owner():
             updates.append((new_owner, ci['id']))
 
     if updates:
-        # ▼ 念押し：更新直前に親アイテムの現状態を再確認し、許可外になっていた子はスキップ
-        #   （上の allowed_now_ids で基本弾いているが、念のため再取得して防御）
-        parent_ids_for_updates = list({ci['item_id'] for ci in child_items if any(u[1] == ci['id'] for u in updates)})
-        rows_status2 = db.execute(
-            f"SELECT id, status FROM item WHERE id IN ({','.join(['?']*len(parent_ids_for_updates))})",
-            parent_ids_for_updates
-        ).fetchall()
-        allowed_final_ids = {r['id'] for r in rows_status2 if r['status'] in CHANGE_OWNER_ALLOWED_ITEM_STATUSES}
-
-        # child_item.id -> parent item_id マップ
+        # 親はロック下で許可状態を確認済み（allowed_now_ids）なので、そのまま反映する
         ci_parent_map = {ci['id']: ci['item_id'] for ci in child_items}
-        updates_final = [(new_owner, ci_id) for (new_owner, ci_id) in updates if ci_parent_map.get(ci_id) in allowed_final_ids]
-
-        if not updates_final:
-            flash("所有者変更対象が許可状態ではなくなったため、変更は適用されませんでした。")
-            return redirect(url_for('index_bp.index'))
+        updates_final = updates
+        allowed_final_ids = {ci_parent_map[ci_id] for (_, ci_id) in updates_final}
 
         db.executemany("UPDATE child_item SET owner=? WHERE id=?", updates_final)
-        db.commit()
 
         # 履歴記録
         now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -138,14 +124,12 @@ def change_owner():
                 "所有者変更", f"{branch_no}番 所有者: {old_owner}→{new_owner}",
                 now_str, "", "承認不要", now_str, ""
             ))
-        db.commit()
 
         # メール通知
         updates_map = {ci_id: new_owner for (new_owner, ci_id) in updates_final}
 
         # 許可IDのみで items_by_id を作る（メールの manager 参照用）
-        items_allowed = [it for it in items if it['id'] in allowed_final_ids]
-        items_by_id = {it['id']: it for it in items_allowed}  # item_id -> sqlite3.Row
+        items_by_id = {i: locked[i] for i in allowed_final_ids}  # item_id -> ロック下で読んだ行
 
         changes = []
         manager_usernames = set()
@@ -224,12 +208,15 @@ def change_owner():
             profiles=profiles,
         )
 
-        result = send_mail(to=to, subject=subject, body=body)
-        if result:
-            flash("所有者を変更しました。所有者・管理者・変更者にメールで連絡しました。")
+        # 更新と同じトランザクションで送信キューへ（送信はワーカーが行う）
+        queued = enqueue_mail(db, to, subject, body)
+        db.commit()
+        if queued:
+            flash("所有者を変更しました。所有者・管理者・変更者にメールで連絡します。")
         else:
-            flash("所有者を変更しました。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+            flash("所有者を変更しました。メールの宛先がないため、関係者への連絡をお願いします。")
 
     else:
+        db.rollback()
         flash("変更はありませんでした。")
     return redirect(url_for('index_bp.index'))
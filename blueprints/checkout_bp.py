@@ -2,14 +2,16 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g
 from datetime import datetime
 from collections import defaultdict
-import json
 
 from services import (
     get_db, INDEX_FIELDS, login_required, roles_required,
-    get_proper_users, get_partner_users, get_managers_by_department, get_user_profiles,
-    logger
+    transition_items, insert_applications, application_snapshot, logger
 )
-from send_mail import send_mail
+from user_directory import (
+    get_managers_by_department, get_proper_users, get_partner_users, get_user_profiles,
+    get_user_display,
+)
+from mail_outbox import enqueue_mail
 
 checkout_bp = Blueprint("checkout_bp", __name__)
 
@@ -104,12 +106,7 @@ def checkout_request():
         approver_default = sorted_managers[0]['username'] if sorted_managers else ''
 
         # index と同じ realname 優先の表示名マップ
-        user_rows = db.execute("""
-            SELECT username,
-                   COALESCE(NULLIF(realname, ''), username) AS display_name
-            FROM users
-        """).fetchall()
-        user_display = {r["username"]: r["display_name"] for r in user_rows}
+        user_display = get_user_display(db)
 
         return render_template(
             'checkout_form.html',
@@ -238,52 +235,41 @@ def checkout_request():
         for id in item_ids:
             owner_lists[str(id)] = form.getlist(f'owner_list_{id}')
 
-        for id in item_ids:
-            item = db.execute("SELECT * FROM item WHERE id=?", (id,)).fetchone()
-
-            # ▼ 念押し：更新直前にも状態チェック（競合対策）
-            if item['status'] not in CHECKOUT_ALLOWED_ITEM_STATUSES:
-                # 許可外になっていたらこのIDだけスキップ（必要なら収集して後で通知も可）
+        # 許可状態のものだけ 1 文で申請中へ（BEGIN IMMEDIATE の中。変更前の行が返る）
+        moved = transition_items(db, item_ids, CHECKOUT_ALLOWED_ITEM_STATUSES, new_status)
+        if not moved:
+            db.rollback()
+            flash(f"選択されたアイテムは申請対象の状態ではなくなりました（許可: {', '.join(CHECKOUT_ALLOWED_ITEM_STATUSES)}）。")
+            return redirect(url_for('index_bp.index'))
+        moved_ids = {str(k) for k in moved}
+        skipped = [str(i) for i in item_ids if str(i) not in moved_ids]
+        item_ids = [i for i in item_ids if str(i) in moved_ids]  # 以降（申請・メール）は実際に動いたものだけ
+
+        # 譲渡枝番（"itemID_branchNo" 形式）は item ごとに 1 回で振り分けておく
+        transfer_nos_by_item = {}
+        for t in transfer_branch_ids if with_transfer else []:
+            try:
+                tid, branch_no = t.split("_")
+                transfer_nos_by_item.setdefault(str(tid), []).append(int(branch_no))
+            except Exception:
                 continue
 
-            original_status = item['status']
-
-            db.execute("UPDATE item SET status=? WHERE id=?", (new_status, id))
-
-            item = db.execute("SELECT * FROM item WHERE id=?", (id,)).fetchone()
-            new_values = dict(item)
+        # new_values（識別用スナップショット＋申請で変わる列＋申請内容）はメモリ上で組み立て、申請はまとめて登録
+        payloads = []
+        for id in item_ids:
+            before = moved[int(id)]
+            new_values = application_snapshot(before)
             new_values['sample_manager'] = manager
+            new_values['status'] = new_status
+            new_values['checkout_start_date'] = start_date
+            new_values['checkout_end_date'] = end_date
+            new_values['owner_list'] = owner_lists.get(str(id), [])
             if with_transfer:
-                new_values['status'] = "持ち出し譲渡申請中"
-                new_values['checkout_start_date'] = start_date
-                new_values['checkout_end_date'] = end_date
-                new_values['owner_list'] = owner_lists.get(str(id), [])
                 new_values['transfer_date'] = transfer_date
-                transfer_ids_this = []
-                for t in transfer_branch_ids:
-                    try:
-                        tid, branch_no = t.split("_")
-                        if str(tid) == str(id):
-                            transfer_ids_this.append(int(branch_no))
-                    except Exception:
-                        continue
-                new_values['transfer_branch_nos'] = transfer_ids_this
+                new_values['transfer_branch_nos'] = transfer_nos_by_item.get(str(id), [])
                 new_values['transfer_comment'] = transfer_comment
-            else:
-                new_values['status'] = "持ち出し申請中"
-                new_values['checkout_start_date'] = start_date
-                new_values['checkout_end_date'] = end_date
-                new_values['owner_list'] = owner_lists.get(str(id), [])
-
-            db.execute('''
-                INSERT INTO item_application
-                (item_id, new_values, applicant, applicant_comment, approver, status, application_datetime, original_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                id, json.dumps(new_values, ensure_ascii=False), applicant, comment, approver, "申請中", now_str, original_status
-            ))
-
-        db.commit()
+            payloads.append((id, new_values, before['status']))
+        insert_applications(db, payloads, applicant, approver, comment, now_str)
 
         # ==== メール送信 ====
         changes = []
@@ -333,11 +319,15 @@ def checkout_request():
             transfer_date=transfer_date,
         )
 
-        result = send_mail(to=to, subject=subject, body=body)
-        if result:
-            flash("持ち出し申請を保存しました。承認待ちです。承認者ほか関係者にメールで連絡しました。")
+        # 更新と同じトランザクションで送信キューへ（送信はワーカーが行う）
+        queued = enqueue_mail(db, to, subject, body)
+        db.commit()
+        if skipped:
+            flash(f"送信中に状態が変更されたため、一部のアイテムを除外しました（ID: {', '.join(skipped)}）。")
+        if queued:
+            flash("持ち出し申請を保存しました。承認待ちです。承認者ほか関係者にメールで連絡します。")
         else:
-            flash("持ち出し申請を保存しました。承認待ちです。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+            flash("持ち出し申請を保存しました。承認待ちです。メールの宛先がないため、関係者への連絡をお願いします。")
 
         return redirect(url_for('index_bp.index'))
 
@@ -1,5 +1,4 @@
 # blueprints/dispose_transfer_request_bp.py
-import json
 from datetime import datetime
 from collections import defaultdict
 
@@ -9,12 +8,14 @@ from services import (
     get_db,
     login_required, roles_required,
     INDEX_FIELDS,
-    get_managers_by_department,
-    get_proper_users,
-    get_user_profiles,
+    attach_sample_counts, transition_items, insert_applications, application_snapshot,
+)
+from user_directory import (
+    get_managers_by_department, get_proper_users, get_user_profiles,
+    get_user_display, get_user_display_dept,
 )
 
-from send_mail import send_mail
+from mail_outbox import enqueue_mail
 
 dispose_transfer_request_bp = Blueprint("dispose_transfer_request_bp", __name__)
 
@@ -36,24 +37,10 @@ def dispose_transfer_request():
     handler_default = g.user['username']
 
     # index と同じ realname 優先の表示名マップ
-    user_rows = db.execute("""
-        SELECT username,
-            COALESCE(NULLIF(realname, ''), username) AS display_name
-        FROM users
-    """).fetchall()
-    user_display = {r["username"]: r["display_name"] for r in user_rows}
+    user_display = get_user_display(db)
 
     #（所有者用：department + realname 形式／realname 空なら username）
-    user_rows2 = db.execute("""
-        SELECT
-            username,
-            TRIM(
-                COALESCE(NULLIF(department,''),'') || ' ' ||
-                COALESCE(NULLIF(realname,''), username)
-            ) AS display_name
-        FROM users
-    """).fetchall()
-    user_display_dept = {r["username"]: r["display_name"] for r in user_rows2}
+    user_display_dept = get_user_display_dept(db)
 
     # POST: 申請フォーム送信
     if request.method == 'POST' and request.form.get('action') == 'submit':
@@ -109,22 +96,7 @@ def dispose_transfer_request():
             else:
                 items = []
 
-            item_list = []
-            for item in items:
-                item = dict(item)
-                item_id = item['id']
-                child_total = db.execute(
-                    "SELECT COUNT(*) FROM child_item WHERE item_id=?", (item_id,)
-                ).fetchone()[0]
-                if child_total == 0:
-                    item['sample_count'] = item.get('num_of_samples', 0)
-                else:
-                    cnt = db.execute(
-                        "SELECT COUNT(*) FROM child_item WHERE item_id=? AND status NOT IN (?, ?)",
-                        (item_id, "破棄", "譲渡")
-                    ).fetchone()[0]
-                    item['sample_count'] = cnt
-                item_list.append(item)
+            item_list = attach_sample_counts(db, [dict(item) for item in items])
 
             if allowed_ids:
                 child_items = db.execute(
@@ -158,59 +130,46 @@ def dispose_transfer_request():
         applicant = g.user['username']
         now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        for item_id in item_ids:
-            # ▼ 念押し：更新直前にも状態チェック（競合で変化した場合の防止）
-            cur = db.execute("SELECT * FROM item WHERE id=?", (item_id,)).fetchone()
-            if not cur or cur['status'] not in DISPOSE_TRANSFER_ALLOWED_ITEM_STATUSES:
-                continue
-
-            item_dict = dict(cur)
-            child_total = db.execute(
-                "SELECT COUNT(*) FROM child_item WHERE item_id=?", (item_id,)
-            ).fetchone()[0]
-            if child_total == 0:
-                item_dict['sample_count'] = item_dict.get('num_of_samples', 0)
-            else:
-                cnt = db.execute(
-                    "SELECT COUNT(*) FROM child_item WHERE item_id=? AND status NOT IN (?, ?)",
-                    (item_id, "破棄", "譲渡")
-                ).fetchone()[0]
-                item_dict['sample_count'] = cnt
+        # 許可状態のものだけ 1 文で破棄・譲渡申請中へ（BEGIN IMMEDIATE の中。変更前の行が返る）
+        moved = transition_items(db, item_ids, DISPOSE_TRANSFER_ALLOWED_ITEM_STATUSES, "破棄・譲渡申請中")
+        if not moved:
+            db.rollback()
+            flash(f"選択されたアイテムは申請対象の状態ではなくなりました（許可: {', '.join(DISPOSE_TRANSFER_ALLOWED_ITEM_STATUSES)}）。")
+            return redirect(url_for('index_bp.index'))
+        moved_ids = {str(k) for k in moved}
+        skipped = [str(i) for i in item_ids if str(i) not in moved_ids]
+        item_ids = [i for i in item_ids if str(i) in moved_ids]  # 以降（申請・メール）は実際に動いたものだけ
 
-            new_values = dict(item_dict)
+        # 対象の子アイテム（枝番）はまとめて 1 回で引く
+        branches_by_item = defaultdict(list)
+        if target_child_ids:
+            rows = db.execute(
+                f"SELECT id, item_id, branch_no FROM child_item WHERE id IN ({','.join(['?']*len(target_child_ids))})",
+                target_child_ids
+            ).fetchall()
+            rows_by_id = {str(r['id']): r for r in rows}
+            for cid in target_child_ids:
+                r = rows_by_id.get(str(cid))
+                if r:
+                    branches_by_item[r['item_id']].append({"id": cid, "branch_no": r['branch_no']})
+
+        item_dicts = [moved[int(i)] for i in item_ids]
+        # new_values（識別用スナップショット＋申請で変わる列＋申請内容）はメモリ上で組み立て、申請はまとめて登録
+        payloads = []
+        for item_dict in item_dicts:
+            item_id = item_dict['id']
+            new_values = application_snapshot(item_dict)
             new_values['dispose_type'] = dispose_type
             new_values['dispose_date'] = dispose_date
             new_values['handler'] = handler
             new_values['dispose_comment'] = dispose_comment
-
-            target_child_branches_this = []
-            for cid in target_child_ids:
-                row = db.execute("SELECT item_id, branch_no FROM child_item WHERE id=?", (cid,)).fetchone()
-                if row and row['item_id'] == int(item_id):
-                    target_child_branches_this.append({"id": cid, "branch_no": row['branch_no']})
-
-            new_values['target_child_branches'] = target_child_branches_this
+            new_values['target_child_branches'] = branches_by_item.get(item_id, [])
             new_values['status'] = "破棄・譲渡申請中"
-
-            original_status = cur['status']
-
-            db.execute('''
-                INSERT INTO item_application
-                (item_id, new_values, applicant, applicant_comment, approver, status, application_datetime, original_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                item_id, json.dumps(new_values, ensure_ascii=False), applicant,
-                applicant_comment, approver, "申請中", now_str, original_status
-            ))
-            db.execute("UPDATE item SET status=? WHERE id=?", ("破棄・譲渡申請中", item_id))
-        db.commit()
+            payloads.append((item_id, new_values, item_dict['status']))
+        insert_applications(db, payloads, applicant, approver, applicant_comment, now_str)
 
         # ==== メール送信部（承認者・申請者・管理者）====
-        items_rows = db.execute(
-            f"SELECT id, sample_manager FROM item WHERE id IN ({','.join(['?']*len(item_ids))})",
-            item_ids
-        ).fetchall()
-        manager_usernames = {row['sample_manager'] for row in items_rows if row and row['sample_manager']}
+        manager_usernames = {row['sample_manager'] for row in item_dicts if row['sample_manager']}
 
         applicant = g.user['username']
         usernames_to_fetch = {approver, applicant} | manager_usernames
@@ -228,21 +187,11 @@ def dispose_transfer_request():
                 to_emails.add(email)
         to = ",".join(sorted(to_emails))
 
-        # 本文用：対象アイテムと枝番
-        branches_by_item = defaultdict(list)
-        if target_child_ids:
-            rows = db.execute(
-                f"SELECT id, item_id, branch_no FROM child_item WHERE id IN ({','.join(['?']*len(target_child_ids))})",
-                target_child_ids
-            ).fetchall()
-            for r in rows:
-                branches_by_item[r['item_id']].append(r['branch_no'])
-
         changes = []
-        for row in items_rows:
+        for row in item_dicts:
             item_id = row['id']
             manager  = row['sample_manager']
-            branch_nos = sorted(branches_by_item.get(item_id, []))
+            branch_nos = sorted(b["branch_no"] for b in branches_by_item.get(item_id, []))
             changes.append({
                 "item_id": item_id,
                 "manager": manager,
@@ -264,11 +213,15 @@ def dispose_transfer_request():
             applicant_comment=applicant_comment,
         )
 
-        result = send_mail(to=to, subject=subject, body=body)
-        if result:
-            flash("破棄・譲渡申請を保存しました。承認待ちです。承認者ほか関係者にメールで連絡しました。")
+        # 更新と同じトランザクションで送信キューへ（送信はワーカーが行う）
+        queued = enqueue_mail(db, to, subject, body)
+        db.commit()
+        if skipped:
+            flash(f"送信中に状態が変更されたため、一部のアイテムを除外しました（ID: {', '.join(skipped)}）。")
+        if queued:
+            flash("破棄・譲渡申請を保存しました。承認待ちです。承認者ほか関係者にメールで連絡します。")
         else:
-            flash("破棄・譲渡申請を保存しました。承認待ちです。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+            flash("破棄・譲渡申請を保存しました。承認待ちです。メールの宛先がないため、関係者への連絡をお願いします。")
         # ==== ここまで ====
 
         return redirect(url_for('index_bp.index'))
@@ -299,22 +252,7 @@ def dispose_transfer_request():
             f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_ids))})", allowed_ids
         ).fetchall()
 
-        item_list = []
-        for item in items:
-            item = dict(item)
-            item_id = item['id']
-            child_total = db.execute(
-                "SELECT COUNT(*) FROM child_item WHERE item_id=?", (item_id,)
-            ).fetchone()[0]
-            if child_total == 0:
-                item['sample_count'] = item.get('num_of_samples', 0)
-            else:
-                cnt = db.execute(
-                    "SELECT COUNT(*) FROM child_item WHERE item_id=? AND status NOT IN (?, ?)",
-                    (item_id, "破棄", "譲渡")
-                ).fetchone()[0]
-                item['sample_count'] = cnt
-            item_list.append(item)
+        item_list = attach_sample_counts(db, [dict(item) for item in items])
 
         child_items = db.execute(
             f"SELECT * FROM child_item WHERE item_id IN ({','.join(['?']*len(allowed_ids))}) ORDER BY item_id, branch_no",
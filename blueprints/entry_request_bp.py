@@ -1,5 +1,4 @@
 # blueprints/entry_request_bp.py
-import json
 from datetime import datetime
 from collections import defaultdict
 
@@ -9,10 +8,12 @@ from services import (
     get_db,
     login_required, roles_required,
     INDEX_FIELDS,
-    get_managers_by_department, get_proper_users, get_partner_users,
-    get_user_profiles,
+    transition_items, insert_applications, application_snapshot,
 )
-from send_mail import send_mail
+from user_directory import (
+    get_managers_by_department, get_proper_users, get_partner_users, get_user_profiles,
+)
+from mail_outbox import enqueue_mail
 
 entry_request_bp = Blueprint("entry_request_bp", __name__)
 
@@ -194,59 +195,43 @@ def entry_request():
         for id in item_ids:
             owner_lists[str(id)] = form.getlist(f'owner_list_{id}')
 
-        for id in item_ids:
-            # item_applicationに申請内容を登録
-            item = db.execute("SELECT * FROM item WHERE id=?", (id,)).fetchone()
-
-            # ▼ 念押し：更新直前にも状態チェック（競合対策・許可ステータスのみ）
-            if item['status'] not in ENTRY_ALLOWED_ITEM_STATUSES:
-                # 許可外になっていたらこのIDだけスキップ（必要なら収集して後で通知も可）
+        # 許可状態のものだけ 1 文で申請中へ（BEGIN IMMEDIATE の中。変更前の行が返る）
+        moved = transition_items(db, item_ids, ENTRY_ALLOWED_ITEM_STATUSES, new_status)
+        if not moved:
+            db.rollback()
+            flash(f"選択されたアイテムは申請対象の状態ではなくなりました（許可: {', '.join(ENTRY_ALLOWED_ITEM_STATUSES)}）。")
+            return redirect(url_for('index_bp.index'))
+        moved_ids = {str(k) for k in moved}
+        skipped = [str(i) for i in item_ids if str(i) not in moved_ids]
+        item_ids = [i for i in item_ids if str(i) in moved_ids]  # 以降（申請・メール）は実際に動いたものだけ
+
+        # 譲渡枝番（"itemID_branchNo" 形式）は item ごとに 1 回で振り分けておく
+        transfer_nos_by_item = {}
+        for t in transfer_branch_ids if (with_checkout and with_transfer) else []:
+            try:
+                tid, branch_no = t.split("_")
+                transfer_nos_by_item.setdefault(str(tid), []).append(int(branch_no))
+            except Exception:
                 continue
 
-            original_status = item['status']
-
-            # itemのstatusのみ即時変更
-            db.execute("UPDATE item SET status=? WHERE id=?", (new_status, id))
-
-            # item内容を取得し、申請内容をnew_values(dict)として用意
-            item = db.execute("SELECT * FROM item WHERE id=?", (id,)).fetchone()
-            new_values = dict(item)
+        # item_applicationに申請内容を登録（new_values は識別用スナップショット＋申請で変わる列＋申請内容。メモリ上で組み立てまとめて INSERT）
+        payloads = []
+        for id in item_ids:
+            before = moved[int(id)]
+            new_values = application_snapshot(before)
             new_values['sample_manager'] = manager
-            # ▼ 新規：譲渡申請情報
-            if with_checkout and with_transfer:
-                new_values['status'] = "入庫持ち出し譲渡申請中"
+            new_values['status'] = new_status
+            if with_checkout:
                 new_values['checkout_start_date'] = start_date
                 new_values['checkout_end_date'] = end_date
                 new_values['owner_list'] = owner_lists.get(str(id), [])
+            # ▼ 譲渡申請情報
+            if with_checkout and with_transfer:
                 new_values['transfer_date'] = transfer_date
-                # transfer_branch_ids 形式は itemID_branchNo。ここではitemごとに格納
-                transfer_ids_this = []
-                for t in transfer_branch_ids:
-                    try:
-                        tid, branch_no = t.split("_")
-                        if str(tid) == str(id):
-                            transfer_ids_this.append(int(branch_no))
-                    except Exception:
-                        continue
-                new_values['transfer_branch_nos'] = transfer_ids_this
+                new_values['transfer_branch_nos'] = transfer_nos_by_item.get(str(id), [])
                 new_values['transfer_comment'] = transfer_comment
-            elif with_checkout:
-                new_values['status'] = "入庫持ち出し申請中"
-                new_values['checkout_start_date'] = start_date
-                new_values['checkout_end_date'] = end_date
-                new_values['owner_list'] = owner_lists.get(str(id), [])
-            else:
-                new_values['status'] = "入庫申請中"
-
-            db.execute('''
-                INSERT INTO item_application
-                (item_id, new_values, applicant, applicant_comment, approver, status, application_datetime, original_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                id, json.dumps(new_values, ensure_ascii=False), applicant, comment, approver, "申請中", now_str, original_status
-            ))
-
-        db.commit()
+            payloads.append((id, new_values, before['status']))
+        insert_applications(db, payloads, applicant, approver, comment, now_str)
 
         # ==== メール送信部（承認者・申請者・管理者・※with_checkout時は所有者も）====
         if with_checkout and with_transfer:
@@ -330,11 +315,15 @@ def entry_request():
             transfer_date=transfer_date,
         )
 
-        result = send_mail(to=to, subject=subject, body=body)
-        if result:
-            flash(f"{subject_kind}を保存しました。承認待ちです。承認者ほか関係者にメールで連絡しました。")
+        # 更新と同じトランザクションで送信キューへ（送信はワーカーが行う）
+        queued = enqueue_mail(db, to, subject, body)
+        db.commit()
+        if skipped:
+            flash(f"送信中に状態が変更されたため、一部のアイテムを除外しました（ID: {', '.join(skipped)}）。")
+        if queued:
+            flash(f"{subject_kind}を保存しました。承認待ちです。承認者ほか関係者にメールで連絡します。")
         else:
-            flash(f"{subject_kind}を保存しました。承認待ちです。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+            flash(f"{subject_kind}を保存しました。承認待ちです。メールの宛先がないため、関係者への連絡をお願いします。")
 
         return redirect(url_for('index_bp.index'))
 
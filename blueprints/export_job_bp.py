@@ -0,0 +1,98 @@
+# blueprints/export_job_bp.py
+import json
+import time
+from datetime import datetime
+
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file, abort, g
+
+from services import get_db, login_required
+from export_jobs import (
+    submit_export_job, get_export_job, list_export_jobs, EXPORT_KINDS,
+)
+
+export_job_bp = Blueprint("export_job_bp", __name__)
+
+
+def _own_job_or_404(db, job_id):
+    """本人（admin は全員分）のジョブだけを返す。他人のジョブは存在しない扱い。"""
+    job = get_export_job(db, job_id)
+    if job is None:
+        abort(404)
+    if job["username"] != g.user["username"] and "admin" not in g.user_roles:
+        abort(404)
+    return job
+
+
+def _fmt_ts(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M") if ts else ""
+
+
+def _job_json(job):
+    total = job["total_rows"]
+    percent = None
+    if job["status"] == "done" and job["expires_at"] and job["expires_at"] <= time.time():
+        # ファイルの削除は定期メンテナンス（export_expiry）が行う。画面上は先に期限切れとして扱う
+        job = dict(job, status="expired")
+    if job["status"] == "done":
+        percent = 100
+    elif total:
+        percent = min(99, int(job["progress_rows"] * 100 / total))
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "total_rows": total,
+        "progress_rows": job["progress_rows"],
+        "percent": percent,
+        "error": job["error"],
+        "expires_at": job["expires_at"],
+        "download_url": url_for("export_job_bp.download", job_id=job["id"]) if job["status"] == "done" else None,
+    }
+
+
+@export_job_bp.route("/export_jobs", methods=["GET", "POST"])
+@login_required
+def export_jobs():
+    """
+    GET : 自分のエクスポートジョブ一覧（進捗は status を定期取得して更新）
+    POST: 現在のフィルタ（*_filter）でジョブを投入して一覧へ
+    """
+    db = get_db()
+    if request.method == "POST":
+        kind = request.form.get("kind", "xlsx")
+        if kind not in EXPORT_KINDS:
+            flash("出力形式が不正です")
+            return redirect(url_for("index_bp.index"))
+        job_id = submit_export_job(db, g.user["username"], kind, request.form)
+        flash("バックグラウンドで出力を開始しました。完了するとここからダウンロードできます。")
+        return redirect(url_for("export_job_bp.export_jobs", new=job_id))
+
+    jobs = []
+    for j in list_export_jobs(db, g.user["username"]):
+        row = _job_json(j)
+        row["created_at"] = _fmt_ts(j["created_at"])
+        row["expires_at"] = _fmt_ts(j["expires_at"])
+        row["filters"] = json.loads(j["params"])
+        jobs.append(row)
+    return render_template("export_jobs.html", jobs=jobs, new_job_id=request.args.get("new"))
+
+
+@export_job_bp.route("/export_jobs/<job_id>/status")
+@login_required
+def status(job_id):
+    db = get_db()
+    return jsonify(_job_json(_own_job_or_404(db, job_id)))
+
+
+@export_job_bp.route("/export_jobs/<job_id>/download")
+@login_required
+def download(job_id):
+    db = get_db()
+    job = _own_job_or_404(db, job_id)
+    if job["status"] == "expired" or (job["expires_at"] and job["expires_at"] <= time.time()):
+        flash("出力ファイルの保存期限が切れています。もう一度出力してください。")
+        return redirect(url_for("export_job_bp.export_jobs"))
+    if job["status"] != "done":
+        flash("出力はまだ完了していません。")
+        return redirect(url_for("export_job_bp.export_jobs"))
+    return send_file(job["file_path"], as_attachment=True, download_name=job["file_name"])
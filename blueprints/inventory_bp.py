@@ -1,13 +1,16 @@
 # blueprints/inventory_bp.py
 from datetime import datetime
-import calendar
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g
 
 from services import (
     get_db,
     login_required, roles_required,
     INDEX_FIELDS,
+    fetch_keyset_page,
+    get_filter_choices,
 )
+from user_directory import get_user_display_dept
+from item_filter import compile_item_filters
 
 inventory_bp = Blueprint("inventory_bp", __name__)
 
@@ -30,125 +33,46 @@ def inventory_list():
         page = int(request.args.get('page', 1))
         offset = (page - 1) * per_page
 
-    # ===== 表示名マップ & realname -> username 逆引き =====
-    user_rows = db.execute("""
-        SELECT username,
-               COALESCE(NULLIF(realname, ''), username) AS display_name
-        FROM users
-    """).fetchall()
-    user_display = {r["username"]: r["display_name"] for r in user_rows}
-    display_to_username = {}
-    for u, d in user_display.items():
-        display_to_username.setdefault(d, u)
-
-    # ===== フィルタ構築 =====
-    filters = {}
-    where = []
-    params = []
-
-    id_filter = request.args.get("id_filter", "").strip()
-    filters["id"] = id_filter
-    if id_filter:
-        where.append("CAST(i.id AS TEXT) LIKE ?")
-        params.append(f"%{id_filter}%")
-
-    for f in INDEX_FIELDS:
-        key = f["key"]
-        v = request.args.get(f"{key}_filter", "").strip()
-        if key == "sample_manager" and v:
-            normalized = display_to_username.get(v, v)  # realname -> username
-            filters[key] = v  # 表示はrealnameのまま
-            where.append(f"i.{key} LIKE ?")
-            params.append(f"%{normalized}%")
-        else:
-            filters[key] = v
-            if v:
-                where.append(f"i.{key} LIKE ?")
-                params.append(f"%{v}%")
-
-    # proper は自分の分のみ
-    if 'proper' in user_roles and not ('admin' in user_roles or 'manager' in user_roles):
-        where.append("i.sample_manager = ?")
-        params.append(username)
-
-    # --- 最終棚卸し日（年月）フィルタ：未実施も“以前”として含める ---
-    last_checked_ym = request.args.get("last_checked_ym_filter", "").strip()
-    filters["last_checked_ym"] = last_checked_ym
-
-    ic_date_clause = ""
-    month_end_str = None
-    if last_checked_ym:
-        # 期待フォーマット: YYYY-MM
-        try:
-            dt = datetime.strptime(last_checked_ym, "%Y-%m")
-            last_day = calendar.monthrange(dt.year, dt.month)[1]
-            month_end_str = f"{dt.year:04d}-{dt.month:02d}-{last_day:02d} 23:59:59"
-            # ★ 未実施（NULL）も含める： (ic.checked_at IS NULL OR ic.checked_at <= ?)
-            ic_date_clause = " AND (ic.checked_at IS NULL OR ic.checked_at <= ?)"
-        except ValueError:
-            # フォーマット不正なら無視（フィルタ未適用）
-            pass
-
-    where_clause = "WHERE " + " AND ".join(where) if where else ""
-
-    # ===== データ取得（最新棚卸し情報をJOIN）=====
-    base_sql = f"""
-        SELECT i.*,
-               ic.checked_at AS last_checked_at,
-               ic.checker    AS last_checker
-        FROM item i
-        LEFT JOIN (
-            SELECT a.item_id, a.checked_at, a.checker
-            FROM inventory_check a
-            INNER JOIN (
-                SELECT item_id, MAX(checked_at) AS max_checked
-                FROM inventory_check GROUP BY item_id
-            ) b
-            ON a.item_id = b.item_id AND a.checked_at = b.max_checked
-        ) ic ON i.id = ic.item_id
-        {where_clause}
-    """
-    # JOIN 後の ic 条件を足す（NULL も対象にするため LEFT JOIN を維持）
-    if ic_date_clause:
-        if where_clause:
-            base_sql += ic_date_clause
-        else:
-            base_sql += " WHERE 1=1" + ic_date_clause
-    base_sql += " ORDER BY i.id DESC"
-
-    final_params = list(params)
-    if ic_date_clause and month_end_str:
-        final_params.append(month_end_str)
-
-    rows_all = db.execute(base_sql, final_params).fetchall()
-
-    total = len(rows_all)
-    if per_page is not None:
-        items = rows_all[offset:offset + per_page]
+    # カーソルモード: ?after_id= / ?before_id= で主キーをシーク
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    cursor_mode = per_page is not None and (after_id is not None or before_id is not None)
+
+    # ===== フィルタ構築（index / export_excel と共通。最新棚卸しの JOIN と proper の絞り込み込み）=====
+    cf = compile_item_filters(
+        db, request.args, with_last_check=True, scope_user=username, scope_roles=user_roles
+    )
+    filters = cf["filters"]
+    user_display = cf["user_display"]
+    base_sql = cf["sql"]
+    final_params = list(cf["params"])
+
+    next_after_id = prev_before_id = None
+    if cursor_mode:
+        # カーソルモード：COUNT は取らず、表示ページ分だけシーク
+        items, next_after_id, prev_before_id = fetch_keyset_page(
+            db, base_sql, final_params, per_page, after_id=after_id, before_id=before_id
+        )
+        total = None
     else:
-        items = rows_all
+        # 合計件数（COUNT）& 表示ページ分だけ取得（LIMIT/OFFSET）
+        total = db.execute(f"SELECT COUNT(*) FROM ({base_sql})", final_params).fetchone()[0]
+
+        base_sql += " ORDER BY item.id DESC"
+        if per_page is not None:
+            base_sql += " LIMIT ? OFFSET ?"
+            final_params += [per_page, offset]
+        items = db.execute(base_sql, final_params).fetchall()
 
     # ===== フィルタ候補辞書 =====
-    filter_choices_dict = {}
-    for f in INDEX_FIELDS:
-        col = f["key"]
-        r = db.execute(f"""
-            SELECT DISTINCT {col}
-            FROM item
-            WHERE {col} IS NOT NULL AND {col} != ''
-        """).fetchall()
-        if col == "sample_manager":
-            usernames = {str(row[col]) for row in r if row[col] not in (None, '')}
-            display_names = {user_display.get(u, u) for u in usernames}
-            filter_choices_dict[col] = sorted(display_names)
-        else:
-            filter_choices_dict[col] = sorted({str(row[col]) for row in r if row[col] not in (None, '')})
-
-    id_rows = db.execute("SELECT id FROM item ORDER BY id DESC").fetchall()
-    filter_choices_dict["id"] = [str(r["id"]) for r in id_rows]
+    # item / users の版数が変わらない限りキャッシュから返る（sample_manager は表示名）
+    filter_choices_dict = get_filter_choices(db)
 
     # ===== ページ数 =====
-    page_count = 1 if per_page is None else max(1, (total + per_page - 1) // per_page)
+    page_count = 1 if per_page is None or total is None else max(1, (total + per_page - 1) // per_page)
+
+    # ページリンク用のクエリ（フィルタは *_filter 名で引き継ぐ）
+    filter_args = cf["filter_args"]
 
     return render_template(
         'inventory_list.html',
@@ -157,6 +81,10 @@ def inventory_list():
         user_display=user_display,
         # フィルタ/ページング用
         filters=filters,
+        filter_args=filter_args,
+        cursor_mode=cursor_mode,
+        next_after_id=next_after_id,
+        prev_before_id=prev_before_id,
         per_page=per_page_raw,
         page=page,
         page_count=page_count,
@@ -193,16 +121,7 @@ def inventory_history(item_id):
         "SELECT * FROM item WHERE id=?", (item_id,)
     ).fetchone()
 
-    user_rows = db.execute("""
-        SELECT
-            username,
-            TRIM(
-                COALESCE(NULLIF(department,''),'') || ' ' ||
-                COALESCE(NULLIF(realname,''), username)
-            ) AS display_name
-        FROM users
-    """).fetchall()
-    user_display = {r["username"]: r["display_name"] for r in user_rows}
+    user_display = get_user_display_dept(db)
 
     return render_template(
         'inventory_history.html',
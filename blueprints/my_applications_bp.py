@@ -3,8 +3,12 @@ from flask import Blueprint, render_template, request, g, flash, redirect, url_f
 from datetime import datetime
 import json
 
-from services import get_db, login_required
-from send_mail import send_mail
+from services import (
+    get_db, login_required,
+    APPLICATION_KINDS, APPLICATION_SORTS, application_list_filters
+)
+from user_directory import get_user_display_dept
+from mail_outbox import enqueue_mail
 from blueprints.approval_bp import build_application_mail
 
 my_applications_bp = Blueprint("my_applications_bp", __name__)
@@ -16,40 +20,38 @@ def my_applications():
     status = request.args.get('status', 'all')
     db = get_db()
     params = [g.user['username']]
-    where = "applicant=?"
+    where = ["applicant=?"]
 
     if status == "approved":
-        where += " AND status='承認'"
+        where.append("status='承認'")
     elif status == "remanded":
-        where += " AND status='差し戻し'"
+        where.append("status='差し戻し'")
     elif status == "canceled":
-        where += " AND status='取消'"
+        where.append("status='取消'")
     elif status == "pending":
-        where += " AND status NOT IN ('承認','差し戻し','取消')"
+        where.append("status NOT IN ('承認','差し戻し','取消')")
+    # 種別・期間・破棄/譲渡の絞り込みと並べ替えは生成列で SQL 側（new_values は解析しない）
+    extra_where, extra_params, order_by, filters = application_list_filters(request.args)
+    where += extra_where
+    params += extra_params
 
     apps = db.execute(f"""
         SELECT * FROM item_application
-        WHERE {where}
-        ORDER BY application_datetime DESC
+        WHERE {" AND ".join(where)}
+        ORDER BY {order_by}
     """, params).fetchall()
 
     # department realname 形式（realname が空なら username）
-    user_rows = db.execute("""
-        SELECT
-            username,
-            TRIM(
-                COALESCE(NULLIF(department,''),'') || ' ' ||
-                COALESCE(NULLIF(realname,''), username)
-            ) AS display_name
-        FROM users
-    """).fetchall()
-    user_display = {r["username"]: r["display_name"] for r in user_rows}
+    user_display = get_user_display_dept(db)
 
     return render_template(
         'my_applications.html',
         applications=apps,
         status=status,
         user_display=user_display,
+        filters=filters,
+        kinds=APPLICATION_KINDS,
+        sorts=APPLICATION_SORTS,
     )
 
 
@@ -137,15 +139,15 @@ def cancel_application(app_id: int):
         cancel_comment
     ))
 
-    # メール送信
+    # メールは取消と同じトランザクションで送信キューへ（commit 前に送ってしまわない）
     to, subject, body = build_application_mail(db, app_row, action="cancel", approver_comment=cancel_comment)
-    sent = send_mail(to=to, subject=subject, body=body)
+    queued = enqueue_mail(db, to, subject, body)
 
     db.commit()
 
-    if sent:
-        flash("申請を取り消しました。関係者にメールで連絡しました。")
+    if queued:
+        flash("申請を取り消しました。関係者にメールで連絡します。")
     else:
-        flash("申請を取り消しました。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+        flash("申請を取り消しました。メールの宛先がないため、関係者への連絡をお願いします。")
 
     return redirect(url_for('my_applications_bp.my_applications'))
@@ -1,5 +1,4 @@
 # blueprints/return_request_bp.py
-import json
 import re
 from datetime import datetime
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g
@@ -8,11 +7,11 @@ from services import (
     get_db,
     login_required, roles_required,
     INDEX_FIELDS,
-    get_managers_by_department,
-    get_user_profiles,
+    attach_sample_counts, transition_items, insert_applications, application_snapshot,
 )
+from user_directory import get_managers_by_department, get_user_profiles, get_user_display
 
-from send_mail import send_mail
+from mail_outbox import enqueue_mail
 
 return_request_bp = Blueprint("return_request_bp", __name__)
 
@@ -31,12 +30,7 @@ def return_request():
     db = get_db()
 
     # realname 優先の表示名マップ（indexと同じ）
-    user_rows = db.execute("""
-        SELECT username,
-            COALESCE(NULLIF(realname, ''), username) AS display_name
-        FROM users
-    """).fetchall()
-    user_display = {r["username"]: r["display_name"] for r in user_rows}
+    user_display = get_user_display(db)
 
     # 申請フォーム表示（POST:選択済みID受取→フォーム表示）
     if request.method == 'POST':
@@ -65,23 +59,8 @@ def return_request():
             allowed_ids
         ).fetchall()
 
-        # 元のロジック：サンプル数（破棄・譲渡を除いた枝番数）を計算
-        item_list = []
-        for item in items:
-            item = dict(item)
-            item_id = item['id']
-            child_total = db.execute(
-                "SELECT COUNT(*) FROM child_item WHERE item_id=?", (item_id,)
-            ).fetchone()[0]
-            if child_total == 0:
-                item['sample_count'] = item.get('num_of_samples', 0)
-            else:
-                cnt = db.execute(
-                    "SELECT COUNT(*) FROM child_item WHERE item_id=? AND status NOT IN (?, ?)",
-                    (item_id, "破棄", "譲渡")
-                ).fetchone()[0]
-                item['sample_count'] = cnt
-            item_list.append(item)
+        # サンプル数（破棄・譲渡を除いた枝番数）を一括算出
+        item_list = attach_sample_counts(db, [dict(item) for item in items])
 
         department = g.user['department']
         all_managers = get_managers_by_department(None, db)
@@ -133,22 +112,7 @@ def return_request():
                 f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_ids))})",
                 allowed_ids
             ).fetchall()
-            item_list = []
-            for item in items:
-                item = dict(item)
-                item_id = item['id']
-                child_total = db.execute(
-                    "SELECT COUNT(*) FROM child_item WHERE item_id=?", (item_id,)
-                ).fetchone()[0]
-                if child_total == 0:
-                    item['sample_count'] = item.get('num_of_samples', 0)
-                else:
-                    cnt = db.execute(
-                        "SELECT COUNT(*) FROM child_item WHERE item_id=? AND status NOT IN (?, ?)",
-                        (item_id, "破棄", "譲渡")
-                    ).fetchone()[0]
-                    item['sample_count'] = cnt
-                item_list.append(item)
+            item_list = attach_sample_counts(db, [dict(item) for item in items])
 
             department = g.user['department']
             all_managers = get_managers_by_department(None, db)
@@ -180,10 +144,6 @@ def return_request():
             flash("保管場所は『S-123 上から3段目』の形式で入力してください（S-の後は3桁数字、段は1以上の整数）。")
 
             # 直前の許可判定を流用して再描画（持ち出し中のみ）
-            rows_status = db.execute(
-                f"SELECT id, status FROM item WHERE id IN ({','.join(['?']*len(item_ids))})",
-                item_ids
-            ).fetchall()
             allowed_ids = [str(r['id']) for r in rows_status if r['status'] in RETURN_ALLOWED_ITEM_STATUSES]
             if not allowed_ids:
                 return redirect(url_for('index_bp.index'))
@@ -192,22 +152,7 @@ def return_request():
                 f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(allowed_ids))})",
                 allowed_ids
             ).fetchall()
-            item_list = []
-            for item in items:
-                item = dict(item)
-                item_id = item['id']
-                child_total = db.execute(
-                    "SELECT COUNT(*) FROM child_item WHERE item_id=?", (item_id,)
-                ).fetchone()[0]
-                if child_total == 0:
-                    item['sample_count'] = item.get('num_of_samples', 0)
-                else:
-                    cnt = db.execute(
-                        "SELECT COUNT(*) FROM child_item WHERE item_id=? AND status NOT IN (?, ?)",
-                        (item_id, "破棄", "譲渡")
-                    ).fetchone()[0]
-                    item['sample_count'] = cnt
-                item_list.append(item)
+            item_list = attach_sample_counts(db, [dict(item) for item in items])
 
             department = g.user['department']
             all_managers = get_managers_by_department(None, db)
@@ -231,38 +176,31 @@ def return_request():
             )
 
         now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for id in item_ids:
-            item = db.execute("SELECT * FROM item WHERE id=?", (id,)).fetchone()
-
-            # ▼ 念押し：更新直前にも状態チェック（競合で状態が変わっていたらスキップ）
-            if item['status'] not in RETURN_ALLOWED_ITEM_STATUSES:
-                continue
-
-            original_status = item['status']
+        # 許可状態のものだけ 1 文で返却申請中へ（BEGIN IMMEDIATE の中。変更前の行が返る）
+        moved = transition_items(db, item_ids, RETURN_ALLOWED_ITEM_STATUSES, "返却申請中")
+        if not moved:
+            db.rollback()
+            flash(f"選択されたアイテムは申請対象の状態ではなくなりました（許可: {', '.join(RETURN_ALLOWED_ITEM_STATUSES)}）。")
+            return redirect(url_for('index_bp.index'))
+        moved_ids = {str(k) for k in moved}
+        skipped = [str(i) for i in item_ids if str(i) not in moved_ids]
+        item_ids = [i for i in item_ids if str(i) in moved_ids]  # 以降（申請・メール）は実際に動いたものだけ
 
-            db.execute("UPDATE item SET status=? WHERE id=?", ("返却申請中", id))
-            item = db.execute("SELECT * FROM item WHERE id=?", (id,)).fetchone()
-            new_values = dict(item)
+        # new_values（識別用スナップショット＋申請で変わる列＋申請内容）はメモリ上で組み立て、申請はまとめて登録
+        payloads = []
+        for id in item_ids:
+            before = moved[int(id)]
+            new_values = application_snapshot(before)
             new_values['return_date'] = return_date
             new_values['storage'] = storage
             new_values['status'] = "返却申請中"
-
-            db.execute('''
-                INSERT INTO item_application
-                (item_id, new_values, applicant, applicant_comment, approver, status, application_datetime, original_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                id, json.dumps(new_values, ensure_ascii=False), applicant, applicant_comment, approver, "申請中", now_str, original_status
-            ))
-        db.commit()
+            payloads.append((id, new_values, before['status']))
+        insert_applications(db, payloads, applicant, approver, applicant_comment, now_str)
 
         # ==== メール送信部（承認者・申請者・管理者）====
 
-        # 対象 item の管理者（username）を収集
-        items_rows = db.execute(
-            f"SELECT id, sample_manager FROM item WHERE id IN ({','.join(['?']*len(item_ids))})",
-            item_ids
-        ).fetchall()
+        # 対象 item の管理者（username）を収集（管理者は申請で変わらないので変更前の行で足りる）
+        items_rows = [moved[int(id)] for id in item_ids]
         manager_usernames = {row['sample_manager'] for row in items_rows if row and row['sample_manager']}
 
         # 申請者・承認者・管理者のプロフィールを一括取得
@@ -300,11 +238,15 @@ def return_request():
             applicant_comment=applicant_comment,
         )
 
-        result = send_mail(to=to, subject=subject, body=body)
-        if result:
-            flash("返却申請を保存しました。承認待ちです。承認者ほか関係者にメールで連絡しました。")
+        # 更新と同じトランザクションで送信キューへ（送信はワーカーが行う）
+        queued = enqueue_mail(db, to, subject, body)
+        db.commit()
+        if skipped:
+            flash(f"送信中に状態が変更されたため、一部のアイテムを除外しました（ID: {', '.join(skipped)}）。")
+        if queued:
+            flash("返却申請を保存しました。承認待ちです。承認者ほか関係者にメールで連絡します。")
         else:
-            flash("返却申請を保存しました。承認待ちです。メール送信に失敗しましたので、関係者への連絡をお願いします。")
+            flash("返却申請を保存しました。承認待ちです。メールの宛先がないため、関係者への連絡をお願いします。")
         # ==== ここまで ====
 
         return redirect(url_for('index_bp.index'))
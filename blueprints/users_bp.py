@@ -1,7 +1,7 @@
 # blueprints/users_bp.py
 from flask import Blueprint, render_template, request, redirect, url_for, flash, g
 from werkzeug.security import generate_password_hash
-from services import get_db, login_required, roles_required
+from services import get_db, login_required, roles_required, forget_session_user
 
 users_bp = Blueprint("users_bp", __name__)
 
@@ -34,6 +34,7 @@ def register():
             for role_id in selected_roles:
                 db.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", (user_id, role_id))
             db.commit()
+            forget_session_user(user_id)
             flash('ユーザー登録が完了しました')
             return redirect(url_for('users_bp.users_list'))
 
@@ -114,6 +115,7 @@ def edit_user(user_id):
                     db.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", (user_id, role_id))
 
                 db.commit()
+                forget_session_user(user_id)
                 flash('ユーザー情報を更新しました')
                 return redirect(url_for('users_bp.edit_user', user_id=user_id))
 
@@ -122,6 +124,7 @@ def edit_user(user_id):
             for role_id in selected_roles:
                 db.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", (user_id, role_id))
             db.commit()
+            forget_session_user(user_id)
             flash('ロールを更新しました')
             return redirect(url_for('users_bp.edit_user', user_id=user_id))
 
@@ -1,6 +1,9 @@
 # cli.py
 import click
-from db_schema import init_db as init_schema, seed_minimal, get_version, upgrade
+from db_schema import (
+    init_db as init_schema, seed_minimal, get_version, upgrade,
+    find_child_count_drift, repair_child_counts, rebuild_item_fts,
+)
 from services import get_db
 
 def init_app(app):
@@ -67,7 +70,13 @@ def init_app(app):
                 DROP TABLE IF EXISTS item_application;
                 DROP TABLE IF EXISTS application_history;
                 DROP TABLE IF EXISTS inventory_check;
+                DROP TABLE IF EXISTS item_lock;
+                DROP TABLE IF EXISTS item_fts;
                 DROP TABLE IF EXISTS item;
+                DROP TABLE IF EXISTS data_version;
+                DROP TABLE IF EXISTS export_job;
+                DROP TABLE IF EXISTS maintenance_run;
+                DROP TABLE IF EXISTS mail_outbox;
                 DROP TABLE IF EXISTS db_meta;
             """)
             db.commit()
@@ -87,4 +96,73 @@ def init_app(app):
             for n in names:
                 db.execute(f"DROP TABLE IF EXISTS {n}")
             db.commit()
-        click.echo("Dropped: " + (", ".join(names) if names else "(none)"))
\ No newline at end of file
+        click.echo("Dropped: " + (", ".join(names) if names else "(none)"))
+
+    @app.cli.command("child-counts-check")
+    @click.option("--repair", is_flag=True, help="ずれていた item の child_total/child_alive を数え直して修正")
+    def child_counts_check_cmd(repair):
+        """item.child_total / child_alive と child_item の実数のずれを検出（--repair で修正）"""
+        with get_db() as db:
+            drift = find_child_count_drift(db)
+            if not drift:
+                click.echo("OK: child counts are consistent.")
+                return
+            for d in drift:
+                click.echo(
+                    f"NG: item={d['id']} total={d['child_total']}(actual {d['actual_total']}) "
+                    f"alive={d['child_alive']}(actual {d['actual_alive']})"
+                )
+            if repair:
+                n = repair_child_counts(db, [d["id"] for d in drift])
+                db.commit()
+                click.echo(f"Repaired: {n} item(s).")
+
+    @app.cli.command("fts-rebuild")
+    def fts_rebuild_cmd():
+        """部分一致検索用 item_fts（FTS5 trigram）を fields.json の text 列で作り直して再索引"""
+        with get_db() as db:
+            n = rebuild_item_fts(db)
+            db.commit()
+        if n < 0:
+            click.echo("NG: this SQLite build has no FTS5 trigram support (filters fall back to LIKE).")
+        else:
+            click.echo(f"Rebuilt item_fts: {n} item(s) indexed.")
+
+    @app.cli.command("maintenance-worker")
+    @click.option("--once", is_flag=True, help="期限の来たジョブを1回だけ実行して終了")
+    @click.option("--job", "jobs", multiple=True, help="実行するジョブ名（複数指定可。省略時は全ジョブ）")
+    @click.option("--force", is_flag=True, help="実行間隔を無視して今すぐ実行（--once と併用）")
+    def maintenance_worker_cmd(once, jobs, force):
+        """定期メンテナンス（ロック期限切れ・エクスポート期限切れ・孤児掃除・ANALYZE・WAL チェックポイント）を実行"""
+        from maintenance import JOBS, run_due_jobs, run_forever
+        unknown = [j for j in jobs if j not in JOBS]
+        if unknown:
+            raise click.BadParameter(f"unknown job: {', '.join(unknown)} (choices: {', '.join(JOBS)})")
+        if once:
+            for r in run_due_jobs(only=jobs or None, force=force):
+                click.echo(f"{r['job']}: {r['status']} rows={r['rows_affected']} {r['duration_ms']}ms"
+                           + (f" ({r['detail']})" if r["detail"] else "")
+                           + (f" error={r['error']}" if r["error"] else ""))
+            return
+        names = jobs or list(JOBS)
+        click.echo("maintenance worker started: " + ", ".join(f"{n}/{JOBS[n][1]}s" for n in names))
+        run_forever(only=jobs or None)
+
+    @app.cli.command("mail-worker")
+    @click.option("--once", is_flag=True, help="送信待ちのメールを送り切ったら終了")
+    @click.option("--retry-failed", is_flag=True, help="failed のメールを送信待ちに戻してから実行")
+    def mail_worker_cmd(once, retry_failed):
+        """mail_outbox に積まれたメールを送信（失敗時は指数バックオフで再送）"""
+        from mail_outbox import drain, run_forever, retry_failed as _retry_failed, outbox_status
+        db = get_db()
+        if retry_failed:
+            n = _retry_failed(db)
+            db.commit()
+            click.echo(f"Requeued: {n} failed mail(s).")
+        if once:
+            counts = drain(db)
+            click.echo(f"sent={counts['sent']} retry={counts['retry']} failed={counts['failed']}")
+            click.echo("outbox: " + ", ".join(f"{k}={v}" for k, v in sorted(outbox_status(db, 0)["counts"].items())))
+            return
+        click.echo("mail worker started.")
+        run_forever()
@@ -0,0 +1,103 @@
+# db_pool.py
+import os
+import sqlite3
+import threading
+
+
+class ConnectionPool:
+    """
+    プロセス内で SQLite 接続を使い回すための小さなプール。
+      - 接続ごとの PRAGMA は open 時に一度だけ適用
+      - 空き接続は max_idle 本まで保持し、溢れた分は close
+      - fork 後（pid が変わった場合）は親プロセスの接続を捨てて作り直す
+    リクエスト内での使い回し（flask.g）は services.get_db() 側で行う。
+    """
+
+    def __init__(self, database: str, max_idle: int = 8, busy_timeout_ms: int = 5000):
+        self.database = database
+        self.max_idle = max_idle
+        self.busy_timeout_ms = busy_timeout_ms
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._stats = {"hits": 0, "reuses": 0, "opens": 0, "closes": 0, "in_use": 0, "high_water": 0}
+
+    # --------- 内部 ---------
+    def _open(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)};")
+        return conn
+
+    def _check_fork(self):
+        """fork 先では親の接続を共有しない（ロック保持中に呼ぶこと）。"""
+        pid = os.getpid()
+        if pid != self._pid:
+            self._idle = []
+            self._pid = pid
+            self._stats["in_use"] = 0
+
+    # --------- 公開 ---------
+    def connect(self):
+        """プール外の単発接続（アプリコンテキスト外用）。close は呼び出し側の責任。"""
+        with self._lock:
+            self._stats["opens"] += 1
+        return self._open()
+
+    def acquire(self):
+        with self._lock:
+            self._check_fork()
+            conn = self._idle.pop() if self._idle else None
+            if conn is not None:
+                self._stats["reuses"] += 1
+            else:
+                self._stats["opens"] += 1
+            self._stats["in_use"] += 1
+            self._stats["high_water"] = max(self._stats["high_water"], self._stats["in_use"])
+        if conn is None:
+            try:
+                conn = self._open()
+            except Exception:
+                with self._lock:
+                    self._stats["in_use"] -= 1
+                raise
+        return conn
+
+    def release(self, conn):
+        """未コミットのトランザクションは破棄してからプールへ戻す。"""
+        keep = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            keep = False
+
+        with self._lock:
+            self._stats["in_use"] = max(0, self._stats["in_use"] - 1)
+            if keep and os.getpid() == self._pid and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._stats["closes"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def note_hit(self):
+        with self._lock:
+            self._stats["hits"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), max_idle=self.max_idle, pid=self._pid)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._stats["closes"] += len(idle)
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
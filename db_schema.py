@@ -1,13 +1,28 @@
 # db_schema.py
 import os
+import sqlite3
+from datetime import datetime, timezone
 from werkzeug.security import generate_password_hash
-from services import get_db, FIELDS, logger
+from services import get_db, FIELDS, FTS_FIELD_KEYS, LOCK_TTL_MIN, logger
 
 # =========================
 # スキーマバージョン
 # v3: 参照整備（CASCADE/SET NULL の是正）と孤児掃除
+# v4: item.child_total / child_alive（子アイテム数の実体化、child_item のトリガーで維持）
+# v5: inventory_check(item_id, checked_at) 複合インデックス（最新棚卸しの引き当て用）
+# v6: data_version（item / users への書き込みでトリガーが加算。プロセス横断のキャッシュ無効化用）
+# v7: item_fts（FTS5 trigram。fields.json の text 列の部分一致検索用、item のトリガーで同期）
+# v8: export_job（バックグラウンドのエクスポートジョブ）
+# v9: item_lock（一括編集ロックを item から分離。expires_at は epoch 秒で索引付き）
+# v10: maintenance_run（定期メンテナンスジョブの実行ログ）
+# v11: item.approval_group（入庫系列の承認時に承認者の部署を記録。fields.json には無い管理列）
+# v12: mail_outbox（業務更新と同じトランザクションで積むメール送信キュー）
+# v13: item_application の生成列（new_values から request_kind / 持ち出し期間 / dispose_type）とインデックス
+# v14: item_application.new_values を差分形式へ（新しい申請から。既存の行は書き換えない）
+# v15: data_version に user_roles を追加、users の版数は email の変更でも加算（ユーザー名簿キャッシュの無効化用）
+# v16: item の版数を子アイテム数（child_total / child_alive）の変更でも加算（sample_count 候補のキャッシュ用）
 # =========================
-SCHEMA_VERSION = 3
+SCHEMA_VERSION = 16
 
 
 # --------- 内部ユーティリティ ---------
@@ -73,6 +88,338 @@ def _recreate_table(db, table: str, create_sql: str, copy_cols: list[str], post_
     db.execute("PRAGMA foreign_keys=ON;")
 
 
+# --------- 子アイテム数（item.child_total / child_alive）---------
+# alive = 破棄・譲渡以外。sample_count の算出に使う
+_CHILD_COUNT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_child_item_count_ins AFTER INSERT ON child_item
+    BEGIN
+        UPDATE item SET child_total = child_total + 1,
+                        child_alive = child_alive + (NEW.status NOT IN ('破棄', '譲渡'))
+        WHERE id = NEW.item_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_child_item_count_del AFTER DELETE ON child_item
+    BEGIN
+        UPDATE item SET child_total = child_total - 1,
+                        child_alive = child_alive - (OLD.status NOT IN ('破棄', '譲渡'))
+        WHERE id = OLD.item_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_child_item_count_upd AFTER UPDATE OF item_id, status ON child_item
+    WHEN OLD.item_id IS NOT NEW.item_id OR OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE item SET child_total = child_total - 1,
+                        child_alive = child_alive - (OLD.status NOT IN ('破棄', '譲渡'))
+        WHERE id = OLD.item_id;
+        UPDATE item SET child_total = child_total + 1,
+                        child_alive = child_alive + (NEW.status NOT IN ('破棄', '譲渡'))
+        WHERE id = NEW.item_id;
+    END
+    """,
+]
+
+_CHILD_COUNT_ACTUAL_SQL = """
+    SELECT item_id,
+           COUNT(*) AS total,
+           SUM(CASE WHEN status NOT IN ('破棄', '譲渡') THEN 1 ELSE 0 END) AS alive
+    FROM child_item
+    GROUP BY item_id
+"""
+
+
+def _ensure_child_counts(db) -> bool:
+    """child_total / child_alive 列とトリガーを用意する（冪等）。列を新設した場合 True。"""
+    added = False
+    if not _column_exists(db, "item", "child_total"):
+        db.execute("ALTER TABLE item ADD COLUMN child_total INTEGER NOT NULL DEFAULT 0")
+        added = True
+    if not _column_exists(db, "item", "child_alive"):
+        db.execute("ALTER TABLE item ADD COLUMN child_alive INTEGER NOT NULL DEFAULT 0")
+        added = True
+    for sql in _CHILD_COUNT_TRIGGERS:
+        db.execute(sql)
+    return added
+
+
+def _ensure_item_approval_group(db):
+    """item.approval_group（入庫系列の承認者の部署。承認処理が書く管理列）を用意する（冪等）。"""
+    if not _column_exists(db, "item", "approval_group"):
+        db.execute("ALTER TABLE item ADD COLUMN approval_group TEXT")
+
+
+def find_child_count_drift(db) -> list[dict]:
+    """item の実体化カウントと child_item の実数がずれている行を返す。"""
+    rows = db.execute(f"""
+        SELECT i.id, i.child_total, i.child_alive,
+               COALESCE(c.total, 0) AS actual_total,
+               COALESCE(c.alive, 0) AS actual_alive
+        FROM item i
+        LEFT JOIN ({_CHILD_COUNT_ACTUAL_SQL}) c ON c.item_id = i.id
+        WHERE i.child_total != COALESCE(c.total, 0)
+           OR i.child_alive != COALESCE(c.alive, 0)
+        ORDER BY i.id
+    """).fetchall()
+    return [dict(r) for r in rows]
+
+
+def repair_child_counts(db, item_ids=None) -> int:
+    """child_item から数え直して上書きする。item_ids 省略時は全件。更新行数を返す。"""
+    where = ""
+    params = []
+    if item_ids:
+        where = f"WHERE id IN ({','.join(['?']*len(item_ids))})"
+        params = list(item_ids)
+    cur = db.execute(f"""
+        UPDATE item SET
+            child_total = (SELECT COUNT(*) FROM child_item c WHERE c.item_id = item.id),
+            child_alive = (SELECT COUNT(*) FROM child_item c
+                           WHERE c.item_id = item.id AND c.status NOT IN ('破棄', '譲渡'))
+        {where}
+    """, params)
+    return cur.rowcount
+
+
+# --------- データ版数（キャッシュ無効化用） ---------
+# フィルタ候補などの集計に影響しない管理列。これらだけの更新では版数を上げない。
+# （child_total / child_alive は sample_count の候補に使うので数える）
+_DATA_VERSION_IGNORED_ITEM_COLS = {"locked_by", "locked_at", "approval_group"}
+
+
+def _ensure_data_version(db):
+    """
+    data_version テーブルと加算トリガーを用意する（冪等）。
+    item の UPDATE トリガーは現在の列構成から作り直す（列追加後に再実行すれば追従する）。
+    """
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS data_version (
+            name    TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    for name in ("item", "users", "user_roles"):
+        db.execute("INSERT OR IGNORE INTO data_version(name, version) VALUES(?, 0)", (name,))
+
+    for table in ("item", "users", "user_roles"):
+        bump = f"UPDATE data_version SET version = version + 1 WHERE name = '{table}';"
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_ins AFTER INSERT ON {table} BEGIN {bump} END")
+        db.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_version_del AFTER DELETE ON {table} BEGIN {bump} END")
+
+    item_cols = [r["name"] for r in db.execute("PRAGMA table_info(item)").fetchall()
+                 if r["name"] not in _DATA_VERSION_IGNORED_ITEM_COLS]
+    db.execute("DROP TRIGGER IF EXISTS trg_item_version_upd")
+    db.execute(f"""
+        CREATE TRIGGER trg_item_version_upd AFTER UPDATE OF {', '.join(item_cols)} ON item
+        BEGIN UPDATE data_version SET version = version + 1 WHERE name = 'item'; END
+    """)
+    # users はユーザー名簿（user_directory.py）のキャッシュにも使うので email の変更も数える
+    db.execute("DROP TRIGGER IF EXISTS trg_users_version_upd")
+    db.execute("""
+        CREATE TRIGGER trg_users_version_upd AFTER UPDATE OF username, realname, department, email ON users
+        BEGIN UPDATE data_version SET version = version + 1 WHERE name = 'users'; END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_user_roles_version_upd AFTER UPDATE ON user_roles
+        BEGIN UPDATE data_version SET version = version + 1 WHERE name = 'user_roles'; END
+    """)
+
+
+# --------- 部分一致検索インデックス（FTS5 trigram） ---------
+def _item_fts_triggers(cols: list[str]) -> list[str]:
+    col_list = ", ".join(cols)
+    new_vals = ", ".join(f"NEW.{c}" for c in cols)
+    old_vals = ", ".join(f"OLD.{c}" for c in cols)
+    # 外部コンテンツ表の削除は「旧値」を渡す必要がある
+    delete = f"INSERT INTO item_fts(item_fts, rowid, {col_list}) VALUES('delete', OLD.id, {old_vals});"
+    insert = f"INSERT INTO item_fts(rowid, {col_list}) VALUES(NEW.id, {new_vals});"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS trg_item_fts_ins AFTER INSERT ON item BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_item_fts_del AFTER DELETE ON item BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_item_fts_upd AFTER UPDATE OF {col_list} ON item BEGIN {delete} {insert} END",
+    ]
+
+
+def _item_fts_columns(db) -> list[str] | None:
+    """既存 item_fts の列（無ければ None）。"""
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='item_fts'"
+    ).fetchone() is not None
+    if not exists:
+        return None
+    return [r["name"] for r in db.execute("PRAGMA table_info(item_fts)").fetchall()]
+
+
+def rebuild_item_fts(db) -> int:
+    """
+    item_fts とトリガーを現在の fields.json の text 列で作り直し、item から再投入する。
+    索引した行数を返す（FTS5 が使えない SQLite では -1）。
+    """
+    cols = [c for c in FTS_FIELD_KEYS if _column_exists(db, "item", c)]
+    for t in ("ins", "del", "upd"):
+        db.execute(f"DROP TRIGGER IF EXISTS trg_item_fts_{t}")
+    db.execute("DROP TABLE IF EXISTS item_fts")
+    if not cols:
+        return 0
+    try:
+        db.execute(f"""
+            CREATE VIRTUAL TABLE item_fts USING fts5(
+                {", ".join(cols)},
+                content='item', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # FTS5 / trigram 非対応ビルド。部分一致は従来どおり LIKE で動く
+        logger.warning("item_fts not created: %s", e)
+        return -1
+    for sql in _item_fts_triggers(cols):
+        db.execute(sql)
+    db.execute("INSERT INTO item_fts(item_fts) VALUES('rebuild')")
+    return db.execute("SELECT COUNT(*) FROM item").fetchone()[0]
+
+
+def _ensure_item_fts(db):
+    """item_fts が無い、または列構成が fields.json と食い違う場合だけ作り直す（冪等）。"""
+    cols = [c for c in FTS_FIELD_KEYS if _column_exists(db, "item", c)]
+    if _item_fts_columns(db) != cols:
+        rebuild_item_fts(db)
+
+
+# --------- バックグラウンドエクスポート ---------
+def _create_export_job(db):
+    """export_job テーブル（冪等）。id は URL に載せるランダムトークン、期限は epoch 秒。"""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS export_job (
+            id            TEXT PRIMARY KEY,
+            username      TEXT NOT NULL,
+            kind          TEXT NOT NULL,            -- xlsx / csv / tsv
+            params        TEXT NOT NULL,            -- フィルタ（*_filter）の JSON
+            status        TEXT NOT NULL,            -- queued / running / done / failed / expired
+            total_rows    INTEGER,
+            progress_rows INTEGER NOT NULL DEFAULT 0,
+            file_path     TEXT,
+            file_name     TEXT,
+            error         TEXT,
+            created_at    REAL NOT NULL,
+            started_at    REAL,
+            finished_at   REAL,
+            expires_at    REAL
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_export_job_user    ON export_job(username, created_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_export_job_expires ON export_job(status, expires_at)")
+
+
+# --------- 一括編集ロック ---------
+def _create_item_lock(db):
+    """item_lock テーブル（冪等）。1 アイテム 1 ロック、期限は epoch 秒。"""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS item_lock (
+            item_id    INTEGER PRIMARY KEY,
+            locked_by  TEXT NOT NULL,
+            locked_at  REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_lock_expires ON item_lock(expires_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_lock_user    ON item_lock(locked_by)")
+
+
+def _create_maintenance_run(db):
+    """maintenance_run テーブル（冪等）。1 行 = メンテナンスジョブ 1 回の実行。時刻は epoch 秒。"""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_run (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            job           TEXT NOT NULL,
+            status        TEXT NOT NULL,            -- running / done / failed
+            worker        TEXT,                     -- host:pid
+            started_at    REAL NOT NULL,
+            finished_at   REAL,
+            rows_affected INTEGER,
+            detail        TEXT,
+            error         TEXT
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_run_job ON maintenance_run(job, started_at)")
+
+
+def _create_mail_outbox(db):
+    """mail_outbox テーブル（冪等）。送信はワーカー（mail_outbox.py）が行う。時刻は epoch 秒。"""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS mail_outbox (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_addrs        TEXT NOT NULL,            -- カンマ区切り
+            subject         TEXT NOT NULL,
+            body            TEXT NOT NULL,
+            status          TEXT NOT NULL,            -- pending / sending / sent / failed
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            last_error      TEXT,
+            created_at      REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,            -- sending 中は再取得までの期限
+            sent_at         REAL
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_mail_outbox_due ON mail_outbox(status, next_attempt_at)")
+
+
+# 申請の new_values（JSON）から取り出す生成列。VIRTUAL なので既存行もそのまま引ける（壊れた JSON は NULL）
+_APPLICATION_COLUMNS = {
+    "request_kind":        "$.status",               # 申請種別（入庫申請中 / 持ち出し申請中 など）
+    "checkout_start_date": "$.checkout_start_date",
+    "checkout_end_date":   "$.checkout_end_date",
+    "dispose_type":        "$.dispose_type",         # 破棄 / 譲渡
+}
+
+
+def _ensure_application_columns(db):
+    """item_application の生成列とインデックスを用意する（冪等）。"""
+    existing = {r["name"] for r in db.execute("PRAGMA table_xinfo(item_application)")}
+    for col, path in _APPLICATION_COLUMNS.items():
+        if col not in existing:
+            db.execute(f"""
+                ALTER TABLE item_application ADD COLUMN {col} TEXT
+                GENERATED ALWAYS AS (CASE WHEN json_valid(new_values) THEN json_extract(new_values, '{path}') END) VIRTUAL
+            """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_app_approver  ON item_application(approver, status, application_datetime)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_app_applicant ON item_application(applicant, status, application_datetime)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_app_kind      ON item_application(request_kind, dispose_type)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_item_app_period    ON item_application(checkout_start_date, checkout_end_date)")
+
+
+def _migrate_item_locks(db) -> int:
+    """
+    旧来の item.locked_by / locked_at（ISO 文字列）を item_lock へ移し、item から列を外す（冪等）。
+    時刻が読めない行は旧実装と同じく期限切れ扱いで移さない。移した件数を返す。
+    """
+    if not _column_exists(db, "item", "locked_by"):
+        return 0
+    at_col = "locked_at" if _column_exists(db, "item", "locked_at") else "NULL AS locked_at"
+    rows = db.execute(
+        f"SELECT id, locked_by, {at_col} FROM item WHERE locked_by IS NOT NULL AND locked_by != ''"
+    ).fetchall()
+    moved = []
+    for r in rows:
+        try:
+            t = datetime.fromisoformat(r["locked_at"])
+        except (TypeError, ValueError):
+            continue
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        ts = t.timestamp()
+        moved.append((r["id"], r["locked_by"], ts, ts + LOCK_TTL_MIN * 60))
+    db.executemany(
+        "INSERT OR REPLACE INTO item_lock (item_id, locked_by, locked_at, expires_at) VALUES (?, ?, ?, ?)",
+        moved
+    )
+    for col in ("locked_by", "locked_at"):
+        if _column_exists(db, "item", col):
+            db.execute(f"ALTER TABLE item DROP COLUMN {col}")
+    logger.info("Migrated %d item lock(s) to item_lock", len(moved))
+    return len(moved)
+
+
 # --------- 初期作成 ---------
 def init_db():
     """全テーブル作成（IF NOT EXISTS）。インデックスもこちらで。"""
@@ -87,11 +434,13 @@ def init_db():
             )
         """)
 
-        # item（フィールドは fields.json に準拠）
+        # item（フィールドは fields.json に準拠 + 子アイテム数の実体化列）
         db.execute(f'''
             CREATE TABLE IF NOT EXISTS item (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                {",".join([f"{f['key']} TEXT" for f in FIELDS])}
+                {",".join([f"{f['key']} TEXT" for f in FIELDS])},
+                child_total INTEGER NOT NULL DEFAULT 0,
+                child_alive INTEGER NOT NULL DEFAULT 0
             )
         ''')
 
@@ -195,9 +544,39 @@ def init_db():
         db.execute("CREATE INDEX IF NOT EXISTS idx_child_item_item   ON child_item(item_id)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_checkout_item     ON checkout_history(item_id)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_inventory_item    ON inventory_check(item_id)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_inventory_item_checked ON inventory_check(item_id, checked_at)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_item_app_item     ON item_application(item_id)")
         db.execute("CREATE INDEX IF NOT EXISTS idx_app_hist_item     ON application_history(item_id)")
 
+        # 子アイテム数の実体化列とトリガー（既存DBに init-db した場合は列を補ってバックフィル）
+        if _ensure_child_counts(db):
+            repair_child_counts(db)
+
+        # 入庫系列の承認者の部署（承認処理が書く）
+        _ensure_item_approval_group(db)
+
+        # データ版数とトリガー（フィルタ候補キャッシュの無効化用）
+        _ensure_data_version(db)
+
+        # 部分一致検索用の FTS5 trigram インデックス
+        _ensure_item_fts(db)
+
+        # バックグラウンドエクスポートのジョブ
+        _create_export_job(db)
+
+        # 一括編集ロック（旧 item.locked_by / locked_at があれば移行）
+        _create_item_lock(db)
+        _migrate_item_locks(db)
+
+        # 定期メンテナンスの実行ログ
+        _create_maintenance_run(db)
+
+        # メール送信キュー
+        _create_mail_outbox(db)
+
+        # 申請の生成列（種別・期間・破棄/譲渡の絞り込みと並べ替えを SQL で）
+        _ensure_application_columns(db)
+
         # バージョン書き込み
         db.execute("INSERT OR REPLACE INTO db_meta(key, value) VALUES('schema_version', ?)",
                    (str(SCHEMA_VERSION),))
@@ -245,14 +624,269 @@ def get_version() -> int:
         except Exception:
             return 0
 
-def upgrade():
+def _upgrade_v3(db):
     """
-    将来のマイグレーション用。
     v2→v3:
       - child_item / checkout_history / inventory_check を ON DELETE CASCADE へ是正（必要時再作成）
       - item_application / application_history を ON DELETE SET NULL へ是正（必要時再作成）
       - 過去DBで発生した孤児の掃除
     """
+    # 1) 明細/実体系は CASCADE
+    if _need_recreate_on_delete(db, "child_item", "item", "CASCADE"):
+        _recreate_table(
+            db,
+            "child_item",
+            '''
+            CREATE TABLE child_item (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id  INTEGER NOT NULL,
+                branch_no INTEGER NOT NULL,
+                owner    TEXT NOT NULL,
+                status   TEXT NOT NULL,
+                comment  TEXT,
+                transfer_dispose_date TEXT,
+                UNIQUE(item_id, branch_no),
+                FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
+            )
+            ''',
+            copy_cols=["id","item_id","branch_no","owner","status","comment","transfer_dispose_date"],
+            post_sql=[
+                "CREATE INDEX IF NOT EXISTS idx_child_item_item ON child_item(item_id)"
+            ]
+        )
+
+    if _need_recreate_on_delete(db, "checkout_history", "item", "CASCADE"):
+        _recreate_table(
+            db,
+            "checkout_history",
+            '''
+            CREATE TABLE checkout_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id INTEGER NOT NULL,
+                checkout_start_date TEXT NOT NULL,
+                checkout_end_date   TEXT NOT NULL,
+                FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
+            )
+            ''',
+            copy_cols=["id","item_id","checkout_start_date","checkout_end_date"],
+            post_sql=[
+                "CREATE INDEX IF NOT EXISTS idx_checkout_item ON checkout_history(item_id)"
+            ]
+        )
+
+    if _need_recreate_on_delete(db, "inventory_check", "item", "CASCADE"):
+        _recreate_table(
+            db,
+            "inventory_check",
+            '''
+            CREATE TABLE inventory_check (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id   INTEGER NOT NULL,
+                checked_at TEXT NOT NULL,
+                checker    TEXT NOT NULL,
+                comment    TEXT,
+                FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
+            )
+            ''',
+            copy_cols=["id","item_id","checked_at","checker","comment"],
+            post_sql=[
+                "CREATE INDEX IF NOT EXISTS idx_inventory_item ON inventory_check(item_id)"
+            ]
+        )
+
+    # 2) ログ系は SET NULL
+    if _need_recreate_on_delete(db, "item_application", "item", "SET NULL"):
+        _recreate_table(
+            db,
+            "item_application",
+            '''
+            CREATE TABLE item_application (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id INTEGER,
+                new_values           TEXT NOT NULL,
+                applicant            TEXT NOT NULL,
+                applicant_comment    TEXT,
+                approver             TEXT,
+                status               TEXT NOT NULL,
+                application_datetime TEXT NOT NULL,
+                approval_datetime    TEXT,
+                approver_comment     TEXT,
+                original_status      TEXT,
+                FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE SET NULL
+            )
+            ''',
+            copy_cols=["id","item_id","new_values","applicant","applicant_comment","approver","status",
+                       "application_datetime","approval_datetime","approver_comment","original_status"],
+            post_sql=[
+                "CREATE INDEX IF NOT EXISTS idx_item_app_item ON item_application(item_id)"
+            ]
+        )
+
+    # application_history: on_delete と NOT NULL の両面チェック
+    need_hist_recreate = False
+    for fk in _fk_list(db, "application_history"):
+        if fk["table"] == "item":
+            if (fk["on_delete"] or "").upper() != "SET NULL":
+                need_hist_recreate = True
+    cols = db.execute("PRAGMA table_info(application_history)").fetchall()
+    for c in cols:
+        if c["name"] == "item_id" and c["notnull"] == 1:
+            need_hist_recreate = True
+
+    if need_hist_recreate:
+        _recreate_table(
+            db,
+            "application_history",
+            '''
+            CREATE TABLE application_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                item_id INTEGER, -- NULL 許可
+                applicant           TEXT NOT NULL,
+                application_content TEXT,
+                applicant_comment   TEXT,
+                application_datetime TEXT NOT NULL,
+                approver            TEXT,
+                approver_comment    TEXT,
+                approval_datetime   TEXT,
+                status              TEXT NOT NULL,
+                FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE SET NULL
+            )
+            ''',
+            copy_cols=["id","item_id","applicant","application_content","applicant_comment",
+                       "application_datetime","approver","approver_comment","approval_datetime","status"],
+            post_sql=[
+                "CREATE INDEX IF NOT EXISTS idx_app_hist_item ON application_history(item_id)"
+            ]
+        )
+
+    # 3) 孤児掃除
+    db.execute("DELETE FROM child_item        WHERE item_id NOT IN (SELECT id FROM item)")
+    db.execute("DELETE FROM checkout_history  WHERE item_id NOT IN (SELECT id FROM item)")
+    db.execute("DELETE FROM inventory_check   WHERE item_id NOT IN (SELECT id FROM item)")
+    db.execute("UPDATE item_application   SET item_id=NULL WHERE item_id NOT IN (SELECT id FROM item)")
+    db.execute("UPDATE application_history SET item_id=NULL WHERE item_id NOT IN (SELECT id FROM item)")
+
+
+def _upgrade_v4(db):
+    """
+    v3→v4:
+      - item に child_total / child_alive を追加し、child_item のトリガーで維持
+      - 既存データから一括バックフィル
+    """
+    _ensure_child_counts(db)
+    repair_child_counts(db)
+
+
+def _upgrade_v5(db):
+    """
+    v4→v5:
+      - 棚卸し一覧の「最新棚卸し」引き当て用に inventory_check(item_id, checked_at) インデックスを追加
+    """
+    db.execute("CREATE INDEX IF NOT EXISTS idx_inventory_item_checked ON inventory_check(item_id, checked_at)")
+
+
+def _upgrade_v6(db):
+    """
+    v5→v6:
+      - data_version テーブルと item / users の加算トリガーを追加
+    """
+    _ensure_data_version(db)
+
+
+def _upgrade_v7(db):
+    """
+    v6→v7:
+      - 部分一致フィルタ用の item_fts（FTS5 trigram）と同期トリガーを追加し、既存データを索引
+    """
+    _ensure_item_fts(db)
+
+
+def _upgrade_v8(db):
+    """
+    v7→v8:
+      - バックグラウンドエクスポート用の export_job テーブルを追加
+    """
+    _create_export_job(db)
+
+
+def _upgrade_v9(db):
+    """
+    v8→v9:
+      - 一括編集ロックを item_lock テーブルへ分離（expires_at に索引）
+      - 旧 item.locked_by / locked_at の内容を移し、item からは列を削除
+    """
+    _create_item_lock(db)
+    _migrate_item_locks(db)
+
+
+def _upgrade_v10(db):
+    """
+    v9→v10:
+      - 定期メンテナンス（maintenance.py）の実行ログ maintenance_run テーブルを追加
+    """
+    _create_maintenance_run(db)
+
+
+def _upgrade_v11(db):
+    """
+    v10→v11:
+      - item に approval_group 列を追加（入庫系列の承認で承認者の部署を記録する。
+        承認処理は従来からこの列を書いていたが、どのスキーマにも無かった）
+    """
+    _ensure_item_approval_group(db)
+
+
+def _upgrade_v12(db):
+    """
+    v11→v12:
+      - メール送信キュー mail_outbox テーブルを追加
+    """
+    _create_mail_outbox(db)
+
+
+def _upgrade_v13(db):
+    """
+    v12→v13:
+      - item_application に new_values から取り出す生成列（request_kind / checkout_start_date /
+        checkout_end_date / dispose_type）と、一覧の絞り込み・並べ替え用インデックスを追加
+    """
+    _ensure_application_columns(db)
+
+
+def _upgrade_v14(db):
+    """
+    v13→v14:
+      - 新しい申請から item_application.new_values を差分形式で登録する（item 行の丸ごとコピーをやめ、
+        申請で変わる列と申請固有のキーだけ）。既存の行は監査ログなので書き換えない（スキーマ変更なし）
+    """
+
+
+def _upgrade_v15(db):
+    """
+    v14→v15:
+      - data_version に user_roles を追加（user_roles への書き込みで加算）
+      - users の更新トリガーを email の変更でも加算するよう作り直す
+    """
+    _ensure_data_version(db)
+
+
+def _upgrade_v16(db):
+    """
+    v15→v16:
+      - item の更新トリガーを子アイテム数（child_total / child_alive）の変更でも加算するよう作り直す
+        （一覧の sample_count 候補をフィルタ候補キャッシュから返すため）
+    """
+    _ensure_data_version(db)
+
+
+def _set_version(db, version: int):
+    db.execute("INSERT OR REPLACE INTO db_meta(key, value) VALUES('schema_version', ?)", (str(version),))
+
+
+def upgrade():
+    """
+    マイグレーション。現在の版数から順に適用する（各段の完了ごとに版数を記録）。
+    """
     with get_db() as db:
         _pragma(db)
 
@@ -265,145 +899,59 @@ def upgrade():
         """)
 
         current = get_version()
-        if current >= 3:
-            return  # 何もしない
-
-        # --- v3 マイグレーション本体 ---
-        # 1) 明細/実体系は CASCADE
-        if _need_recreate_on_delete(db, "child_item", "item", "CASCADE"):
-            _recreate_table(
-                db,
-                "child_item",
-                '''
-                CREATE TABLE child_item (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_id  INTEGER NOT NULL,
-                    branch_no INTEGER NOT NULL,
-                    owner    TEXT NOT NULL,
-                    status   TEXT NOT NULL,
-                    comment  TEXT,
-                    transfer_dispose_date TEXT,
-                    UNIQUE(item_id, branch_no),
-                    FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
-                )
-                ''',
-                copy_cols=["id","item_id","branch_no","owner","status","comment","transfer_dispose_date"],
-                post_sql=[
-                    "CREATE INDEX IF NOT EXISTS idx_child_item_item ON child_item(item_id)"
-                ]
-            )
-
-        if _need_recreate_on_delete(db, "checkout_history", "item", "CASCADE"):
-            _recreate_table(
-                db,
-                "checkout_history",
-                '''
-                CREATE TABLE checkout_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_id INTEGER NOT NULL,
-                    checkout_start_date TEXT NOT NULL,
-                    checkout_end_date   TEXT NOT NULL,
-                    FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
-                )
-                ''',
-                copy_cols=["id","item_id","checkout_start_date","checkout_end_date"],
-                post_sql=[
-                    "CREATE INDEX IF NOT EXISTS idx_checkout_item ON checkout_history(item_id)"
-                ]
-            )
-
-        if _need_recreate_on_delete(db, "inventory_check", "item", "CASCADE"):
-            _recreate_table(
-                db,
-                "inventory_check",
-                '''
-                CREATE TABLE inventory_check (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_id   INTEGER NOT NULL,
-                    checked_at TEXT NOT NULL,
-                    checker    TEXT NOT NULL,
-                    comment    TEXT,
-                    FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE CASCADE
-                )
-                ''',
-                copy_cols=["id","item_id","checked_at","checker","comment"],
-                post_sql=[
-                    "CREATE INDEX IF NOT EXISTS idx_inventory_item ON inventory_check(item_id)"
-                ]
-            )
-
-        # 2) ログ系は SET NULL
-        if _need_recreate_on_delete(db, "item_application", "item", "SET NULL"):
-            _recreate_table(
-                db,
-                "item_application",
-                '''
-                CREATE TABLE item_application (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_id INTEGER,
-                    new_values           TEXT NOT NULL,
-                    applicant            TEXT NOT NULL,
-                    applicant_comment    TEXT,
-                    approver             TEXT,
-                    status               TEXT NOT NULL,
-                    application_datetime TEXT NOT NULL,
-                    approval_datetime    TEXT,
-                    approver_comment     TEXT,
-                    original_status      TEXT,
-                    FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE SET NULL
-                )
-                ''',
-                copy_cols=["id","item_id","new_values","applicant","applicant_comment","approver","status",
-                           "application_datetime","approval_datetime","approver_comment","original_status"],
-                post_sql=[
-                    "CREATE INDEX IF NOT EXISTS idx_item_app_item ON item_application(item_id)"
-                ]
-            )
-
-        # application_history: on_delete と NOT NULL の両面チェック
-        need_hist_recreate = False
-        for fk in _fk_list(db, "application_history"):
-            if fk["table"] == "item":
-                if (fk["on_delete"] or "").upper() != "SET NULL":
-                    need_hist_recreate = True
-        cols = db.execute("PRAGMA table_info(application_history)").fetchall()
-        for c in cols:
-            if c["name"] == "item_id" and c["notnull"] == 1:
-                need_hist_recreate = True
-
-        if need_hist_recreate:
-            _recreate_table(
-                db,
-                "application_history",
-                '''
-                CREATE TABLE application_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_id INTEGER, -- NULL 許可
-                    applicant           TEXT NOT NULL,
-                    application_content TEXT,
-                    applicant_comment   TEXT,
-                    application_datetime TEXT NOT NULL,
-                    approver            TEXT,
-                    approver_comment    TEXT,
-                    approval_datetime   TEXT,
-                    status              TEXT NOT NULL,
-                    FOREIGN KEY(item_id) REFERENCES item(id) ON DELETE SET NULL
-                )
-                ''',
-                copy_cols=["id","item_id","applicant","application_content","applicant_comment",
-                           "application_datetime","approver","approver_comment","approval_datetime","status"],
-                post_sql=[
-                    "CREATE INDEX IF NOT EXISTS idx_app_hist_item ON application_history(item_id)"
-                ]
-            )
-
-        # 3) 孤児掃除
-        db.execute("DELETE FROM child_item        WHERE item_id NOT IN (SELECT id FROM item)")
-        db.execute("DELETE FROM checkout_history  WHERE item_id NOT IN (SELECT id FROM item)")
-        db.execute("DELETE FROM inventory_check   WHERE item_id NOT IN (SELECT id FROM item)")
-        db.execute("UPDATE item_application   SET item_id=NULL WHERE item_id NOT IN (SELECT id FROM item)")
-        db.execute("UPDATE application_history SET item_id=NULL WHERE item_id NOT IN (SELECT id FROM item)")
-
-        # 4) バージョン更新（db_meta は既に存在するのでOK）
-        db.execute("INSERT OR REPLACE INTO db_meta(key, value) VALUES('schema_version', ?)", (str(3),))
-        db.commit()
\ No newline at end of file
+        if current < 3:
+            _upgrade_v3(db)
+            _set_version(db, 3)
+            db.commit()
+        if current < 4:
+            _upgrade_v4(db)
+            _set_version(db, 4)
+            db.commit()
+        if current < 5:
+            _upgrade_v5(db)
+            _set_version(db, 5)
+            db.commit()
+        if current < 6:
+            _upgrade_v6(db)
+            _set_version(db, 6)
+            db.commit()
+        if current < 7:
+            _upgrade_v7(db)
+            _set_version(db, 7)
+            db.commit()
+        if current < 8:
+            _upgrade_v8(db)
+            _set_version(db, 8)
+            db.commit()
+        if current < 9:
+            _upgrade_v9(db)
+            _set_version(db, 9)
+            db.commit()
+        if current < 10:
+            _upgrade_v10(db)
+            _set_version(db, 10)
+            db.commit()
+        if current < 11:
+            _upgrade_v11(db)
+            _set_version(db, 11)
+            db.commit()
+        if current < 12:
+            _upgrade_v12(db)
+            _set_version(db, 12)
+            db.commit()
+        if current < 13:
+            _upgrade_v13(db)
+            _set_version(db, 13)
+            db.commit()
+        if current < 14:
+            _upgrade_v14(db)
+            _set_version(db, 14)
+            db.commit()
+        if current < 15:
+            _upgrade_v15(db)
+            _set_version(db, 15)
+            db.commit()
+        if current < 16:
+            _upgrade_v16(db)
+            _set_version(db, 16)
+            db.commit()
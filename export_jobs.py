@@ -0,0 +1,187 @@
+# export_jobs.py
+"""
+バックグラウンドのエクスポートジョブ。
+  - ジョブは export_job テーブルに記録（状態・進捗・成果物・期限）
+  - 実行はプロセス内のスレッドプール（EXPORT_WORKERS 本）。リクエストワーカーは投入だけして返る
+  - 完成ファイルは EXPORT_DIR に置き、EXPORT_TTL_SEC 経過後に expire_export_jobs()（定期メンテナンスの export_expiry）で削除
+"""
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from services import get_db, logger, BASE_DIR
+from item_filter import compile_item_filters
+from item_export import iter_export_rows, iter_csv_chunks, write_xlsx
+
+EXPORT_DIR = os.path.abspath(os.getenv("EXPORT_DIR", os.path.join(BASE_DIR, "exports")))
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", 2))
+EXPORT_TTL_SEC = int(os.getenv("EXPORT_TTL_SEC", 24 * 3600))
+# queued / running のまま残ったジョブ（プロセス再起動など）を失敗扱いにするまでの秒数
+EXPORT_STALE_SEC = int(os.getenv("EXPORT_STALE_SEC", 6 * 3600))
+# 一覧の件数がこれ以上なら画面でバックグラウンド出力を案内する
+EXPORT_BACKGROUND_THRESHOLD = int(os.getenv("EXPORT_BACKGROUND_THRESHOLD", 5000))
+PROGRESS_EVERY = 1000  # 進捗を書き込む行間隔
+
+EXPORT_KINDS = {"xlsx": ".xlsx", "csv": ".csv", "tsv": ".tsv"}
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """プロセスごとのスレッドプール（fork 後は作り直す）。"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+# ===== 投入・参照 =====
+def submit_export_job(db, username: str, kind: str, args) -> str:
+    """args（request.args / form）の *_filter を保存してジョブを投入し、ジョブ ID を返す。"""
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f"unknown export kind: {kind}")
+    params = {k: v for k, v in args.items() if k.endswith("_filter") and v}
+    job_id = uuid.uuid4().hex
+    db.execute(
+        """
+        INSERT INTO export_job (id, username, kind, params, status, created_at)
+        VALUES (?, ?, ?, ?, 'queued', ?)
+        """,
+        (job_id, username, kind, json.dumps(params, ensure_ascii=False), time.time())
+    )
+    db.commit()
+    _get_executor().submit(run_export_job, job_id)
+    return job_id
+
+
+def get_export_job(db, job_id: str) -> dict | None:
+    row = db.execute("SELECT * FROM export_job WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_export_jobs(db, username: str, limit: int = 20) -> list[dict]:
+    rows = db.execute(
+        "SELECT * FROM export_job WHERE username = ? ORDER BY created_at DESC LIMIT ?",
+        (username, limit)
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def expire_export_jobs(db, now: float = None) -> int:
+    """
+    期限切れの完成ファイルを削除して expired にし、放置された queued/running を failed にする。
+    expired にした件数を返す（commit は呼び出し側）。
+    """
+    now = now or time.time()
+    rows = db.execute(
+        "SELECT id, file_path FROM export_job WHERE status = 'done' AND expires_at <= ?",
+        (now,)
+    ).fetchall()
+    for r in rows:
+        if r["file_path"]:
+            try:
+                os.remove(r["file_path"])
+            except FileNotFoundError:
+                pass
+    if rows:
+        ids = [r["id"] for r in rows]
+        db.execute(
+            f"UPDATE export_job SET status = 'expired', file_path = NULL WHERE id IN ({','.join(['?']*len(ids))})",
+            ids
+        )
+    db.execute(
+        """
+        UPDATE export_job SET status = 'failed', error = '中断されました（プロセスの終了など）', finished_at = ?
+        WHERE status IN ('queued', 'running') AND created_at <= ?
+        """,
+        (now, now - EXPORT_STALE_SEC)
+    )
+    return len(rows)
+
+
+# ===== 実行（ワーカースレッド）=====
+def _with_progress(rows, db, job_id, progress: dict):
+    """行を流しつつ件数を progress["rows"] に数え、PROGRESS_EVERY 行ごとに progress_rows を更新する。"""
+    for row in rows:
+        yield row
+        progress["rows"] += 1
+        if progress["rows"] % PROGRESS_EVERY == 0:
+            db.execute("UPDATE export_job SET progress_rows = ? WHERE id = ?", (progress["rows"], job_id))
+            db.commit()
+
+
+def run_export_job(job_id: str):
+    """
+    1 ジョブを実行する。アプリコンテキスト外なので接続はプール外の単発接続。
+    読み出し（カーソル）と進捗の書き込みは別接続にして、書き込みのコミットが読み出しに干渉しないようにする。
+    """
+    reader = get_db()
+    writer = get_db()
+    tmp_path = None
+    try:
+        job = get_export_job(writer, job_id)
+        if job is None or job["status"] != "queued":
+            return
+        writer.execute(
+            "UPDATE export_job SET status = 'running', started_at = ? WHERE id = ?",
+            (time.time(), job_id)
+        )
+        writer.commit()
+
+        cf = compile_item_filters(reader, json.loads(job["params"]))
+        total = reader.execute(f"SELECT COUNT(*) FROM ({cf['sql']})", cf["params"]).fetchone()[0]
+        writer.execute("UPDATE export_job SET total_rows = ? WHERE id = ?", (total, job_id))
+        writer.commit()
+
+        kind = job["kind"]
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        path = os.path.join(EXPORT_DIR, f"{job_id}{EXPORT_KINDS[kind]}")
+        tmp_path = path + ".part"
+        progress = {"rows": 0}
+        rows = _with_progress(iter_export_rows(reader, cf), writer, job_id, progress)
+        with open(tmp_path, "wb") as f:
+            if kind == "xlsx":
+                write_xlsx(rows, f)
+            else:
+                for chunk in iter_csv_chunks(rows, delimiter="\t" if kind == "tsv" else ","):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+        tmp_path = None
+        count = progress["rows"]
+
+        now = time.time()
+        created = time.strftime("%Y%m%d_%H%M%S", time.localtime(job["created_at"]))
+        writer.execute(
+            """
+            UPDATE export_job
+               SET status = 'done', progress_rows = ?, file_path = ?, file_name = ?,
+                   finished_at = ?, expires_at = ?
+             WHERE id = ?
+            """,
+            (count, path, f"items_{created}{EXPORT_KINDS[kind]}", now, now + EXPORT_TTL_SEC, job_id)
+        )
+        writer.commit()
+        logger.info("export job done: %s kind=%s rows=%s", job_id, kind, count)
+    except Exception as e:
+        logger.exception("export job failed: %s", job_id)
+        writer.rollback()
+        writer.execute(
+            "UPDATE export_job SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (str(e)[:500], time.time(), job_id)
+        )
+        writer.commit()
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+    finally:
+        reader.close()
+        writer.close()
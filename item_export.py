@@ -0,0 +1,120 @@
+# item_export.py
+"""
+一覧のエクスポート。フィルタは item_filter.compile_item_filters() の結果をそのまま使う。
+行はカーソルから fetchmany で少しずつ流し、全件をメモリに載せない。
+"""
+import os
+import io
+import csv
+import zlib
+import tempfile
+
+from services import INDEX_FIELDS
+
+EXPORT_FETCH_SIZE = 500
+# 生成したファイルはこのサイズまではメモリ、超えたら一時ファイルへ
+EXPORT_SPOOL_MAX_BYTES = int(os.getenv("EXPORT_SPOOL_MAX_BYTES", 8 * 1024 * 1024))
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+CSV_MIMETYPES = {",": "text/csv; charset=utf-8", "\t": "text/tab-separated-values; charset=utf-8"}
+# Excel の列幅（fields.json の type ごと。write-only ブックは内容を見てから幅を決められない）
+XLSX_COLUMN_WIDTHS = {"int": 10, "date": 12, "text": 30}
+
+
+def export_headers() -> list[str]:
+    """ヘッダ行: ID + INDEX_FIELDSの表示名 + サンプル数"""
+    return ["ID"] + [f["name"] for f in INDEX_FIELDS] + ["サンプル数"]
+
+
+def iter_export_rows(db, cf):
+    """フィルタ適用後の行を ID 降順で 1 行ずつ（list）返す。sample_manager は表示名に変換。"""
+    user_display = cf["user_display"]
+    cur = db.execute(f"{cf['sql']} ORDER BY item.id DESC", cf["params"])
+    while True:
+        rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        for r in rows:
+            out = [r["id"]]
+            for f in INDEX_FIELDS:
+                val = r[f["key"]]
+                if f["key"] == "sample_manager":
+                    val = user_display.get(val, val)
+                out.append(val)
+            out.append(r["sample_count"])
+            yield out
+
+
+def iter_csv_chunks(rows, delimiter=",", compress=False):
+    """
+    rows（iter_export_rows の出力）をヘッダ付き CSV/TSV（UTF-8）のバイト列として少しずつ返す。
+    EXPORT_FETCH_SIZE 行ごとに 1 チャンク。compress=True なら gzip ストリームにする。
+    """
+    gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=delimiter, lineterminator="\r\n")
+
+    def flush():
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    writer.writerow(export_headers())
+    pending = 1
+    for row in rows:
+        writer.writerow(["" if v is None else v for v in row])
+        pending += 1
+        if pending >= EXPORT_FETCH_SIZE:
+            chunk = flush()
+            pending = 0
+            if chunk:
+                yield chunk
+    chunk = flush()
+    if gz:
+        chunk += gz.flush()
+    if chunk:
+        yield chunk
+
+
+def _xlsx_column_widths() -> list[int]:
+    """列幅（ID + INDEX_FIELDS + サンプル数）。fields.json の型ごとの既定幅と見出しの長さの大きい方。"""
+    types = ["int"] + [f.get("type", "text") for f in INDEX_FIELDS] + ["int"]
+    return [
+        min(max(XLSX_COLUMN_WIDTHS.get(t, XLSX_COLUMN_WIDTHS["text"]), len(h) * 2 + 2), 60)
+        for t, h in zip(types, export_headers())
+    ]
+
+
+def write_xlsx(rows, fileobj) -> int:
+    """
+    rows（iter_export_rows の出力）を write-only ブックへそのまま流し込み、fileobj に書き出す。書いた行数を返す。
+    write-only では列幅を 1 行目より前に確定させる必要があるので、列幅は内容ではなく型から決める。
+    """
+    # 依存: openpyxl（未導入なら `pip install openpyxl`）
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("items")
+    for i, w in enumerate(_xlsx_column_widths(), start=1):
+        ws.column_dimensions[get_column_letter(i)].width = w
+    ws.append(export_headers())
+    count = 0
+    for row in rows:
+        ws.append(row)
+        count += 1
+    wb.save(fileobj)
+    return count
+
+
+def spool_xlsx(db, cf):
+    """Excel を SpooledTemporaryFile に書き、(先頭に戻したファイル, バイト数) を返す。"""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    try:
+        write_xlsx(iter_export_rows(db, cf), spool)
+        size = spool.tell()
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool, size
@@ -0,0 +1,141 @@
+# item_filter.py
+"""
+一覧系（index / export_excel / inventory_list）共通のフィルタコンパイラ。
+request.args の *_filter を解釈し、パラメータ付きの SELECT 文を組み立てる。
+
+  - sample_manager は realname で受け取り username に正規化（表示名マップはキャッシュ済み）
+  - 部分一致は 3 文字以上なら item_fts（FTS5 trigram）、それ以外は LIKE
+  - sample_count / 最終棚卸し年月 / proper の自分分のみ、もここで扱う
+
+SQL 文字列はフィルタの「形」（どの列をどの方式で絞るか）ごとにキャッシュする。
+値はすべてパラメータなので、同じ形の検索は同じ SQL テキストになり sqlite3 の文キャッシュにも乗る。
+"""
+from datetime import datetime
+import calendar
+from functools import lru_cache
+
+from services import (
+    INDEX_FIELDS, FTS_FIELD_KEYS, FTS_MIN_CHARS, SAMPLE_COUNT_EXPR, SQL_NOW_EPOCH,
+    has_item_fts,
+)
+from user_directory import get_user_display_maps
+
+# 最新の棚卸し1件（idx_inventory_item_checked でアイテムごとに引く）
+_LATEST_CHECK_JOIN = """
+    LEFT JOIN inventory_check ic ON ic.id = (
+        SELECT a.id FROM inventory_check a
+        WHERE a.item_id = item.id
+        ORDER BY a.checked_at DESC, a.id DESC
+        LIMIT 1
+    )
+"""
+
+
+@lru_cache(maxsize=256)
+def _compile_sql(shape: tuple, with_last_check: bool) -> str:
+    """shape = ((方式, 列), ...) から SELECT 文を作る。値は含まないのでキャッシュできる。"""
+    conds = []
+    for kind, col in shape:
+        if kind == "id":
+            conds.append("CAST(item.id AS TEXT) LIKE ?")
+        elif kind == "fts":
+            conds.append(f"item.id IN (SELECT rowid FROM item_fts WHERE {col} MATCH ?)")
+        elif kind == "like":
+            conds.append(f"item.{col} LIKE ?")
+        elif kind == "sample_count":
+            conds.append(f"CAST(({SAMPLE_COUNT_EXPR}) AS TEXT) = ?")
+        elif kind == "owner":
+            conds.append("item.sample_manager = ?")
+        elif kind == "checked_before":
+            # 未実施（NULL）も“以前”として含める
+            conds.append("(ic.checked_at IS NULL OR ic.checked_at <= ?)")
+        else:
+            raise ValueError(f"unknown filter kind: {kind}")
+
+    # locked_by は期限内の編集ロック保持者（item_lock を主キーで引く）
+    cols = (
+        f"item.*, {SAMPLE_COUNT_EXPR} AS sample_count, "
+        f"(SELECT lk.locked_by FROM item_lock lk WHERE lk.item_id = item.id AND lk.expires_at >= {SQL_NOW_EPOCH}) AS locked_by"
+    )
+    join = ""
+    if with_last_check:
+        cols += ", ic.checked_at AS last_checked_at, ic.checker AS last_checker"
+        join = _LATEST_CHECK_JOIN
+    where = "WHERE " + " AND ".join(conds) if conds else ""
+    return f"SELECT {cols} FROM item {join} {where}"
+
+
+def _month_end(ym: str):
+    """'YYYY-MM' → その月末の 'YYYY-MM-DD 23:59:59'。不正なら None。"""
+    try:
+        dt = datetime.strptime(ym, "%Y-%m")
+    except ValueError:
+        return None
+    last_day = calendar.monthrange(dt.year, dt.month)[1]
+    return f"{dt.year:04d}-{dt.month:02d}-{last_day:02d} 23:59:59"
+
+
+def compile_item_filters(db, args, *, with_last_check=False, scope_user=None, scope_roles=()):
+    """
+    request.args → 一覧用の SQL（ORDER BY / LIMIT なし）。戻り値の dict:
+      sql / params           … 全フィルタ適用後
+      filters                … 画面反映用（キー: id / 各列 / sample_count [/ last_checked_ym]）
+      filter_args            … ページリンク用（*_filter 名）
+      user_display           … username → 表示名
+    with_last_check=True で最新棚卸し（last_checked_at / last_checker）を JOIN し last_checked_ym を解釈する。
+    scope_roles が proper のみ（admin/manager でない）なら scope_user の管理分だけに絞る。
+    """
+    user_display, display_to_username = get_user_display_maps(db)
+    use_fts = has_item_fts(db)
+
+    filters = {}
+    shape = []
+    params = []
+
+    id_filter = args.get("id_filter", "").strip()
+    filters["id"] = id_filter
+    if id_filter:
+        shape.append(("id", "id"))
+        params.append(f"%{id_filter}%")
+
+    for f in INDEX_FIELDS:
+        key = f["key"]
+        v = args.get(f"{key}_filter", "").strip()
+        filters[key] = v  # sample_manager も画面反映は realname のまま
+        if not v:
+            continue
+        if key == "sample_manager":
+            v = display_to_username.get(v, v)  # realname -> username（見つからなければそのまま）
+        if use_fts and key in FTS_FIELD_KEYS and len(v) >= FTS_MIN_CHARS:
+            shape.append(("fts", key))
+            params.append('"' + v.replace('"', '""') + '"')
+        else:
+            shape.append(("like", key))
+            params.append(f"%{v}%")
+
+    # proper は自分の分のみ
+    if scope_user and "proper" in scope_roles and not ("admin" in scope_roles or "manager" in scope_roles):
+        shape.append(("owner", "sample_manager"))
+        params.append(scope_user)
+
+    if with_last_check:
+        last_checked_ym = args.get("last_checked_ym_filter", "").strip()
+        filters["last_checked_ym"] = last_checked_ym
+        month_end = _month_end(last_checked_ym) if last_checked_ym else None
+        if month_end:  # フォーマット不正なら無視（フィルタ未適用）
+            shape.append(("checked_before", "checked_at"))
+            params.append(month_end)
+
+    sample_count_filter = args.get("sample_count_filter", "").strip()
+    filters["sample_count"] = sample_count_filter
+    if sample_count_filter:
+        shape.append(("sample_count", "sample_count"))
+        params.append(sample_count_filter)
+
+    return {
+        "sql": _compile_sql(tuple(shape), with_last_check),
+        "params": params,
+        "filters": filters,
+        "filter_args": {f"{k}_filter": v for k, v in filters.items() if v},
+        "user_display": user_display,
+    }
@@ -0,0 +1,174 @@
+# mail_digest.py
+"""
+申請の通知メールを宛先ごとにまとめる（一括承認などで 1 申請 1 通にしない）。
+  - 1 リクエスト（一括処理）の間、add() で申請を集め、最後に enqueue() で送信キューへ積む
+  - 申請ごとの関係者（承認者・申請者・管理者・所有者）を求め、人ごとに関係する申請の集合を作る。
+    集合が同じ人たちは 1 通にまとめる → 通数・描画回数は人数以下（申請件数に比例しない）
+  - 1 通に申請が 1 件だけなら従来の mails/approval_result.txt、複数なら mails/approval_digest.txt
+  - ユーザー情報・管理者の補完は全申請分を 1 回ずつまとめて引く
+"""
+import json
+
+from flask import render_template
+
+from user_directory import get_user_profiles
+from mail_outbox import enqueue_mail
+
+# 所有者にも知らせる申請（所有者入力のある申請）
+OWNER_NOTIFY_STATUSES = (
+    "入庫持ち出し申請中", "入庫持ち出し譲渡申請中",
+    "持ち出し申請中", "持ち出し譲渡申請中"
+)
+
+KIND_LABELS = {
+    "入庫持ち出し譲渡申請中": "入庫持ち出し譲渡申請",
+    "入庫持ち出し申請中": "入庫持ち出し申請",
+    "入庫申請中": "入庫申請",
+    "持ち出し譲渡申請中": "持ち出し譲渡申請",
+    "持ち出し申請中": "持ち出し申請",
+    "返却申請中": "返却申請",
+    "破棄・譲渡申請中": "破棄・譲渡申請",
+}
+
+ACTION_LABELS = {"approve": "承認", "reject": "差し戻し", "cancel": "取消"}
+
+
+def application_kind(status: str) -> str:
+    return KIND_LABELS.get(status) or (status or "申請")
+
+
+class ApplicationDigest:
+    """1 リクエスト分の申請通知を集めて、宛先ごとに 1 通にまとめる。"""
+
+    def __init__(self, action: str, approver_comment: str = ""):
+        self.action = action
+        self.action_label = ACTION_LABELS.get(action, "更新")
+        self.approver_comment = approver_comment or ""
+        self.rows = []
+        self.no_recipient = []   # 宛先が 1 つもなかった申請の ID
+
+    def add(self, app_row):
+        # sqlite3.Row は .get を持たないため dict 化
+        self.rows.append(app_row if isinstance(app_row, dict) else dict(app_row))
+
+    def __len__(self):
+        return len(self.rows)
+
+    # ===== 申請 → 通知内容 =====
+    def _events(self, db) -> list[dict]:
+        events = []
+        for row in self.rows:
+            try:
+                nv = json.loads(row.get("new_values") or "{}")
+            except Exception:
+                nv = {}
+            status = (nv.get("status") or "").strip()
+            include_owners = status in OWNER_NOTIFY_STATUSES
+            events.append({
+                "app_id": row.get("id"),
+                "item_id": row["item_id"],
+                "approver": row.get("approver"),
+                "applicant": row.get("applicant"),
+                "kind": application_kind(status),
+                "manager": (nv.get("sample_manager") or "").strip(),
+                "include_owners": include_owners,
+                "owners": list(nv.get("owner_list") or []) if include_owners else [],
+                "new_values": nv,
+                "applicant_comment": row.get("applicant_comment") or "",
+            })
+
+        # 申請に管理者がなければ item の管理者（まとめて 1 回で引く）
+        missing = sorted({e["item_id"] for e in events if not e["manager"] and e["item_id"] is not None})
+        if missing:
+            placeholders = ",".join("?" * len(missing))
+            managers = {
+                r["id"]: (r["sample_manager"] or "").strip()
+                for r in db.execute(f"SELECT id, sample_manager FROM item WHERE id IN ({placeholders})", missing)
+            }
+            for e in events:
+                if not e["manager"]:
+                    e["manager"] = managers.get(e["item_id"], "")
+        return events
+
+    def _usernames(self, e) -> set:
+        names = {e["approver"], e["applicant"]}
+        if e["manager"]:
+            names.add(e["manager"])
+        names |= {u for u in e["owners"] if u}
+        names.discard(None)
+        return names
+
+    # ===== 描画 =====
+    def _render_single(self, e, profiles) -> tuple[str, str]:
+        nv = e["new_values"]
+        subject = f"[{self.action_label}] {e['kind']}（ID: {e['item_id']}）"
+        body = render_template(
+            "mails/approval_result.txt",
+            approver_prof=profiles.get(e["approver"], {}),
+            applicant_prof=profiles.get(e["applicant"], {}),
+            manager_prof=profiles.get(e["manager"], {}) if e["manager"] else {},
+            owner_profs=[profiles[u] for u in sorted({u for u in e["owners"] if u})] if e["include_owners"] else [],
+            profiles=profiles,
+            action_label=self.action_label,
+            kind=e["kind"],
+            changes=[{"item_id": e["item_id"], "manager": e["manager"], "owners": e["owners"]}],
+            start_date=nv.get("checkout_start_date", ""),
+            end_date=nv.get("checkout_end_date", ""),
+            transfer_date=nv.get("transfer_date", ""),
+            transfer_comment=nv.get("transfer_comment", ""),
+            dispose_type=nv.get("dispose_type", ""),
+            dispose_date=nv.get("dispose_date", ""),
+            dispose_comment=nv.get("dispose_comment", ""),
+            return_date=nv.get("return_date", ""),
+            storage=nv.get("storage", ""),
+            applicant_comment=e["applicant_comment"],
+            approver_comment=self.approver_comment,
+        )
+        return subject, body
+
+    def _render_digest(self, events, profiles) -> tuple[str, str]:
+        kinds = list(dict.fromkeys(e["kind"] for e in events))
+        kind_text = kinds[0] if len(kinds) == 1 else f"{kinds[0]}ほか"
+        subject = f"[{self.action_label}] {kind_text} {len(events)}件"
+        body = render_template(
+            "mails/approval_digest.txt",
+            events=events,
+            profiles=profiles,
+            action_label=self.action_label,
+            approver_comment=self.approver_comment,
+        )
+        return subject, body
+
+    def build(self, db) -> list[tuple[str, str, str]]:
+        """[(to, subject, body), ...] を返す。宛先のない申請は self.no_recipient に入る。"""
+        events = self._events(db)
+        usernames = set()
+        for e in events:
+            usernames |= self._usernames(e)
+        profiles = get_user_profiles(db, sorted(usernames))
+
+        # 人（メールアドレス）ごとに関係する申請 → 同じ申請の組を受け取る人を 1 通にまとめる
+        per_email = {}
+        for idx, e in enumerate(events):
+            emails = {profiles[u]["email"] for u in self._usernames(e) if profiles[u]["email"]}
+            if not emails:
+                self.no_recipient.append(e["app_id"])
+            for addr in emails:
+                per_email.setdefault(addr, []).append(idx)
+        groups = {}
+        for addr, idxs in per_email.items():
+            groups.setdefault(tuple(idxs), []).append(addr)
+
+        mails = []
+        for idxs, addrs in sorted(groups.items()):
+            group = [events[i] for i in idxs]
+            if len(group) == 1:
+                subject, body = self._render_single(group[0], profiles)
+            else:
+                subject, body = self._render_digest(group, profiles)
+            mails.append((",".join(sorted(addrs)), subject, body))
+        return mails
+
+    def enqueue(self, db) -> int:
+        """まとめたメールを送信キューに積み、通数を返す（commit は呼び出し側）。"""
+        return sum(1 for to, subject, body in self.build(db) if enqueue_mail(db, to, subject, body))
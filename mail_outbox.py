@@ -0,0 +1,198 @@
+# mail_outbox.py
+"""
+メール送信キュー（transactional outbox）。
+  - 画面側は enqueue_mail() で mail_outbox に 1 行積むだけ（業務更新と同じトランザクション、commit は呼び出し側）
+    → ロールバックされた変更のメールは送られず、SMTP の遅さがリクエストに乗らない
+  - 送信はワーカーが行う。失敗したら指数バックオフで再送し、MAIL_MAX_ATTEMPTS 回で failed
+      Web プロセス内: 最初のリクエストでデーモンスレッドを起動（MAIL_WORKER=thread、既定）。
+                      メールを積んだリクエストの終了時に起こすので、通常はすぐ送られる
+      専用プロセス  : `flask mail-worker`
+  - 取り出しは 1 文の UPDATE ... RETURNING なので、複数のワーカーが同じメールを二重に送ることはない
+  - SMTP 接続は send_mail 側のプールで使い回すので、1 バッチは同じ接続で続けて送られる
+"""
+import os
+import time
+import threading
+
+from flask import g, has_app_context
+
+from services import get_db, logger
+from send_mail import send_mail, transport_stats, close_transport
+
+MAIL_WORKER = os.getenv("MAIL_WORKER", "thread")                      # thread / off
+MAIL_POLL_SEC = int(os.getenv("MAIL_POLL_SEC", 10))                   # キューを見に行く間隔
+MAIL_BATCH = int(os.getenv("MAIL_BATCH", 20))                         # 1 回に取り出す通数
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 6))
+MAIL_RETRY_BASE_SEC = int(os.getenv("MAIL_RETRY_BASE_SEC", 60))       # 再送間隔: 60, 120, 240, ... 秒
+MAIL_RETRY_MAX_SEC = int(os.getenv("MAIL_RETRY_MAX_SEC", 3600))
+# sending のまま残ったメール（送信中のプロセス終了など）を再送対象に戻すまでの秒数
+MAIL_SENDING_TIMEOUT_SEC = int(os.getenv("MAIL_SENDING_TIMEOUT_SEC", 600))
+MAIL_KEEP_DAYS = int(os.getenv("MAIL_KEEP_DAYS", 30))                 # 送信済みを残す日数
+
+
+# ===== 積む =====
+def enqueue_mail(db, to, subject: str, body: str):
+    """
+    メールを 1 通キューに積み、id を返す（commit は呼び出し側）。宛先が空なら積まずに None。
+    アプリコンテキスト内なら、リクエスト終了時にワーカーを起こす印を付ける。
+    """
+    if not isinstance(to, str):
+        to = ",".join(a for a in to if a)
+    to = ",".join(a.strip() for a in to.split(",") if a.strip())
+    if not to:
+        logger.warning("mail not queued (no recipients): %s", subject)
+        return None
+    now = time.time()
+    cur = db.execute(
+        """
+        INSERT INTO mail_outbox (to_addrs, subject, body, status, created_at, next_attempt_at)
+        VALUES (?, ?, ?, 'pending', ?, ?)
+        """,
+        (to, subject, body, now, now)
+    )
+    if has_app_context():
+        g.mail_enqueued = True
+    return cur.lastrowid
+
+
+# ===== 送る =====
+def _claim(db, limit: int) -> list:
+    """送信期限の来たメールを最大 limit 通 sending にして取り出す（1 文なので他ワーカーと競合しない）。"""
+    now = time.time()
+    rows = db.execute(
+        """
+        UPDATE mail_outbox
+           SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+         WHERE id IN (
+            SELECT id FROM mail_outbox
+             WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+             ORDER BY next_attempt_at, id
+             LIMIT ?
+         )
+        RETURNING id, to_addrs, subject, body, attempts
+        """,
+        (now + MAIL_SENDING_TIMEOUT_SEC, now, limit)
+    ).fetchall()
+    db.commit()
+    return rows
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(MAIL_RETRY_BASE_SEC * (2 ** max(attempts - 1, 0)), MAIL_RETRY_MAX_SEC)
+
+
+def deliver_pending(db, limit: int = None) -> dict:
+    """キューから 1 バッチ取り出して送る。{"sent": n, "retry": n, "failed": n} を返す。"""
+    counts = {"sent": 0, "retry": 0, "failed": 0}
+    for m in _claim(db, limit or MAIL_BATCH):
+        result = send_mail(to=m["to_addrs"], subject=m["subject"], body=m["body"])
+        now = time.time()
+        if result and result.get("success"):
+            db.execute(
+                "UPDATE mail_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                (now, m["id"])
+            )
+            counts["sent"] += 1
+        elif m["attempts"] >= MAIL_MAX_ATTEMPTS:
+            db.execute(
+                "UPDATE mail_outbox SET status = 'failed', last_error = ? WHERE id = ?",
+                ((result or {}).get("error"), m["id"])
+            )
+            counts["failed"] += 1
+            logger.error("mail %s failed after %s attempts: %s", m["id"], m["attempts"], (result or {}).get("error"))
+        else:
+            db.execute(
+                "UPDATE mail_outbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (now + _retry_delay(m["attempts"]), (result or {}).get("error"), m["id"])
+            )
+            counts["retry"] += 1
+            logger.warning("mail %s attempt %s failed: %s", m["id"], m["attempts"], (result or {}).get("error"))
+        db.commit()
+    return counts
+
+
+def drain(db) -> dict:
+    """送れるものがなくなるまで deliver_pending() を繰り返す。"""
+    total = {"sent": 0, "retry": 0, "failed": 0}
+    while True:
+        counts = deliver_pending(db)
+        for k in total:
+            total[k] += counts[k]
+        if not any(counts.values()):
+            return total
+
+
+def retry_failed(db) -> int:
+    """failed のメールを送信待ちに戻す（試行回数はリセット）。件数を返す（commit は呼び出し側）。"""
+    return db.execute(
+        "UPDATE mail_outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'failed'",
+        (time.time(),)
+    ).rowcount
+
+
+def prune_sent(db, now: float = None) -> int:
+    """MAIL_KEEP_DAYS より古い送信済みを削除（commit は呼び出し側）。"""
+    cutoff = (now or time.time()) - MAIL_KEEP_DAYS * 86400
+    return db.execute("DELETE FROM mail_outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,)).rowcount
+
+
+def outbox_status(db, limit: int = 50) -> dict:
+    """状態ごとの件数と直近のメール（本文は除く）、SMTP 接続プールの統計。"""
+    counts = {r["status"]: r["n"] for r in db.execute(
+        "SELECT status, COUNT(*) AS n FROM mail_outbox GROUP BY status"
+    )}
+    recent = db.execute(
+        """
+        SELECT id, to_addrs, subject, status, attempts, last_error, created_at, next_attempt_at, sent_at
+        FROM mail_outbox ORDER BY id DESC LIMIT ?
+        """,
+        (limit,)
+    ).fetchall()
+    return {"counts": counts, "recent": [dict(r) for r in recent], "transport": transport_stats()}
+
+
+# ===== ワーカー =====
+_wake = threading.Event()
+_thread = None
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def run_forever(poll: int = None, stop_event: threading.Event = None):
+    """キューを送り切ったら poll 秒（または wake_mail_worker() まで）待つ、を繰り返す。"""
+    poll = poll or MAIL_POLL_SEC
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        db = get_db()
+        try:
+            drain(db)
+        except Exception:
+            logger.exception("mail worker failed")
+            db.rollback()
+        finally:
+            if not has_app_context():  # アプリコンテキスト内（CLI）の接続は teardown でプールへ返る
+                db.close()
+        _wake.wait(poll)
+        _wake.clear()
+    close_transport()
+
+
+def start_mail_worker():
+    """Web プロセス内の送信スレッドを（プロセスごとに 1 本）起動する。"""
+    global _thread, _thread_pid
+    if MAIL_WORKER != "thread":
+        return
+    if _thread is not None and _thread_pid == os.getpid():
+        return
+    with _thread_lock:
+        if _thread is not None and _thread_pid == os.getpid():
+            return
+        _thread = threading.Thread(target=run_forever, name="mail-worker", daemon=True)
+        _thread_pid = os.getpid()
+        _thread.start()
+
+
+def wake_mail_worker(exc=None):
+    """teardown_appcontext から呼ばれる。このリクエストでメールを積んでいたらワーカーを起こす。"""
+    if g.pop("mail_enqueued", False) and exc is None:
+        _wake.set()
@@ -0,0 +1,244 @@
+# maintenance.py
+"""
+定期メンテナンス（ユーザーのリクエストに相乗りさせない後始末）。
+  - lock_expiry     … 期限切れの一括編集ロックを削除
+  - export_expiry   … 期限切れのエクスポート成果物を削除、放置ジョブを失敗扱いに
+  - orphan_sweep    … 親 item を失った明細・ログを少しずつ掃除（1 バッチごとに commit）
+  - analyze         … 統計情報の更新（analysis_limit 付き ANALYZE）
+  - wal_checkpoint  … WAL のチェックポイント
+  - run_log_prune   … 古い maintenance_run を削除
+  - mail_prune      … 古い送信済みメール（mail_outbox）を削除
+
+実行のしかた:
+  - Web プロセス内: 最初のリクエストで start_scheduler() がデーモンスレッドを起動（MAINTENANCE_SCHEDULER=thread、既定）
+  - 専用プロセス  : `flask maintenance-worker`（この場合 Web 側は MAINTENANCE_SCHEDULER=off にしてよい）
+どちらでも、ジョブの実行権は maintenance_run への書き込み（BEGIN IMMEDIATE）で取るので、
+複数プロセスが同時に動いても同じジョブが二重に走ることはない。
+"""
+import os
+import time
+import socket
+import threading
+
+from flask import has_app_context
+
+from services import get_db, logger, expire_locks, immediate_transaction
+from export_jobs import expire_export_jobs
+from mail_outbox import prune_sent
+
+MAINTENANCE_SCHEDULER = os.getenv("MAINTENANCE_SCHEDULER", "thread")  # thread / off
+MAINTENANCE_TICK_SEC = int(os.getenv("MAINTENANCE_TICK_SEC", 30))      # 期限到来の確認間隔
+# running のまま残った実行（プロセス終了など）を無視して再実行するまでの秒数
+MAINTENANCE_STALE_SEC = int(os.getenv("MAINTENANCE_STALE_SEC", 3600))
+ORPHAN_BATCH = int(os.getenv("MAINT_ORPHAN_BATCH", 500))          # 1 バッチ（1 commit）の行数
+ORPHAN_MAX_ROWS = int(os.getenv("MAINT_ORPHAN_MAX_ROWS", 5000))   # 1 回の実行で扱う最大行数
+ANALYSIS_LIMIT = int(os.getenv("MAINT_ANALYSIS_LIMIT", 1000))     # ANALYZE が索引ごとに見る行数の上限
+WAL_CHECKPOINT_MODE = os.getenv("MAINT_WAL_CHECKPOINT_MODE", "PASSIVE").upper()
+RUN_LOG_KEEP_DAYS = int(os.getenv("MAINT_RUN_LOG_KEEP_DAYS", 30))
+
+# 親 item を失った行の扱い（v3 の孤児掃除と同じ方針）
+_ORPHAN_DELETE_TABLES = ["child_item", "checkout_history", "inventory_check", "item_lock"]
+_ORPHAN_NULLIFY_TABLES = ["item_application", "application_history"]
+
+
+# ===== ジョブ本体（db を受け取り (件数, 詳細) を返す）=====
+def _job_lock_expiry(db):
+    n = expire_locks(db)
+    db.commit()
+    return n, None
+
+
+def _job_export_expiry(db):
+    n = expire_export_jobs(db)
+    db.commit()
+    return n, None
+
+
+def _job_orphan_sweep(db):
+    """
+    孤児を ORPHAN_BATCH 行ずつ処理し、バッチごとに commit して書き込みロックを短く保つ。
+    1 回の実行は ORPHAN_MAX_ROWS 行までで、残りは次回に回す。
+    """
+    total = 0
+    counts = {}
+    for table in _ORPHAN_DELETE_TABLES + _ORPHAN_NULLIFY_TABLES:
+        if table in _ORPHAN_DELETE_TABLES:
+            sql = f"""
+                DELETE FROM {table} WHERE rowid IN (
+                    SELECT t.rowid FROM {table} t
+                    WHERE NOT EXISTS (SELECT 1 FROM item WHERE item.id = t.item_id)
+                    LIMIT ?
+                )
+            """
+        else:
+            sql = f"""
+                UPDATE {table} SET item_id = NULL WHERE rowid IN (
+                    SELECT t.rowid FROM {table} t
+                    WHERE t.item_id IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM item WHERE item.id = t.item_id)
+                    LIMIT ?
+                )
+            """
+        while total < ORPHAN_MAX_ROWS:
+            n = db.execute(sql, (min(ORPHAN_BATCH, ORPHAN_MAX_ROWS - total),)).rowcount
+            db.commit()
+            if n <= 0:
+                break
+            total += n
+            counts[table] = counts.get(table, 0) + n
+    detail = ", ".join(f"{t}={n}" for t, n in counts.items()) or None
+    return total, detail
+
+
+def _job_analyze(db):
+    db.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    db.execute("ANALYZE")
+    db.commit()
+    return 0, None
+
+
+def _job_wal_checkpoint(db):
+    mode = WAL_CHECKPOINT_MODE if WAL_CHECKPOINT_MODE in ("PASSIVE", "FULL", "RESTART", "TRUNCATE") else "PASSIVE"
+    busy, log_frames, checkpointed = db.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    return checkpointed, f"mode={mode} busy={busy} log={log_frames} checkpointed={checkpointed}"
+
+
+def _job_run_log_prune(db):
+    cutoff = time.time() - RUN_LOG_KEEP_DAYS * 86400
+    n = db.execute(
+        "DELETE FROM maintenance_run WHERE started_at < ? AND status != 'running'", (cutoff,)
+    ).rowcount
+    db.commit()
+    return n, None
+
+
+def _job_mail_prune(db):
+    n = prune_sent(db)
+    db.commit()
+    return n, None
+
+
+# ジョブ名 → (関数, 実行間隔秒)。間隔は MAINT_<ジョブ名大文字>_SEC で上書き可
+JOBS = {
+    name: (func, int(os.getenv(f"MAINT_{name.upper()}_SEC", default)))
+    for name, func, default in [
+        ("lock_expiry",    _job_lock_expiry,    60),
+        ("export_expiry",  _job_export_expiry,  300),
+        ("orphan_sweep",   _job_orphan_sweep,   3600),
+        ("analyze",        _job_analyze,        6 * 3600),
+        ("wal_checkpoint", _job_wal_checkpoint, 300),
+        ("run_log_prune",  _job_run_log_prune,  24 * 3600),
+        ("mail_prune",     _job_mail_prune,     24 * 3600),
+    ]
+}
+
+
+# ===== 実行権の取得と記録 =====
+def _worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _claim(db, job: str, interval: int, force: bool):
+    """
+    期限が来ていれば maintenance_run に running 行を入れて run id を返す（来ていなければ None）。
+    判定と挿入は BEGIN IMMEDIATE の中で行うので、他プロセスと同時に取ることはない。
+    """
+    now = time.time()
+    with immediate_transaction(db):
+        last = db.execute(
+            "SELECT status, started_at FROM maintenance_run WHERE job = ? ORDER BY started_at DESC LIMIT 1",
+            (job,)
+        ).fetchone()
+        if last is not None:
+            if last["status"] == "running" and now - last["started_at"] < MAINTENANCE_STALE_SEC:
+                return None
+            if not force and now - last["started_at"] < interval:
+                return None
+        cur = db.execute(
+            "INSERT INTO maintenance_run (job, status, worker, started_at) VALUES (?, 'running', ?, ?)",
+            (job, _worker_name(), now)
+        )
+        return cur.lastrowid
+
+
+def run_job(db, job: str, force: bool = False) -> dict | None:
+    """1 ジョブを（期限が来ていれば）実行して結果を記録する。実行しなかったら None。"""
+    func, interval = JOBS[job]
+    run_id = _claim(db, job, interval, force)
+    if run_id is None:
+        return None
+    started = time.time()
+    try:
+        rows, detail = func(db)
+        status, error = "done", None
+    except Exception as e:
+        logger.exception("maintenance job failed: %s", job)
+        db.rollback()
+        rows, detail, status, error = None, None, "failed", str(e)[:500]
+    db.execute(
+        """
+        UPDATE maintenance_run SET status = ?, finished_at = ?, rows_affected = ?, detail = ?, error = ?
+        WHERE id = ?
+        """,
+        (status, time.time(), rows, detail, error, run_id)
+    )
+    db.commit()
+    elapsed_ms = int((time.time() - started) * 1000)
+    logger.info("maintenance %s: %s rows=%s %dms", job, status, rows, elapsed_ms)
+    return {"job": job, "status": status, "rows_affected": rows, "detail": detail, "error": error,
+            "duration_ms": elapsed_ms}
+
+
+def run_due_jobs(only=None, force: bool = False) -> list[dict]:
+    """期限の来たジョブ（only 指定時はその名前のみ）を順に実行し、実行した分の結果を返す。"""
+    db = get_db()
+    try:
+        results = []
+        for job in JOBS:
+            if only and job not in only:
+                continue
+            res = run_job(db, job, force=force)
+            if res:
+                results.append(res)
+        return results
+    finally:
+        if not has_app_context():  # アプリコンテキスト内（CLI）の接続は teardown でプールへ返る
+            db.close()
+
+
+def list_runs(db, limit: int = 50) -> list[dict]:
+    rows = db.execute("SELECT * FROM maintenance_run ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+# ===== スケジューラ =====
+def run_forever(tick: int = None, stop_event: threading.Event = None, only=None):
+    """tick 秒ごとに run_due_jobs() を呼び続ける（maintenance-worker / スレッドの本体）。"""
+    tick = tick or MAINTENANCE_TICK_SEC
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            run_due_jobs(only=only)
+        except Exception:
+            logger.exception("maintenance tick failed")
+        stop_event.wait(tick)
+
+
+_thread = None
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def start_scheduler():
+    """Web プロセス内のスケジューラスレッドを（プロセスごとに 1 本）起動する。"""
+    global _thread, _thread_pid
+    if MAINTENANCE_SCHEDULER != "thread":
+        return
+    if _thread is not None and _thread_pid == os.getpid():
+        return
+    with _thread_lock:
+        if _thread is not None and _thread_pid == os.getpid():
+            return
+        _thread = threading.Thread(target=run_forever, name="maintenance", daemon=True)
+        _thread_pid = os.getpid()
+        _thread.start()
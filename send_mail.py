@@ -1,19 +1,84 @@
 # send_mail.py
+"""
+メール送信（トランスポート）。画面からは直接呼ばず、mail_outbox.enqueue_mail() で積んだものをワーカーが送る。
+MAIL_SMTP_HOST が未設定なら従来どおりダミー（標準出力に表示するだけ）。
+SMTP 接続は smtp_pool.SmtpPool で使い回す（送信のたびに接続・TLS・ログインをしない）。
+環境変数:
+  MAIL_SMTP_HOST / MAIL_SMTP_PORT（既定 25）/ MAIL_SMTP_USER / MAIL_SMTP_PASSWORD
+  MAIL_SMTP_STARTTLS（1 で STARTTLS）/ MAIL_SMTP_TIMEOUT（秒、既定 10）/ MAIL_FROM
+  MAIL_SMTP_POOL_SIZE（保持する接続数、既定 2）/ MAIL_SMTP_MAX_CONCURRENCY（同時送信数、既定 2）
+  MAIL_SMTP_MAX_PER_CONN（1 接続で送る通数、既定 100）/ MAIL_SMTP_IDLE_CHECK_SEC（NOOP で確認するまでの放置秒数、既定 30）
+"""
+import os
+from email.message import EmailMessage
+
+from smtp_pool import SmtpPool
+
+MAIL_SMTP_HOST = os.getenv("MAIL_SMTP_HOST", "")
+MAIL_SMTP_PORT = int(os.getenv("MAIL_SMTP_PORT", 25))
+MAIL_SMTP_USER = os.getenv("MAIL_SMTP_USER", "")
+MAIL_SMTP_PASSWORD = os.getenv("MAIL_SMTP_PASSWORD", "")
+MAIL_SMTP_STARTTLS = os.getenv("MAIL_SMTP_STARTTLS", "0") == "1"
+MAIL_SMTP_TIMEOUT = float(os.getenv("MAIL_SMTP_TIMEOUT", 10))
+MAIL_FROM = os.getenv("MAIL_FROM", "noreply@example.com")
+MAIL_SMTP_POOL_SIZE = int(os.getenv("MAIL_SMTP_POOL_SIZE", 2))
+MAIL_SMTP_MAX_CONCURRENCY = int(os.getenv("MAIL_SMTP_MAX_CONCURRENCY", 2))
+MAIL_SMTP_MAX_PER_CONN = int(os.getenv("MAIL_SMTP_MAX_PER_CONN", 100))
+MAIL_SMTP_IDLE_CHECK_SEC = float(os.getenv("MAIL_SMTP_IDLE_CHECK_SEC", 30))
+
+_pool = SmtpPool(
+    MAIL_SMTP_HOST, MAIL_SMTP_PORT,
+    user=MAIL_SMTP_USER, password=MAIL_SMTP_PASSWORD, starttls=MAIL_SMTP_STARTTLS,
+    timeout=MAIL_SMTP_TIMEOUT, max_idle=MAIL_SMTP_POOL_SIZE, max_concurrency=MAIL_SMTP_MAX_CONCURRENCY,
+    max_messages=MAIL_SMTP_MAX_PER_CONN, idle_check_sec=MAIL_SMTP_IDLE_CHECK_SEC
+) if MAIL_SMTP_HOST else None
+
+
+def _recipients(to) -> list[str]:
+    if isinstance(to, str):
+        to = to.split(",")
+    return [a.strip() for a in to if a and a.strip()]
+
+
+def _build_message(recipients, subject, body) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = MAIL_FROM
+    msg["To"] = ", ".join(recipients)
+    msg["Subject"] = subject
+    msg.set_content(body)
+    return msg
+
 
 def send_mail(to, subject, body):
     """
-    メール送信のダミー実装。
+    メールを 1 通送る。
     Args:
-        to (str|list): 宛先メールアドレス（複数対応も可）
+        to (str|list): 宛先メールアドレス（カンマ区切り文字列 or リスト）
         subject (str): 件名
         body (str): 本文
     Returns:
         dict: {'success': True/False, 'error': None or '詳細メッセージ'}
     """
+    recipients = _recipients(to)
+    if not recipients:
+        return {'success': False, 'error': '宛先がありません'}
     try:
-        # ここで実際のメール送信処理を実装する（ダミー）
-        print(f"[MAIL] To:{to} / Subject:{subject} / Body:{body}")
-        # 実際にはsmtplibやsendgrid等で送信
+        if _pool is None:
+            # SMTP 未設定（開発環境）はダミー
+            print(f"[MAIL] To:{','.join(recipients)} / Subject:{subject} / Body:{body}")
+            return {'success': True, 'error': None}
+        _pool.send(_build_message(recipients, subject, body))
         return {'success': True, 'error': None}
     except Exception as e:
         return {'success': False, 'error': str(e)}
+
+
+def transport_stats() -> dict:
+    """SMTP 接続プールの統計（送信数・再接続・送信時間など）。SMTP 未設定なら空。"""
+    return _pool.stats() if _pool else {}
+
+
+def close_transport():
+    """保持している SMTP 接続を閉じる（ワーカー終了時など）。"""
+    if _pool:
+        _pool.close_all()
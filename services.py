@@ -3,9 +3,13 @@ import os
 import json
 import sqlite3
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from functools import wraps
-from datetime import datetime, timedelta, timezone
-from flask import session, redirect, url_for, flash, g
+from flask import session, redirect, url_for, flash, g, has_app_context
+
+from db_pool import ConnectionPool
 
 # ===== logger（設定は app.py 側）=====
 logger = logging.getLogger("myapp")
@@ -21,6 +25,7 @@ with open(FIELDS_PATH, encoding='utf-8') as f:
 USER_FIELDS  = [f for f in FIELDS if not f.get('internal')]
 INDEX_FIELDS = [f for f in FIELDS if f.get('show_in_index')]
 FIELD_KEYS   = [f['key'] for f in FIELDS]
+FTS_FIELD_KEYS = [f['key'] for f in FIELDS if f.get('type') == 'text']  # item_fts（trigram）で索引する列
 
 SELECT_FIELD_PATH = os.path.join(BASE_DIR, 'select_fields.json')
 
@@ -35,64 +40,479 @@ def save_select_fields(data):
         json.dump(data, f, ensure_ascii=False, indent=2)
 
 # ===== DB接続 =====
+# 1リクエスト = 1接続（flask.g）とし、teardown でプールへ返却する。
+# 環境変数 DB_POOL_SIZE / DB_BUSY_TIMEOUT_MS で調整可。
+_pool = ConnectionPool(
+    DATABASE,
+    max_idle=int(os.getenv("DB_POOL_SIZE", 8)),
+    busy_timeout_ms=int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000)),
+)
+
 def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
-    return conn
+    if not has_app_context():
+        # アプリコンテキスト外（単体スクリプト等）は従来通り単発接続
+        return _pool.connect()
+    if "db" in g:
+        _pool.note_hit()
+        return g.db
+    g.db = _pool.acquire()
+    return g.db
+
+def close_db(exc=None):
+    """teardown_appcontext から呼ばれる。リクエストの接続をプールへ返す。"""
+    conn = g.pop("db", None)
+    if conn is not None:
+        _pool.release(conn)
+
+def get_db_stats() -> dict:
+    return _pool.stats()
+
+def begin_immediate(db):
+    """
+    書き込みロックを取って新しいトランザクションを始める（BEGIN IMMEDIATE）。commit / rollback は呼び出し側。
+    未確定の書き込みがある状態では呼ばないこと（黙って commit すると後の rollback で取り消せなくなるので例外にする）。
+    ロック下で行う書き込みは、すべてこの後に行う。
+    """
+    if db.in_transaction:
+        raise RuntimeError("begin_immediate: a transaction is already open; start the locked transaction before any writes")
+    db.execute("BEGIN IMMEDIATE")
+
+@contextmanager
+def immediate_transaction(db):
+    """
+    BEGIN IMMEDIATE で書き込みロックを先に取り、正常終了なら commit、例外なら rollback する。
+    読んでから書くまでの間に他の接続の書き込みが割り込まない。
+    """
+    begin_immediate(db)
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+# ===== サンプル数（破棄・譲渡を除いた子アイテム数。子が無ければ num_of_samples）=====
+# item.child_total / child_alive は child_item のトリガーで維持される（db_schema v4）
+SAMPLE_COUNT_EXPR = "CASE WHEN child_total = 0 THEN num_of_samples ELSE child_alive END"
+
+def attach_sample_counts(db, items):
+    """
+    items（item 行の dict のリスト）に sample_count を付与する。
+    child_total / child_alive を持つ行なら追加クエリは発生しない。
+    """
+    missing = [it["id"] for it in items if "child_total" not in it or "child_alive" not in it]
+    if missing:
+        rows = db.execute(
+            f"SELECT id, child_total, child_alive FROM item WHERE id IN ({','.join(['?']*len(missing))})",
+            missing
+        ).fetchall()
+        counts = {r["id"]: (r["child_total"], r["child_alive"]) for r in rows}
+        for it in items:
+            if it["id"] in counts:
+                it["child_total"], it["child_alive"] = counts[it["id"]]
+    for it in items:
+        if not it.get("child_total"):
+            it["sample_count"] = it.get("num_of_samples", 0)
+        else:
+            it["sample_count"] = it.get("child_alive") or 0
+    return items
+
+# ===== キーセット（カーソル）ページング =====
+def fetch_keyset_page(db, base_sql, params, per_page, after_id=None, before_id=None):
+    """
+    base_sql（id 列を持つ SELECT。ORDER BY/LIMIT なし）を id DESC 順に主キーでシークして1ページ分返す。
+      after_id  … 表示順でその id より後ろ（= id が小さい側）のページ
+      before_id … 表示順でその id より前（= id が大きい側）のページ
+    戻り値: (rows, next_after_id, prev_before_id)  ※その方向にページが無ければ None
+    """
+    if before_id is not None:
+        rows = db.execute(
+            f"SELECT * FROM ({base_sql}) AS q WHERE q.id > ? ORDER BY q.id ASC LIMIT ?",
+            [*params, before_id, per_page + 1]
+        ).fetchall()
+        has_prev = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_next = bool(rows) and db.execute(
+            f"SELECT 1 FROM ({base_sql}) AS q WHERE q.id < ? LIMIT 1",
+            [*params, rows[-1]["id"]]
+        ).fetchone() is not None
+    else:
+        cursor_sql = f"SELECT * FROM ({base_sql}) AS q"
+        cursor_params = list(params)
+        if after_id is not None:
+            cursor_sql += " WHERE q.id < ?"
+            cursor_params.append(after_id)
+        rows = db.execute(
+            cursor_sql + " ORDER BY q.id DESC LIMIT ?",
+            [*cursor_params, per_page + 1]
+        ).fetchall()
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev = bool(rows) and after_id is not None and db.execute(
+            f"SELECT 1 FROM ({base_sql}) AS q WHERE q.id > ? LIMIT 1",
+            [*params, rows[0]["id"]]
+        ).fetchone() is not None
+
+    next_after_id = rows[-1]["id"] if rows and has_next else None
+    prev_before_id = rows[0]["id"] if rows and has_prev else None
+    return rows, next_after_id, prev_before_id
+
+# ===== 申請一覧の絞り込み・並べ替え（item_application の生成列を使う）=====
+APPLICATION_KINDS = [
+    ("入庫申請中", "入庫申請"),
+    ("入庫持ち出し申請中", "入庫持ち出し申請"),
+    ("入庫持ち出し譲渡申請中", "入庫持ち出し譲渡申請"),
+    ("持ち出し申請中", "持ち出し申請"),
+    ("持ち出し譲渡申請中", "持ち出し譲渡申請"),
+    ("返却申請中", "持ち出し終了申請"),
+    ("破棄・譲渡申請中", "破棄・譲渡申請"),
+]
+APPLICATION_SORTS = {
+    "date":   ("申請日時", "application_datetime DESC, id DESC"),
+    "kind":   ("申請種別", "request_kind, application_datetime DESC, id DESC"),
+    "period": ("持ち出し期間", "checkout_start_date IS NULL, checkout_start_date, checkout_end_date, id DESC"),
+}
+
+
+def application_list_filters(args) -> tuple[list, list, str, dict]:
+    """
+    一覧のクエリ引数（kind / dispose_type / period_from / period_to / sort）から
+    (WHERE 条件のリスト, パラメータ, ORDER BY, 画面に戻す選択状態) を返す。
+    期間は持ち出し期間が [period_from, period_to] と重なる申請。
+    """
+    state = {k: (args.get(k) or "").strip() for k in ("kind", "dispose_type", "period_from", "period_to", "sort")}
+    where, params = [], []
+    if state["kind"] in dict(APPLICATION_KINDS):
+        where.append("request_kind = ?")
+        params.append(state["kind"])
+    else:
+        state["kind"] = ""
+    if state["dispose_type"] in ("破棄", "譲渡"):
+        where.append("dispose_type = ?")
+        params.append(state["dispose_type"])
+    else:
+        state["dispose_type"] = ""
+    if state["period_from"]:
+        where.append("checkout_end_date >= ?")
+        params.append(state["period_from"])
+    if state["period_to"]:
+        where.append("checkout_start_date <= ?")
+        params.append(state["period_to"])
+    if state["sort"] not in APPLICATION_SORTS:
+        state["sort"] = "date"
+    return where, params, APPLICATION_SORTS[state["sort"]][1], state
+
+# ===== 部分一致フィルタ（FTS5 trigram）=====
+FTS_MIN_CHARS = 3  # trigram は 3 文字未満の語を引けない
+
+
+def has_item_fts(db) -> bool:
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='item_fts'"
+    ).fetchone() is not None
+
+
+# ===== データ版数 & フィルタ候補キャッシュ =====
+# data_version は item / users / user_roles への書き込みでトリガーが加算する（db_schema._ensure_data_version）。
+# 版数は DB にあるので、複数ワーカープロセスでもそれぞれのキャッシュが正しく無効化される。
+_filter_choices_lock = threading.Lock()
+_filter_choices_cache = {"key": None, "choices": None}
+
+
+def get_data_versions(db, *names) -> tuple | None:
+    """data_version の版数をタプルで返す。未マイグレーションの DB では None。"""
+    try:
+        rows = db.execute(
+            f"SELECT name, version FROM data_version WHERE name IN ({','.join(['?']*len(names))})",
+            names
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return None
+    found = {r["name"]: r["version"] for r in rows}
+    return tuple(found.get(n, 0) for n in names)
+
+
+def _build_filter_choices(db) -> dict:
+    from user_directory import get_user_display_maps  # user_directory は services を import するため関数内で
+    user_display, _ = get_user_display_maps(db)
+    choices = {}
+    for f in INDEX_FIELDS:
+        col = f["key"]
+        rows = db.execute(
+            f"SELECT DISTINCT {col} FROM item WHERE {col} IS NOT NULL AND {col} != ''"
+        ).fetchall()
+        values = {str(row[col]) for row in rows if row[col] not in (None, '')}
+        # sample_manager だけは display_name（realname）で候補を返す（users に無い username はそのまま）
+        if col == "sample_manager":
+            values = {user_display.get(u, u) for u in values}
+        choices[col] = sorted(values)
+    # sample_count は実体化した子アイテム数から（child_item は読まない）
+    sample_counts = {
+        str(r[0]) for r in db.execute(f"SELECT DISTINCT {SAMPLE_COUNT_EXPR} FROM item").fetchall()
+        if r[0] not in (None, '')
+    }
+    choices["sample_count"] = sorted(sample_counts, key=lambda x: int(x) if x.isdigit() else x)
+    choices["id"] = [str(r["id"]) for r in db.execute("SELECT id FROM item ORDER BY id DESC").fetchall()]
+    return choices
+
+
+def get_filter_choices(db) -> dict:
+    """
+    一覧画面のフィルタ候補（INDEX_FIELDS 各列の DISTINCT 値 + sample_count + id）。
+    item / users の版数が変わるまではプロセス内キャッシュを返す。戻り値は呼び出し側で追記してよい。
+    """
+    key = get_data_versions(db, "item", "users")
+    with _filter_choices_lock:
+        if key is not None and _filter_choices_cache["key"] == key:
+            return dict(_filter_choices_cache["choices"])
+    choices = _build_filter_choices(db)
+    if key is not None:
+        with _filter_choices_lock:
+            _filter_choices_cache["key"] = key
+            _filter_choices_cache["choices"] = choices
+    return dict(choices)
+
 
 # ===== ロック関連 =====
+# 一括編集のロックは item_lock（item_id 主キー、expires_at は epoch 秒で索引付き）に持つ。
+# 期限切れの判定は expires_at の比較だけで行い、item テーブルには書き込まない。
 LOCK_TTL_MIN = 30
+# SQL 側の現在時刻（epoch 秒）。一覧で期限内のロックだけを表示するのに使う
+SQL_NOW_EPOCH = "((julianday('now') - 2440587.5) * 86400.0)"
 
-def _now():
-    return datetime.now(timezone.utc)
+def _now_ts() -> float:
+    return time.time()
 
-def _is_lock_expired(locked_at_str):
-    if not locked_at_str:
-        return True
-    try:
-        t = datetime.fromisoformat(locked_at_str)
-    except Exception:
-        return True
-    return (_now() - t) > timedelta(minutes=LOCK_TTL_MIN)
+def expire_locks(db, now: float = None) -> int:
+    """期限切れロックを 1 文で削除（idx_item_lock_expires）。削除件数を返す（commit は呼び出し側）。"""
+    cur = db.execute("DELETE FROM item_lock WHERE expires_at < ?", (now or _now_ts(),))
+    return cur.rowcount
 
 def acquire_locks(db, ids, username):
+    """
+    ids のロックをまとめて取得する（全件取れたときだけ確定）。戻り値は (ok, blocked_ids)。
+    BEGIN IMMEDIATE の中で 1 文の UPSERT を流し、
+      - 未ロック                 → INSERT
+      - 自分のロック / 期限切れ → 取り直し（UPDATE）
+      - 他人の期限内ロック      → ON CONFLICT の WHERE で更新されない
+    RETURNING に出てこなかった ID（存在しない ID を含む）が blocked。1 件でもあればロールバックする。
+    """
     blocked = []
     norm_ids = []
     for item_id in ids:
         try:
-            item_id = int(item_id)
+            norm_ids.append(int(item_id))
         except Exception:
-            blocked.append(str(item_id)); continue
-        norm_ids.append(item_id)
-        row = db.execute("SELECT locked_by, locked_at FROM item WHERE id=?", (item_id,)).fetchone()
-        if not row:
-            blocked.append(str(item_id)); continue
-        lb, la = row["locked_by"], row["locked_at"]
-        if lb and not _is_lock_expired(la) and lb != username:
             blocked.append(str(item_id))
+    norm_ids = list(dict.fromkeys(norm_ids))
+    if not norm_ids:
+        return not blocked, blocked
+
+    username = str(username or "")
+    now = _now_ts()
+    ph = ",".join(["?"] * len(norm_ids))
+    begin_immediate(db)
+    try:
+        acquired = {r[0] for r in db.execute(
+            f"""
+            INSERT INTO item_lock (item_id, locked_by, locked_at, expires_at)
+            SELECT id, ?, ?, ? FROM item WHERE id IN ({ph})
+            ON CONFLICT(item_id) DO UPDATE
+               SET locked_by = excluded.locked_by,
+                   locked_at = excluded.locked_at,
+                   expires_at = excluded.expires_at
+             WHERE item_lock.locked_by = excluded.locked_by OR item_lock.expires_at < ?
+            RETURNING item_id
+            """,
+            [username, now, now + LOCK_TTL_MIN * 60] + norm_ids + [now]
+        )}
+    except Exception:
+        db.rollback()
+        raise
+    blocked += [str(i) for i in norm_ids if i not in acquired]
     if blocked:
+        db.rollback()
         return False, blocked
-    now = _now().isoformat()
-    for item_id in norm_ids:
-        db.execute("UPDATE item SET locked_by=?, locked_at=? WHERE id=?", (str(username or ""), now, item_id))
     db.commit()
     return True, []
 
 def release_locks(db, ids):
-    for item_id in ids:
-        db.execute("UPDATE item SET locked_by=NULL, locked_at=NULL WHERE id=?", (item_id,))
+    """ids のロックを 1 文で解除して commit。"""
+    ids = [int(i) for i in ids]
+    if ids:
+        db.execute(f"DELETE FROM item_lock WHERE item_id IN ({','.join(['?'] * len(ids))})", ids)
     db.commit()
 
-def _cleanup_expired_locks(db):
+def get_locked_ids(db, username) -> list[int]:
+    """username が保持している（期限内の）ロックの item_id 一覧。"""
     rows = db.execute(
-        "SELECT id, locked_at FROM item WHERE locked_by IS NOT NULL AND locked_by != ''"
+        "SELECT item_id FROM item_lock WHERE locked_by = ? AND expires_at >= ?",
+        (username, _now_ts())
     ).fetchall()
-    expired_ids = [r["id"] for r in rows if _is_lock_expired(r["locked_at"])]
-    if expired_ids:
-        ph = ",".join(["?"]*len(expired_ids))
-        db.execute(f"UPDATE item SET locked_by=NULL, locked_at=NULL WHERE id IN ({ph})", expired_ids)
-        db.commit()
+    return [r["item_id"] for r in rows]
+
+# ===== 状態遷移（申請・変更の確定）=====
+def transition_items(db, ids, allowed, new_status: str = None, values: dict = None) -> dict[int, dict]:
+    """
+    item.status が allowed のものだけを new_status（と values の列）に変え、動いた item の
+    変更前の行を {id: dict} で返す。new_status も values もなければ変更せず、許可状態の行を返すだけ。
+    BEGIN IMMEDIATE で書き込みロックを取ってから読むので、返した行と実際に更新された行は必ず一致し、
+    commit までの間に他の接続が状態を変えることもない（更新直前の再確認は不要）。
+    commit / rollback は呼び出し側（申請の登録やメールと同じトランザクションにするため）。
+    トランザクションはここで始まるので、その前に書き込みをしないこと（あれば RuntimeError）。
+    ※ SQLite の RETURNING は更新後の値しか返せないので、変更前の行はロック下の SELECT で取る。
+    """
+    norm_ids = []
+    for item_id in ids:
+        try:
+            norm_ids.append(int(item_id))
+        except (TypeError, ValueError):
+            continue
+    norm_ids = list(dict.fromkeys(norm_ids))
+    sets = dict(values or {})
+    if new_status is not None:
+        sets["status"] = new_status
+    unknown = [k for k in sets if k not in FIELD_KEYS]
+    if unknown:
+        raise ValueError(f"unknown item columns: {unknown}")
+    if not norm_ids:
+        return {}
+
+    begin_immediate(db)
+    allowed = list(allowed)
+    id_ph = ",".join(["?"] * len(norm_ids))
+    st_ph = ",".join(["?"] * len(allowed))
+    before = {
+        r["id"]: dict(r) for r in db.execute(
+            f"SELECT * FROM item WHERE id IN ({id_ph}) AND status IN ({st_ph})", norm_ids + allowed
+        )
+    }
+    if before and sets:
+        cols = list(sets)
+        moved_ph = ",".join(["?"] * len(before))
+        moved = {r["id"] for r in db.execute(
+            f"UPDATE item SET {', '.join(f'{k}=?' for k in cols)} "
+            f"WHERE id IN ({moved_ph}) AND status IN ({st_ph}) RETURNING id",
+            [sets[k] for k in cols] + list(before) + allowed
+        )}
+        before = {i: row for i, row in before.items() if i in moved}
+    return before
+
+
+def insert_applications(db, payloads, applicant: str, approver: str, applicant_comment: str, now_str: str) -> int:
+    """
+    申請（item_application）をまとめて登録する。payloads は [(item_id, new_values(dict), original_status), ...]。
+    JSON 化はここで行い、INSERT は executemany の 1 文（件数に比例して文が増えない）。
+    transition_items と同じトランザクションで呼ぶ想定で、commit は呼び出し側。
+    """
+    rows = [
+        (item_id, json.dumps(new_values, ensure_ascii=False), applicant, applicant_comment,
+         approver, "申請中", now_str, original_status)
+        for item_id, new_values, original_status in payloads
+    ]
+    if rows:
+        db.executemany('''
+            INSERT INTO item_application
+            (item_id, new_values, applicant, applicant_comment, approver, status, application_datetime, original_status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    return len(rows)
+
+# ===== 申請内容（new_values）=====
+# new_values には「申請で変わる item の列」と申請固有のキー（期間・所有者・破棄内容など）に加え、
+# 申請時点の item を識別する列（製品名・製品情報）とサンプル数のスナップショットを持つ。
+# それ以外の item の列は持たず、申請中のものだけ表示時に現在の item 行へ重ねて復元する。
+# 処理済み（承認・差し戻し・取消）の申請や item が削除された申請は、new_values（申請時点の内容）のまま表示する。
+APPLICATION_ITEM_KEYS = {
+    "入庫申請中":             ("status", "sample_manager"),
+    "入庫持ち出し申請中":     ("status", "sample_manager"),
+    "入庫持ち出し譲渡申請中": ("status", "sample_manager"),
+    "持ち出し申請中":         ("status", "sample_manager"),
+    "持ち出し譲渡申請中":     ("status", "sample_manager"),
+    "返却申請中":             ("status", "storage"),
+    "破棄・譲渡申請中":       ("status",),
+}
+
+# 申請時点の値を new_values に残す列（識別用の製品名・製品情報と、所有者の既定に使うサンプル数）。
+# 承認時に item へは書き戻さない
+APPLICATION_SNAPSHOT_KEYS = (
+    "product_name", "product_info1", "product_info2", "product_info3", "product_info4", "num_of_samples",
+)
+
+
+def application_snapshot(item: dict) -> dict:
+    """item 行から new_values に残す識別用の列（申請時点の値）を取り出す。"""
+    return {k: item.get(k) for k in APPLICATION_SNAPSHOT_KEYS if k in item}
+
+
+def parse_application_values(db, apps) -> list[dict]:
+    """
+    apps（item_application 行の dict のリスト）に parsed_values を付与する。壊れた JSON は {}。
+    申請中のものは現在の item 行に new_values を重ねる（item は全件 1 クエリ。識別用の列は現在の値）。
+    処理済みの申請と item が削除された申請は new_values のまま（申請時点のスナップショットと申請内容）。
+    """
+    for app in apps:
+        try:
+            app['parsed_values'] = json.loads(app.get('new_values') or "{}")
+        except Exception:
+            app['parsed_values'] = {}
+    pending = [
+        app for app in apps
+        if app.get('status') == '申請中' and app.get('item_id') is not None and isinstance(app['parsed_values'], dict)
+    ]
+    ids = list({app['item_id'] for app in pending})
+    if ids:
+        items = {
+            r["id"]: dict(r) for r in db.execute(
+                f"SELECT * FROM item WHERE id IN ({','.join(['?']*len(ids))})", ids
+            )
+        }
+        for app in pending:
+            item = items.get(app['item_id'])
+            if item:
+                changes = {k: v for k, v in app['parsed_values'].items() if k not in APPLICATION_SNAPSHOT_KEYS}
+                app['parsed_values'] = {**item, **changes}
+    return apps
+
+# ===== ログインユーザーのキャッシュ =====
+# load_logged_in_user（app.py）が毎リクエスト引く users の行とロールを、セッションのユーザーごとに短時間だけ覚える。
+# このプロセスでの変更（ユーザー登録・編集・ログイン）は forget_session_user() ですぐに捨てる。
+# 他のワーカーでの変更は SESSION_USER_TTL_SEC（秒）以内に反映される。
+SESSION_USER_TTL_SEC = float(os.getenv("SESSION_USER_TTL_SEC", 30))
+_SESSION_USER_MAX = 1024
+_session_user_lock = threading.Lock()
+_session_user_cache = {}   # user_id -> (期限 monotonic, users 行, frozenset(ロール名))
+
+
+def load_session_user(db, user_id):
+    """(users 行 or None, frozenset(ロール名)) を返す。TTL 内はキャッシュから（クエリなし）。"""
+    now = time.monotonic()
+    with _session_user_lock:
+        hit = _session_user_cache.get(user_id)
+        if hit and hit[0] > now:
+            return hit[1], hit[2]
+    user = db.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
+    roles = frozenset(r['name'] for r in db.execute("""
+        SELECT roles.name FROM roles
+        JOIN user_roles ON roles.id = user_roles.role_id
+        WHERE user_roles.user_id=?
+    """, (user_id,)))
+    if user is not None:
+        with _session_user_lock:
+            if len(_session_user_cache) >= _SESSION_USER_MAX:
+                for k in [k for k, v in _session_user_cache.items() if v[0] <= now]:
+                    del _session_user_cache[k]
+            _session_user_cache[user_id] = (now + SESSION_USER_TTL_SEC, user, roles)
+    return user, roles
+
+
+def forget_session_user(user_id=None):
+    """user_id のキャッシュを捨てる（None なら全員分）。"""
+    with _session_user_lock:
+        if user_id is None:
+            _session_user_cache.clear()
+        else:
+            _session_user_cache.pop(user_id, None)
 
 # ===== 認可/認証デコレータ =====
 def login_required(f):
@@ -104,101 +524,14 @@ def login_required(f):
     return decorated
 
 def roles_required(*roles):
+    required = frozenset(roles)
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            user_roles = getattr(g, 'user_roles', [])
-            if not any(role in user_roles for role in roles):
+            user_roles = getattr(g, 'user_roles', frozenset())
+            if required.isdisjoint(user_roles):
                 flash('権限がありません')
                 return redirect(url_for('index_bp.index'))  # _urlfor_compat がテンプレで効いていればOK
             return func(*args, **kwargs)
         return wrapper
     return decorator
-
-def get_managers_by_department(department=None, db=None):
-    if db is None:
-        db = get_db()
-    query = """
-        SELECT u.username, u.realname, u.department
-        FROM users u
-        JOIN user_roles ur ON u.id = ur.user_id
-        JOIN roles r ON ur.role_id = r.id
-        WHERE r.name = 'manager'
-    """
-    params = []
-    if department:
-        query += " AND u.department = ?"
-        params.append(department)
-    query += " ORDER BY u.department, u.realname"
-    rows = db.execute(query, params).fetchall()
-    return [{'username': row['username'], 'realname': row['realname'], 'department': row['department']} for row in rows]
-
-def get_proper_users(db):
-    return [
-        dict(
-            username=row['username'],
-            realname=row['realname'],
-            department=row['department'],
-            email=row['email']
-        )
-        for row in db.execute(
-            """SELECT u.username, u.realname, u.department, u.email
-                 FROM users u
-                 JOIN user_roles ur ON u.id = ur.user_id
-                 JOIN roles r ON ur.role_id = r.id
-                WHERE r.name = 'proper'
-             ORDER BY u.department, u.username"""
-        )
-    ]
-
-def get_partner_users(db):
-    return [
-        dict(
-            username=row['username'],
-            realname=row['realname'],
-            department=row['department'],
-            email=row['email']
-        )
-        for row in db.execute(
-            """SELECT u.username, u.realname, u.department, u.email
-                 FROM users u
-                 JOIN user_roles ur ON u.id = ur.user_id
-                 JOIN roles r ON ur.role_id = r.id
-                WHERE r.name = 'partner'
-             ORDER BY u.department, u.username"""
-        )
-    ]
-
-def get_user_profile(db, username: str) -> dict:
-    row = db.execute(
-        "SELECT username, email, realname, department FROM users WHERE username = ?",
-        (username,)
-    ).fetchone()
-    if not row:
-        return {"username": username, "email": "", "realname": "", "department": ""}
-    return {
-        "username": row["username"],
-        "email": row["email"] or "",
-        "realname": row["realname"] or "",
-        "department": row["department"] or ""
-    }
-
-def get_user_profiles(db, usernames: list[str]) -> dict[str, dict]:
-    if not usernames:
-        return {}
-    placeholders = ",".join(["?"] * len(usernames))
-    rows = db.execute(
-        f"SELECT username, email, realname, department FROM users WHERE username IN ({placeholders})",
-        list(usernames)
-    ).fetchall()
-    found = {
-        r["username"]: {
-            "username": r["username"],
-            "email": r["email"] or "",
-            "realname": r["realname"] or "",
-            "department": r["department"] or ""
-        } for r in rows
-    }
-    for u in usernames:
-        found.setdefault(u, {"username": u, "email": "", "realname": "", "department": ""})
-    return found
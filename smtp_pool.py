@@ -0,0 +1,177 @@
+# smtp_pool.py
+import os
+import time
+import smtplib
+import threading
+
+
+class SmtpPool:
+    """
+    認証済みの SMTP 接続を使い回すための小さなプール（send_mail から使う）。
+      - 接続（TLS・ログイン込み）は空きを max_idle 本まで保持し、次の送信で再利用
+      - 1 接続で max_messages 通送ったら閉じて張り直す（サーバー側の上限対策）
+      - idle_check_sec 以上使っていない接続は NOOP で生存確認してから使う
+      - 再利用した接続が切れていたら 1 回だけ新しい接続で送り直す
+      - 同時に送る数は max_concurrency で制限
+      - fork 後（pid が変わった場合）は親プロセスの接続を捨てて作り直す
+    """
+
+    def __init__(self, host: str, port: int = 25, *, user: str = "", password: str = "",
+                 starttls: bool = False, timeout: float = 10.0, max_idle: int = 2,
+                 max_concurrency: int = 2, max_messages: int = 100, idle_check_sec: float = 30.0):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_concurrency = max_concurrency
+        self.max_messages = max_messages
+        self.idle_check_sec = idle_check_sec
+        self._sem = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._idle = []          # [[smtp, 送信数, 最終使用時刻], ...]
+        self._pid = os.getpid()
+        self._stats = {
+            "sends": 0, "failures": 0, "opens": 0, "reuses": 0, "closes": 0,
+            "reconnects": 0, "health_check_failures": 0, "in_use": 0,
+            "latency_ms_total": 0.0, "latency_ms_max": 0.0, "latency_ms_last": 0.0,
+        }
+
+    # --------- 内部 ---------
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+        except Exception:
+            self._close(smtp)
+            raise
+        return smtp
+
+    def _close(self, smtp):
+        with self._lock:
+            self._stats["closes"] += 1
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _check_fork(self):
+        """fork 先では親の接続を共有しない（ロック保持中に呼ぶこと）。"""
+        pid = os.getpid()
+        if pid != self._pid:
+            self._idle = []
+            self._pid = pid
+
+    def _healthy(self, entry) -> bool:
+        if time.monotonic() - entry[2] < self.idle_check_sec:
+            return True
+        try:
+            return entry[0].noop()[0] == 250
+        except Exception:
+            return False
+
+    def _acquire(self):
+        """[smtp, 送信数, 最終使用時刻] と、再利用かどうかを返す。"""
+        while True:
+            with self._lock:
+                self._check_fork()
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                break
+            if self._healthy(entry):
+                with self._lock:
+                    self._stats["reuses"] += 1
+                return entry, True
+            with self._lock:
+                self._stats["health_check_failures"] += 1
+            self._close(entry[0])
+        smtp = self._open()
+        with self._lock:
+            self._stats["opens"] += 1
+        return [smtp, 0, time.monotonic()], False
+
+    def _release(self, entry):
+        entry[2] = time.monotonic()
+        with self._lock:
+            if entry[1] < self.max_messages and os.getpid() == self._pid and len(self._idle) < self.max_idle:
+                self._idle.append(entry)
+                return
+        self._close(entry[0])
+
+    # --------- 公開 ---------
+    def send(self, msg):
+        """EmailMessage を 1 通送る。失敗したら例外（呼び出し側で捕捉）。"""
+        with self._sem:
+            with self._lock:
+                self._stats["in_use"] += 1
+            t0 = time.perf_counter()
+            try:
+                self._send(msg)
+            except Exception:
+                with self._lock:
+                    self._stats["failures"] += 1
+                raise
+            finally:
+                with self._lock:
+                    self._stats["in_use"] -= 1
+            ms = (time.perf_counter() - t0) * 1000
+            with self._lock:
+                self._stats["sends"] += 1
+                self._stats["latency_ms_total"] += ms
+                self._stats["latency_ms_last"] = ms
+                self._stats["latency_ms_max"] = max(self._stats["latency_ms_max"], ms)
+
+    def _send(self, msg):
+        entry, reused = self._acquire()
+        try:
+            entry[0].send_message(msg)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # 宛先拒否などサーバーの応答エラー。接続は RSET して使い続ける
+            try:
+                entry[0].rset()
+            except Exception:
+                self._close(entry[0])
+                raise
+            self._release(entry)
+            raise
+        except OSError:
+            # 使い回した接続がサーバー側で切られていた → 新しい接続で 1 回だけ送り直す
+            # （smtplib の例外は OSError の派生。応答エラーは上で処理済み）
+            self._close(entry[0])
+            if not reused:
+                raise
+            with self._lock:
+                self._stats["reconnects"] += 1
+            entry = [self._open(), 0, time.monotonic()]
+            with self._lock:
+                self._stats["opens"] += 1
+            try:
+                entry[0].send_message(msg)
+            except Exception:
+                self._close(entry[0])
+                raise
+        entry[1] += 1
+        self._release(entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats, idle=len(self._idle), max_idle=self.max_idle,
+                     max_concurrency=self.max_concurrency, pid=self._pid)
+        s["latency_ms_avg"] = round(s.pop("latency_ms_total") / s["sends"], 1) if s["sends"] else 0.0
+        s["latency_ms_max"] = round(s["latency_ms_max"], 1)
+        s["latency_ms_last"] = round(s["latency_ms_last"], 1)
+        return s
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._close(entry[0])
@@ -0,0 +1,98 @@
+# tests/conftest.py
+# テスト共通のアプリ（一時ディレクトリに init-db した空の DB。セッションで 1 つ）
+import os
+import sys
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    # items.db / app.log はカレントディレクトリに作られるので、一時ディレクトリで動かす
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    os.environ["MAIL_WORKER"] = "off"
+    os.environ["MAINTENANCE_SCHEDULER"] = "off"
+    os.environ["LOG_LEVEL"] = "WARNING"
+    sys.path.insert(0, ROOT)
+    from app import app as flask_app
+    import db_schema
+    from services import get_db
+
+    flask_app.config["TESTING"] = True
+    with flask_app.app_context():
+        db_schema.init_db()
+        db_schema.seed_minimal()
+        db_schema.upgrade()
+        db = get_db()
+        for username, role in (("mgr", "manager"), ("prop", "proper")):
+            db.execute(
+                "INSERT INTO users (username, password, email, department, realname) VALUES (?, ?, ?, ?, ?)",
+                (username, generate_password_hash("pw"), f"{username}@example.com", "開発部", username)
+            )
+            db.execute("""
+                INSERT INTO user_roles (user_id, role_id)
+                SELECT u.id, r.id FROM users u, roles r WHERE u.username = ? AND r.name = ?
+            """, (username, role))
+        db.commit()
+    yield flask_app
+    os.chdir(cwd)
+
+
+class _SmtpHandler:
+    """aiosmtpd のハンドラ。受け取ったメールを記録し、指定の宛先・NOOP を拒否できる。"""
+
+    def __init__(self):
+        self.messages = []        # [{"peer", "rcpt_tos", "subject"}, ...]
+        self.reject_rcpt = set()  # この宛先は 451（一時エラー）で拒否
+        self.noop_status = None   # "421 ..." などを入れると NOOP がその応答になる
+        self.data_delay = 0.0     # DATA の応答を遅らせる秒数（同時送信数の確認用）
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.reject_rcpt:
+            return "451 4.3.0 try again later"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_NOOP(self, server, session, envelope, arg):
+        return self.noop_status or "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        import asyncio
+        from email import message_from_bytes, policy
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.data_delay:
+                await asyncio.sleep(self.data_delay)
+            self.messages.append({
+                "peer": session.peer,
+                "rcpt_tos": list(envelope.rcpt_tos),
+                "subject": str(message_from_bytes(envelope.content, policy=policy.default)["Subject"]),
+            })
+        finally:
+            self.in_flight -= 1
+        return "250 Message accepted"
+
+
+@pytest.fixture
+def smtp_server():
+    """ローカルの SMTP サーバー（aiosmtpd）。handler と host / port を返す。"""
+    import socket
+    controller_mod = pytest.importorskip("aiosmtpd.controller")
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    handler = _SmtpHandler()
+    controller = controller_mod.Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    handler.host, handler.port = "127.0.0.1", port
+    yield handler
+    controller.stop()
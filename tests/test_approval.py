@@ -0,0 +1,97 @@
+# tests/test_approval.py
+# 申請 → 承認の通し確認（空の DB に init-db した状態から）
+
+
+def _add_item(app, num_of_samples):
+    from services import get_db
+    with app.app_context():
+        db = get_db()
+        item_id = db.execute(
+            "INSERT INTO item (product_name, num_of_samples, sample_manager, status) VALUES (?, ?, ?, ?)",
+            ("製品", str(num_of_samples), "prop", "保管中")
+        ).lastrowid
+        db.commit()
+    return item_id
+
+
+def _login(app, username, password="pw"):
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": password})
+    return client
+
+
+def _checkout_and_approve(app, item_id, owners):
+    applicant = _login(app, "admin", "adminpass")
+    r = applicant.get("/checkout_request", query_string={
+        "action": "submit", "item_id": item_id, "manager": "prop", "approver": "mgr", "qty_checked": "1",
+        "start_date": "2025-02-01", "end_date": "2025-03-01", f"owner_list_{item_id}": owners,
+    })
+    assert r.status_code == 302
+
+    from services import get_db
+    with app.app_context():
+        app_id = get_db().execute(
+            "SELECT id FROM item_application WHERE item_id=? AND status='申請中'", (item_id,)
+        ).fetchone()["id"]
+
+    approver = _login(app, "mgr")
+    assert approver.get("/approval").status_code == 200
+    r = approver.post("/approval", data={"selected_ids": [str(app_id)], "action": "approve"})
+    assert r.status_code == 200
+
+    with app.app_context():
+        db = get_db()
+        item = db.execute("SELECT status, child_total FROM item WHERE id=?", (item_id,)).fetchone()
+        children = [
+            (r["branch_no"], r["owner"])
+            for r in db.execute("SELECT branch_no, owner FROM child_item WHERE item_id=? ORDER BY branch_no", (item_id,))
+        ]
+        app_status = db.execute("SELECT status FROM item_application WHERE id=?", (app_id,)).fetchone()["status"]
+    return item, children, app_status
+
+
+def test_approve_checkout_application(app):
+    item_id = _add_item(app, 3)
+    item, children, app_status = _checkout_and_approve(app, item_id, ["prop", "prop", "mgr"])
+    assert app_status == "承認"
+    assert item["status"] == "持ち出し中"
+    assert children == [(1, "prop"), (2, "prop"), (3, "mgr")]
+
+
+def test_approve_checkout_without_owners_uses_num_of_samples(app):
+    # 所有者未入力ならサンプル数ぶん管理者の枝番（new_values は差分なので num_of_samples は item から）
+    item_id = _add_item(app, 3)
+    item, children, app_status = _checkout_and_approve(app, item_id, [])
+    assert app_status == "承認"
+    assert item["child_total"] == 3
+    assert children == [(1, "prop"), (2, "prop"), (3, "prop")]
+
+
+def test_processed_application_keeps_snapshot(app):
+    # 申請後に item を編集しても、承認済みの申請は申請時点の製品名で表示（承認で item へは書き戻さない）
+    from services import get_db, parse_application_values
+    item_id = _add_item(app, 1)
+    applicant = _login(app, "admin", "adminpass")
+    applicant.get("/checkout_request", query_string={
+        "action": "submit", "item_id": item_id, "manager": "prop", "approver": "mgr", "qty_checked": "1",
+        "start_date": "2025-02-01", "end_date": "2025-03-01",
+    })
+    with app.app_context():
+        db = get_db()
+        app_id = db.execute("SELECT id FROM item_application WHERE item_id=?", (item_id,)).fetchone()["id"]
+        db.execute("UPDATE item SET product_name=? WHERE id=?", ("改名後", item_id))
+        db.commit()
+        row = dict(db.execute("SELECT * FROM item_application WHERE id=?", (app_id,)).fetchone())
+        assert parse_application_values(db, [row])[0]["parsed_values"]["product_name"] == "改名後"
+
+    _login(app, "mgr").post("/approval", data={"selected_ids": [str(app_id)], "action": "approve"})
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute("SELECT product_name FROM item WHERE id=?", (item_id,)).fetchone()["product_name"] == "改名後"
+        db.execute("DELETE FROM item WHERE id=?", (item_id,))
+        db.commit()
+        row = dict(db.execute("SELECT * FROM item_application WHERE id=?", (app_id,)).fetchone())
+        assert row["status"] == "承認" and row["item_id"] is None
+        pv = parse_application_values(db, [row])[0]["parsed_values"]
+        assert (pv["product_name"], pv["status"]) == ("製品", "持ち出し申請中")
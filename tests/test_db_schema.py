@@ -0,0 +1,27 @@
+# tests/test_db_schema.py
+# init-db / upgrade は既存の申請（監査ログ）を書き換えない
+import json
+
+
+def test_init_db_keeps_existing_application_payloads(app):
+    import db_schema
+    from services import get_db
+    legacy = {"id": 1, "product_name": "旧製品", "product_info1": "A", "storage": "棚1", "status": "返却申請中",
+              "return_date": "2025-01-10"}
+    with app.app_context():
+        db = get_db()
+        app_ids = [
+            db.execute("""
+                INSERT INTO item_application (item_id, new_values, applicant, status, application_datetime)
+                VALUES (?, ?, 'prop', ?, '2025-01-01 00:00:00')
+            """, (item_id, json.dumps(legacy, ensure_ascii=False), status)).lastrowid
+            for item_id, status in ((None, "承認"), (None, "申請中"))
+        ]
+        db.commit()
+        db_schema.init_db()
+        db_schema.upgrade()
+        stored = [
+            json.loads(db.execute("SELECT new_values FROM item_application WHERE id=?", (i,)).fetchone()[0])
+            for i in app_ids
+        ]
+    assert stored == [legacy, legacy]
@@ -0,0 +1,32 @@
+# tests/test_index.py
+# 一覧のページ送り（番号付きページとカーソルのどちらか一方だけを表示）
+
+
+def _login(app, username="admin", password="adminpass"):
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": password})
+    return client
+
+
+def _seed_items(app, n):
+    from services import get_db
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO item (product_name, num_of_samples, sample_manager, status) VALUES (?, '1', 'prop', '保管中')",
+            [(f"一覧{i}",) for i in range(n)]
+        )
+        db.commit()
+
+
+def test_index_pagination_shows_only_active_mode(app):
+    _seed_items(app, 25)
+    client = _login(app)
+
+    html = client.get("/", query_string={"per_page": 10}).get_data(as_text=True)
+    assert "page=2" in html
+    assert "after_id=" not in html
+
+    html = client.get("/", query_string={"per_page": 10, "after_id": 10 ** 9}).get_data(as_text=True)
+    assert "after_id=" in html
+    assert "page=2" not in html
@@ -0,0 +1,18 @@
+# tests/test_item_export.py
+# Excel 出力（write-only ブックへの流し込み）
+import io
+
+
+def test_write_xlsx_streams_rows(app):
+    from openpyxl import load_workbook
+    from item_export import write_xlsx, export_headers
+
+    width = len(export_headers())
+    rows = ([i] + ["値"] * (width - 2) + [str(i)] for i in range(3, 0, -1))
+    buf = io.BytesIO()
+    assert write_xlsx(rows, buf) == 3
+
+    buf.seek(0)
+    ws = load_workbook(buf).active
+    assert [c.value for c in ws[1]] == export_headers()
+    assert [ws.cell(row=r, column=1).value for r in range(2, 5)] == [3, 2, 1]
@@ -0,0 +1,107 @@
+# tests/test_mail_outbox.py
+# メール送信キュー（ローカルの SMTP サーバーに対してワーカーの処理を通す）
+import time
+
+import pytest
+
+import mail_outbox
+import send_mail
+from smtp_pool import SmtpPool
+
+
+@pytest.fixture
+def outbox(app, smtp_server, monkeypatch):
+    """空の mail_outbox と、ローカル SMTP サーバーへ送るトランスポート。"""
+    from services import get_db
+    pool = SmtpPool(smtp_server.host, smtp_server.port)
+    monkeypatch.setattr(send_mail, "_pool", pool)
+    with app.app_context():
+        db = get_db()
+        db.execute("DELETE FROM mail_outbox")
+        db.commit()
+        yield db
+    pool.close_all()
+
+
+def _row(db, mail_id):
+    return db.execute("SELECT * FROM mail_outbox WHERE id=?", (mail_id,)).fetchone()
+
+
+def test_deliver_pending_sends_queued_mail(outbox, smtp_server):
+    db = outbox
+    first = mail_outbox.enqueue_mail(db, ["a@example.com", "", "b@example.com"], "件名1", "本文1")
+    second = mail_outbox.enqueue_mail(db, "c@example.com", "件名2", "本文2")
+    assert mail_outbox.enqueue_mail(db, " , ", "宛先なし", "本文") is None
+    db.commit()
+
+    assert mail_outbox.deliver_pending(db) == {"sent": 2, "retry": 0, "failed": 0}
+    assert [(m["rcpt_tos"], m["subject"]) for m in smtp_server.messages] == [
+        (["a@example.com", "b@example.com"], "件名1"),
+        (["c@example.com"], "件名2"),
+    ]
+    for mail_id in (first, second):
+        row = _row(db, mail_id)
+        assert (row["status"], row["attempts"], row["last_error"]) == ("sent", 1, None)
+        assert row["sent_at"] is not None
+    # 送り終えたら取り出すものはない
+    assert mail_outbox.deliver_pending(db) == {"sent": 0, "retry": 0, "failed": 0}
+
+    status = mail_outbox.outbox_status(db)
+    assert status["counts"] == {"sent": 2}
+    assert [r["id"] for r in status["recent"]] == [second, first]
+    assert "body" not in status["recent"][0]
+    assert status["transport"]["sends"] == 2
+
+    # 保持期間を過ぎた送信済みは削除
+    assert mail_outbox.prune_sent(db) == 0
+    assert mail_outbox.prune_sent(db, now=time.time() + mail_outbox.MAIL_KEEP_DAYS * 86400 + 60) == 2
+    db.commit()
+
+
+def test_claim_takes_each_mail_once(outbox):
+    db = outbox
+    mail_id = mail_outbox.enqueue_mail(db, "a@example.com", "件名", "本文")
+    db.commit()
+    claimed = mail_outbox._claim(db, 10)
+    assert [r["id"] for r in claimed] == [mail_id]
+    # sending の間（MAIL_SENDING_TIMEOUT_SEC まで）は他のワーカーが取り出さない
+    assert mail_outbox._claim(db, 10) == []
+    row = _row(db, mail_id)
+    assert (row["status"], row["attempts"]) == ("sending", 1)
+
+
+def test_failed_delivery_is_retried_with_backoff(outbox, smtp_server, monkeypatch):
+    db = outbox
+    monkeypatch.setattr(mail_outbox, "MAIL_MAX_ATTEMPTS", 3)
+    smtp_server.reject_rcpt.add("busy@example.com")
+    mail_id = mail_outbox.enqueue_mail(db, "busy@example.com", "再送", "本文")
+    db.commit()
+
+    for attempt in (1, 2):
+        before = time.time()
+        assert mail_outbox.deliver_pending(db) == {"sent": 0, "retry": 1, "failed": 0}
+        row = _row(db, mail_id)
+        assert (row["status"], row["attempts"]) == ("pending", attempt)
+        assert "451" in row["last_error"]
+        delay = mail_outbox.MAIL_RETRY_BASE_SEC * 2 ** (attempt - 1)
+        assert before + delay <= row["next_attempt_at"] <= time.time() + delay
+        # 待ち時間の間は送らない
+        assert mail_outbox.deliver_pending(db) == {"sent": 0, "retry": 0, "failed": 0}
+        db.execute("UPDATE mail_outbox SET next_attempt_at = 0 WHERE id=?", (mail_id,))
+        db.commit()
+
+    # MAIL_MAX_ATTEMPTS 回目の失敗で failed
+    assert mail_outbox.deliver_pending(db) == {"sent": 0, "retry": 0, "failed": 1}
+    row = _row(db, mail_id)
+    assert (row["status"], row["attempts"]) == ("failed", 3)
+    assert "451" in row["last_error"]
+    assert smtp_server.messages == []
+    assert mail_outbox.outbox_status(db)["counts"] == {"failed": 1}
+
+    # 手動で戻すと送信待ちになり、受け付けられれば送られる
+    smtp_server.reject_rcpt.clear()
+    assert mail_outbox.retry_failed(db) == 1
+    db.commit()
+    assert mail_outbox.drain(db) == {"sent": 1, "retry": 0, "failed": 0}
+    assert _row(db, mail_id)["status"] == "sent"
+    assert [m["subject"] for m in smtp_server.messages] == ["再送"]
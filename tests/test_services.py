@@ -0,0 +1,60 @@
+# tests/test_services.py
+# 書き込みロック（BEGIN IMMEDIATE）を取るトランザクションの境界
+import pytest
+
+
+def _add_item(db, status="保管中"):
+    item_id = db.execute(
+        "INSERT INTO item (product_name, num_of_samples, sample_manager, status) VALUES (?, ?, ?, ?)",
+        ("製品", "1", "prop", status)
+    ).lastrowid
+    db.commit()
+    return item_id
+
+
+def test_transition_items_rollback_undoes_transition(app):
+    from services import get_db, transition_items
+    with app.app_context():
+        db = get_db()
+        item_id = _add_item(db)
+        moved = transition_items(db, [item_id], ["保管中"], "返却申請中")
+        assert list(moved) == [item_id]
+        assert moved[item_id]["status"] == "保管中"
+        db.rollback()
+        assert db.execute("SELECT status FROM item WHERE id=?", (item_id,)).fetchone()["status"] == "保管中"
+
+
+def test_begin_immediate_refuses_pending_writes(app):
+    # 先に書き込みがあると黙って commit せず例外（呼び出し側の rollback で取り消せるまま）
+    from services import get_db, transition_items, acquire_locks
+    with app.app_context():
+        db = get_db()
+        item_id = _add_item(db)
+        db.execute("UPDATE item SET storage=? WHERE id=?", ("棚A", item_id))
+        with pytest.raises(RuntimeError):
+            transition_items(db, [item_id], ["保管中"], "返却申請中")
+        with pytest.raises(RuntimeError):
+            acquire_locks(db, [item_id], "prop")
+        db.rollback()
+        row = db.execute("SELECT status, storage FROM item WHERE id=?", (item_id,)).fetchone()
+        assert (row["status"], row["storage"]) == ("保管中", None)
+        assert db.execute("SELECT COUNT(*) FROM item_lock WHERE item_id=?", (item_id,)).fetchone()[0] == 0
+
+
+def test_sample_count_choices_follow_child_items(app):
+    # sample_count の候補はフィルタ候補キャッシュから。子アイテムの増減（実体化カウント）で作り直される
+    from services import get_db, get_filter_choices
+    with app.app_context():
+        db = get_db()
+        item_id = db.execute(
+            "INSERT INTO item (product_name, num_of_samples, sample_manager, status) VALUES ('製品', '77', 'prop', '保管中')"
+        ).lastrowid
+        db.commit()
+        assert "77" in get_filter_choices(db)["sample_count"]
+        db.executemany(
+            "INSERT INTO child_item (item_id, branch_no, owner, status) VALUES (?, ?, 'prop', '持ち出し中')",
+            [(item_id, n) for n in range(1, 79)]
+        )
+        db.commit()
+        choices = get_filter_choices(db)["sample_count"]
+        assert "78" in choices and "77" not in choices
@@ -0,0 +1,63 @@
+# tests/test_smtp_pool.py
+# SMTP 接続プール（ローカルの SMTP サーバーに対して）
+import threading
+from email.message import EmailMessage
+
+from smtp_pool import SmtpPool
+
+
+def _msg(subject, to="user@example.com"):
+    msg = EmailMessage()
+    msg["From"] = "noreply@example.com"
+    msg["To"] = to
+    msg["Subject"] = subject
+    msg.set_content("本文")
+    return msg
+
+
+def test_messages_share_one_connection(smtp_server):
+    pool = SmtpPool(smtp_server.host, smtp_server.port, max_idle=1, max_messages=3)
+    try:
+        for i in range(4):
+            pool.send(_msg(f"件名{i}"))
+    finally:
+        pool.close_all()
+
+    assert [m["subject"] for m in smtp_server.messages] == ["件名0", "件名1", "件名2", "件名3"]
+    peers = [m["peer"] for m in smtp_server.messages]
+    # 3 通までは同じ接続、max_messages で張り直す
+    assert peers[0] == peers[1] == peers[2] != peers[3]
+    stats = pool.stats()
+    assert (stats["sends"], stats["opens"], stats["reuses"]) == (4, 2, 2)
+
+
+def test_concurrency_is_capped(smtp_server):
+    smtp_server.data_delay = 0.2
+    pool = SmtpPool(smtp_server.host, smtp_server.port, max_idle=4, max_concurrency=2)
+    threads = [threading.Thread(target=pool.send, args=(_msg(f"並行{i}"),)) for i in range(6)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+    finally:
+        pool.close_all()
+
+    assert len(smtp_server.messages) == 6
+    assert smtp_server.max_in_flight == 2
+    assert pool.stats()["opens"] <= 2
+
+
+def test_reconnects_after_failed_noop(smtp_server):
+    pool = SmtpPool(smtp_server.host, smtp_server.port, idle_check_sec=0)
+    try:
+        pool.send(_msg("1通目"))
+        smtp_server.noop_status = "421 4.4.2 closing idle connection"
+        pool.send(_msg("2通目"))
+    finally:
+        pool.close_all()
+
+    assert [m["subject"] for m in smtp_server.messages] == ["1通目", "2通目"]
+    assert smtp_server.messages[0]["peer"] != smtp_server.messages[1]["peer"]
+    stats = pool.stats()
+    assert (stats["health_check_failures"], stats["opens"], stats["reuses"]) == (1, 2, 0)
@@ -0,0 +1,146 @@
+# user_directory.py
+"""
+ユーザー名簿（表示名・候補ユーザー・プロフィール）のプロセス内キャッシュ。
+  - users と user_roles を 1 回ずつ全件読み、表示名 2 形式・ロール別の候補・プロフィールを作っておく
+  - data_version の users / user_roles の版数が変わるまでは同じものを返す（他ワーカーの更新にも追従）
+  - 未マイグレーションの DB（data_version が無い）ではキャッシュせず毎回作る
+  - 表示名マップは共有の dict をそのまま返すので、呼び出し側で書き換えないこと
+    （候補リスト・プロフィールは呼び出しごとのコピーを返す）
+"""
+import threading
+
+from services import get_db, get_data_versions
+
+_lock = threading.Lock()
+_cache = {"key": None, "directory": None}
+
+
+def _sort_key(v):
+    """SQLite の ORDER BY と同じ並び（NULL が先頭、文字列はコードポイント順）。"""
+    return (v is not None, v or "")
+
+
+def _build(db) -> dict:
+    users = [
+        {
+            "id": r["id"],
+            "username": r["username"],
+            "realname": r["realname"],
+            "department": r["department"],
+            "email": r["email"],
+        }
+        for r in db.execute("SELECT id, username, realname, department, email FROM users ORDER BY id")
+    ]
+    roles = {}
+    for r in db.execute("""
+        SELECT ur.user_id, r.name
+          FROM user_roles ur
+          JOIN roles r ON ur.role_id = r.id
+    """):
+        roles.setdefault(r["user_id"], set()).add(r["name"])
+
+    by_username = {}
+    display = {}        # username -> realname（空なら username）
+    display_dept = {}   # username -> 部署 + 氏名（氏名が空なら username）
+    display_to_username = {}
+    for u in users:
+        u["roles"] = frozenset(roles.get(u["id"], ()))
+        by_username[u["username"]] = u
+        display[u["username"]] = u["realname"] or u["username"]
+        display_dept[u["username"]] = f"{u['department'] or ''} {u['realname'] or u['username']}".strip(" ")
+        display_to_username.setdefault(display[u["username"]], u["username"])
+
+    def with_role(name, order):
+        return sorted((u for u in users if name in u["roles"]),
+                      key=lambda u: tuple(_sort_key(u[k]) for k in order))
+
+    return {
+        "by_username": by_username,
+        "display": display,
+        "display_dept": display_dept,
+        "display_to_username": display_to_username,
+        "proper": with_role("proper", ("department", "username")),
+        "partner": with_role("partner", ("department", "username")),
+        "manager": with_role("manager", ("department", "realname")),
+    }
+
+
+def get_directory(db=None) -> dict:
+    """名簿一式。users / user_roles の版数が変わるまではプロセス内キャッシュを返す。"""
+    if db is None:
+        db = get_db()
+    key = get_data_versions(db, "users", "user_roles")
+    with _lock:
+        if key is not None and _cache["key"] == key:
+            return _cache["directory"]
+    directory = _build(db)
+    if key is not None:
+        with _lock:
+            _cache["key"] = key
+            _cache["directory"] = directory
+    return directory
+
+
+# ===== 表示名 =====
+def get_user_display(db) -> dict:
+    """username -> 表示名（realname、空なら username）。"""
+    return get_directory(db)["display"]
+
+
+def get_user_display_dept(db) -> dict:
+    """username -> 表示名（部署 + 氏名、氏名が空なら username）。"""
+    return get_directory(db)["display_dept"]
+
+
+def get_user_display_maps(db) -> tuple[dict, dict]:
+    """
+    (username -> 表示名, 表示名 -> username) の組。表示名は realname（空なら username）。
+    逆引きは同名が複数いる場合は最初の一致。
+    """
+    d = get_directory(db)
+    return d["display"], d["display_to_username"]
+
+
+# ===== 候補ユーザー =====
+def get_managers_by_department(department=None, db=None):
+    managers = get_directory(db)["manager"]
+    if department:
+        managers = [u for u in managers if u["department"] == department]
+    return [{'username': u['username'], 'realname': u['realname'], 'department': u['department']} for u in managers]
+
+
+def get_proper_users(db):
+    return [
+        dict(username=u['username'], realname=u['realname'], department=u['department'], email=u['email'])
+        for u in get_directory(db)["proper"]
+    ]
+
+
+def get_partner_users(db):
+    return [
+        dict(username=u['username'], realname=u['realname'], department=u['department'], email=u['email'])
+        for u in get_directory(db)["partner"]
+    ]
+
+
+# ===== プロフィール =====
+def _profile(u, username: str) -> dict:
+    if not u:
+        return {"username": username, "email": "", "realname": "", "department": ""}
+    return {
+        "username": u["username"],
+        "email": u["email"] or "",
+        "realname": u["realname"] or "",
+        "department": u["department"] or ""
+    }
+
+
+def get_user_profile(db, username: str) -> dict:
+    return _profile(get_directory(db)["by_username"].get(username), username)
+
+
+def get_user_profiles(db, usernames: list[str]) -> dict[str, dict]:
+    if not usernames:
+        return {}
+    by_username = get_directory(db)["by_username"]
+    return {u: _profile(by_username.get(u), u) for u in usernames}